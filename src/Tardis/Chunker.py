@@ -0,0 +1,143 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2020, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import hashlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Gear table for the rolling hash.  Must never change, or chunk boundaries (and so deduplication) will shift.
+_gear = [int.from_bytes(hashlib.md5(b'TardisChunk%d' % i).digest()[:8], 'big') for i in range(256)]
+_gearArray = numpy.array(_gear, dtype=numpy.uint64) if numpy else None
+
+_hashMask = 0xFFFFFFFFFFFFFFFF
+
+def _topBits(bits):
+    """ A mask selecting the top bits of the 64 bit hash.  Those depend on the last 64 bytes, rather than just the last few. """
+    return ((1 << bits) - 1) << (64 - bits)
+
+class Chunker:
+    """
+    Split a stream into content defined chunks, using a FastCDC style gear hash with normalized chunking.
+    Chunk boundaries depend only on the content near them, so an insertion or deletion only changes the chunks
+    around it, and identical runs of data in different files (or different versions of a file) produce identical chunks.
+    Iterating yields (offset, data) tuples, covering the entire stream in order.
+    """
+    def __init__(self, stream, avgsize=1024 * 1024, minsize=None, maxsize=None, readsize=None):
+        self.stream = stream
+        self.avgsize = avgsize
+        self.minsize = minsize or avgsize // 4
+        self.maxsize = maxsize or avgsize * 4
+        self.readsize = max(readsize or 8 * 1024 * 1024, self.maxsize)
+        bits = max(avgsize.bit_length() - 1, 3)
+        # Harder to match before the average size, easier after, which pulls chunk sizes towards the average.
+        self.maskS = _topBits(bits + 2)
+        self.maskL = _topBits(bits - 2)
+
+    @staticmethod
+    def _scanPython(buf, origin, start, end, match):
+        """ Roll the hash, started at origin, over buf[start:end].  Returns the position after the first match, or None """
+        gear = _gear
+        # The hash only depends on the last 64 bytes, so it only needs rolling over the 63 before start to catch up.
+        h = 0
+        for x in buf[max(origin, start - 63):start]:
+            h = (h << 1) + gear[x]
+        h &= _hashMask
+        # Only mask the hash every 64 bytes.  The bits above 64 are garbage, but carries only propagate upwards,
+        # so the bits being matched are unaffected, and the loop runs about twice as fast.
+        for block in range(start, end, 64):
+            for i, x in enumerate(buf[block:min(block + 64, end)], block):
+                h = (h << 1) + gear[x]
+                if not h & match:
+                    return i + 1
+            h &= _hashMask
+        return None
+
+    @staticmethod
+    def _scanNumpy(buf, origin, start, end, match, blocksize=256 * 1024):
+        """
+        As _scanPython, but hashes a block of positions at once.  The hash at each position is the sum of the gear values
+        of the 64 bytes (or back to origin) ending there, each shifted left by how far back it is, so the hashes of the
+        whole block are built up by doubling the window: a 2n byte window's hash is the hash of its last n bytes, plus
+        the hash of the n before them, shifted n.  The arithmetic wraps at 64 bits, so the boundaries are the same.
+        """
+        match = numpy.uint64(match)
+        for block in range(start, end, blocksize):
+            stop = min(block + blocksize, end)
+            first = max(origin, block - 63)
+            h = _gearArray[numpy.frombuffer(buf, dtype=numpy.uint8, count=stop - first, offset=first)]
+            window = 1
+            while window < 64:
+                h[window:] += h[:-window] << numpy.uint64(window)
+                window *= 2
+            hits = numpy.flatnonzero((h[block - first:] & match) == 0)
+            if len(hits):
+                return block + int(hits[0]) + 1
+        return None
+
+    # Use numpy, if it's available.  It's many times faster, and finds exactly the same boundaries.
+    _scan = _scanNumpy if numpy else _scanPython
+
+    def _cut(self, buf, start, end):
+        """ Find the length of the chunk starting at start. """
+        length = end - start
+        if length <= self.minsize:
+            return length
+        normal = start + min(self.avgsize, length)
+        limit  = start + min(self.maxsize, length)
+
+        # The hash starts at the minimum size, so nothing before that affects where the chunk ends
+        origin = start + self.minsize
+        i = self._scan(buf, origin, origin, normal, self.maskS)
+        if i is None:
+            i = self._scan(buf, origin, normal, limit, self.maskL)
+        return (i if i is not None else limit) - start
+
+    def __iter__(self):
+        buf = b''
+        pos = 0             # Offset of buf within the stream
+        i = 0               # Start of the next chunk within buf
+        eof = False
+        while True:
+            if not eof and len(buf) - i < self.maxsize:
+                data = self.stream.read(self.readsize)
+                if data:
+                    buf = buf[i:] + data
+                    pos += i
+                    i = 0
+                    continue
+                eof = True
+            if i >= len(buf):
+                break
+            n = self._cut(buf, i, len(buf))
+            yield (pos + i, buf[i:i + n])
+            i += n
@@ -59,6 +59,12 @@ import pprint
 import traceback
 import hmac
 import cProfile
+import threading
+import collections
+import concurrent.futures
+import multiprocessing
+import queue
+import resource
 
 from binascii import hexlify
 
@@ -74,11 +80,17 @@ import Tardis
 import Tardis.TardisCrypto as TardisCrypto
 import Tardis.CompressedBuffer as CompressedBuffer
 import Tardis.Connection as Connection
+import Tardis.Messages as Messages
 import Tardis.Util as Util
 import Tardis.Defaults as Defaults
 import Tardis.librsync as librsync
 import Tardis.MultiFormatter as MultiFormatter
 import Tardis.StatusBar as StatusBar
+import Tardis.ScanState as ScanState
+import Tardis.Chunker as Chunker
+import Tardis.SigCache as SigCache
+import Tardis.InodeDB as InodeDB
+import Tardis.DirColumns as DirColumns
 
 
 features = Tardis.check_features()
@@ -116,6 +128,7 @@ configDefaults = {
     'Local':                str(False),
     'LocalServerCmd':       'tardisd --config ' + local_config,
     'CompressMsgs':         'none',
+    'MsgDictionary':        Defaults.getDefault('TARDIS_MSG_DICTIONARY'),
     'Purge':                str(False),
     'IgnoreCVS':            str(False),
     'SkipCaches':           str(False),
@@ -133,6 +146,27 @@ configDefaults = {
     'Stats':                str(False),
     'Report':               str(False),
     'Directories':          '.',
+    'ScanThreads':          str(0),
+    'ScanState':            str(False),
+    'ScanStateDir':         '~/.tardis',
+    'Window':               str(0),
+    'ChecksumThreads':      str(0),
+    'DeltaThreads':         str(0),
+    'CompressThreads':      str(0),
+    'AdaptiveCompress':     str(False),
+    'ChunkDedup':           str(False),
+    'ChunkThreshold':       str(16 * 1024 * 1024),
+    'RangeThreads':         str(0),
+    'RangeThreshold':       str(256 * 1024 * 1024),
+    'RangeConnections':     str(0),
+    'ChecksumFilter':       str(False),
+    'ColumnarDirs':         str(False),
+    'TreeDigests':          str(False),
+    'Connections':          str(1),
+    'SignatureHash':        'md4',
+    'ContentHash':          None,
+    'SigCache':             str(False),
+    'SigCacheSize':         str(1024 * 1024 * 1024),
 }
 
 excludeDirs         = []
@@ -158,7 +192,10 @@ args                = None
 config              = None
 
 cloneDirs           = []
-cloneContents       = {}
+cloneContents       = {}                            # (inode, device) => (path index, list of file infos)
+treeDigests         = {}                            # (inode, device) => (digest of the tree below it, list of subdirectory (inode, device)s)
+unchangedTrees      = set()                         # (inode, device) of trees the server found unchanged, and cloned whole
+pendingTreeDigests  = []                            # Digests of trees which have been backed up, to be recorded on the server
 batchMsgs           = []
 metaCache           = Util.bidict()                 # A cache of metadata.  Since many files can have the same metadata, we check that
                                                     # that we haven't sent it yet.
@@ -166,6 +203,22 @@ newmeta             = []                            # When we encounter new meta
 
 noCompTypes         = []
 
+scanPool            = None                          # Thread pool for scanning directories, if --scan-threads is set
+metaLock            = threading.Lock()
+scanState           = None                          # Saved state of the last completed backup, if --scan-state is set
+checksumFilter      = None                          # Bloom filter of the checksums the server has, if --checksum-filter is set
+forkedState         = None                          # In forked connections, the main process's scan state.  Held so it's never used or closed (and rolled back) here.
+checksumPool        = None                          # Thread pool for calculating checksums, if --checksum-threads is set
+deltaPool           = None                          # Thread pool for generating deltas, if --delta-threads is set
+rangePool           = None                          # Thread pool for preparing ranges of large files, if --range-threads is set
+rangeSenders        = None                          # Processes sending ranges over their own connections, and their job and result queues, if --range-connections is set
+sigCache            = None                          # Local copies of the signatures of files sent, if --sig-cache is set
+columnarDirs        = False                         # Send directories as columns, if --columnar-dirs is set, and the server supports it
+treeMode            = False                         # Skip unchanged trees, found by their digests, if --tree-digests is set, and the server supports it
+packFiles           = False                         # Pack small files together, if --packsize is set, and the server supports it
+rangedFiles         = False                         # Send large files and deltas in resumable ranges, if --range-threshold is set, and the server supports it
+deltaBases          = {}                            # Checksum of the version the server has of each file it wants a delta of
+
 crypt               = None
 logger              = None
 exceptionLogger     = None
@@ -189,11 +242,11 @@ contentKey          = None
 # Example: If you have 100 files, and 99 of them are already backed up (ie, one new), backed would be 100, but new would be 1.
 # dataSent is the compressed and encrypted size of the files (or deltas) sent in this run, but dataBacked is the total size of
 # the files.
-stats = { 'dirs' : 0, 'files' : 0, 'links' : 0, 'backed' : 0, 'dataSent': 0, 'dataBacked': 0 , 'new': 0, 'delta': 0, 'gone': 0, 'denied': 0 }
+stats = { 'dirs' : 0, 'files' : 0, 'links' : 0, 'backed' : 0, 'dataSent': 0, 'dataBacked': 0 , 'new': 0, 'delta': 0, 'gone': 0, 'denied': 0, 'chunksSent': 0, 'chunksDedup': 0, 'filterMisses': 0, 'rangesSent': 0, 'rangesResumed': 0, 'sigsCached': 0 }
 
 report = {}
 
-inodeDB             = {}
+inodeDB             = InodeDB.InodeDB()
 dirHashes           = {
     (0, 0): ('00000000000000000000000000000000', 0)
     }
@@ -295,34 +348,50 @@ def msgInfo(resp=None, batch=None):
     return (respId, respType, batchId)
 
 
+def checksumFile(pathname):
+    """ Calculate the checksum of a file.  Safe to run in the checksum threads """
+    m = crypt.getHash()
+    with open(pathname, "rb") as f:
+        for chunk in iter(functools.partial(f.read, args.chunksize), b''):
+            m.update(chunk)
+    return m.hexdigest()
+
+def getChecksumFilter():
+    """ Get the server's filter of the checksums it has content for.  Fetched the first time it's needed. """
+    global checksumFilter
+    if checksumFilter is None:
+        message = {
+            "message": "CKF"
+        }
+        setMessageID(message)
+        response = sendAndReceive(message)
+        checkMessage(response, 'ACKCKF')
+        checksumFilter = Util.BloomFilter(response['bits'], response['hashes'], conn.decode(response['filter']))
+        logger.debug("Received checksum filter: %d bits, %d hashes", checksumFilter.bits, checksumFilter.hashes)
+    return checksumFilter
+
 def processChecksums(inodes):
     """ Generate checksums for requested checksum files """
     files = []
+    absent = []
+    bloom = getChecksumFilter() if args.checksumfilter else None
+    # First, start the checksums running in the pool, if there is one.  Otherwise they're calculated below
+    pending = []
     for inode in inodes:
         try:
             (_, pathname) = inodeDB[inode]
 
-            setProgress("File [C]:", pathname)
-
-            m = crypt.getHash()
             s = os.lstat(pathname)
-            mode = s.st_mode
-            if stat.S_ISLNK(mode):
-                m.update(fs_encode(os.readlink(pathname)))
-            else:
-                try:
-                    with open(pathname, "rb") as f:
-                        for chunk in iter(functools.partial(f.read, args.chunksize), b''):
-                            if chunk:
-                                m.update(chunk)
-                            else:
-                                break
-                        checksum = m.hexdigest()
-                        files.append({ "inode": inode, "checksum": checksum })
-                except IOError as e:
-                    logger.error("Unable to generate checksum for %s: %s", pathname, str(e))
-                    exceptionLogger.log(e)
-                    # TODO: Add an error response?
+            if stat.S_ISLNK(s.st_mode):
+                # Links have never had checksums sent for them here.
+                continue
+            checksum = None
+            if scanState:
+                checksum = scanState.getChecksum(s.st_ino, s.st_dev, s.st_size, int(s.st_mtime), int(s.st_ctime))
+            job = None
+            if checksum is None and checksumPool:
+                job = checksumPool.submit(checksumFile, pathname)
+            pending.append((inode, pathname, s, checksum, job))
         except KeyError as e:
             (rId, rType, bId) = msgInfo()
             logger.error("Unable to process checksum for %s, not found in inodeDB (%s, %s -- %s)", str(inode), rId, rType, bId)
@@ -339,14 +408,41 @@ def processChecksums(inodes):
             exceptionLogger.log(e)
             # TODO: Add an error response?
 
-    message = {
-        "message": "CKS",
-        "files": files
-    }
+    # Collect the results, in the order they were requested
+    for (inode, pathname, s, checksum, job) in pending:
+        setProgress("File [C]:", pathname)
+        if checksum is None:
+            try:
+                checksum = job.result() if job else checksumFile(pathname)
+            except Exception as e:
+                logger.error("Unable to generate checksum for %s: %s", pathname, str(e))
+                exceptionLogger.log(e)
+                # TODO: Add an error response?
+                continue
+            if scanState:
+                scanState.setChecksum(s.st_ino, s.st_dev, s.st_size, int(s.st_mtime), int(s.st_ctime), checksum)
+        if bloom is not None and checksum not in bloom:
+            # The server definitely doesn't have it, so don't bother asking
+            absent.append(inode)
+        else:
+            files.append({ "inode": inode, "checksum": checksum })
 
-    #response = sendAndReceive(message)
-    #handleAckSum(response)
-    batchMessage(message)
+    if files:
+        message = {
+            "message": "CKS",
+            "files": files
+        }
+
+        #response = sendAndReceive(message)
+        #handleAckSum(response)
+        batchMessage(message)
+
+    for inode in absent:
+        if logger.isEnabledFor(logging.FILES):
+            logFileInfo(inode, 'n')
+        Util.accumulateStat(stats, 'filterMisses')
+        sendContent(inode, 'Full')
+        delInode(inode)
 
 def logFileInfo(i, c):
     if i in inodeDB:
@@ -384,24 +480,39 @@ def handleAckSum(response):
         sendContent(i, 'Full')
         delInode(i)
 
-    signatures = None
-    if not args.full and len(delta) != 0:
-        signatures = prefetchSigFiles(delta)
-
-    for i in [tuple(x) for x in delta]:
+    for (i, sig, d) in prefetchDeltas([tuple(x) for x in delta]):
         if logfiles:
             logFileInfo(i, 'd')
-        processDelta(i, signatures)
+        processDelta(i, sig, d)
         delInode(i)
 
+    flushPacked()
+
+def signatureWanted():
+    """ Should signatures be sent to the server.  It can't generate them itself if the data's encrypted """
+    return crypt.encrypting() or args.signature
+
+def sigParams(size):
+    """ The parameters for the signature of a file of the given size, or False if no signature is needed """
+    if signatureWanted() or sigCache is not None:
+        return librsync.sigParams(size, args.sighash)
+    return False
+
+def cacheSignature(checksum, sig):
+    """ Keep a copy of the signature of a file just sent, so it needn't be fetched when the next delta of it is made """
+    if sigCache is not None and checksum and sig:
+        sigCache.insert(checksum, sig)
+        sig.seek(0)
+
 def makeEncryptor():
     iv = crypt.getIV()
     encryptor = crypt.getContentEncryptor(iv)
     return (encryptor, iv)
 
 def prefetchSigFiles(inodes):
+    """ Request the signatures for a list of files, and yield each one as it arrives, as (inode, sigfile, checksum).
+        The server sends them all in one stream, so it must be read to the end before anything else is sent. """
     logger.debug("Requesting signature files: %s", str(inodes))
-    signatures = {}
 
     message = {
         "message": "SGS",
@@ -421,13 +532,11 @@ def prefetchSigFiles(inodes):
         Util.receiveData(conn.sender, sigfile)
         logger.debug("Received sig file: %d", sigfile.tell())
         sigfile.seek(0)
-        signatures[inode] = (sigfile, sigmessage['checksum'])
-
+        yield (inode, sigfile, sigmessage['checksum'])
 
         # Get the next file in the stream
         sigmessage = receiveMessage()
         checkMessage(sigmessage, "SIG")
-    return signatures
 
 def fetchSignature(inode):
     logger.debug("Requesting checksum for %s", str(inode))
@@ -459,47 +568,121 @@ def fetchSignature(inode):
     return (sigfile, None)
 
 
-def processDelta(inode, signatures):
-    """ Generate a delta and send it """
+def makeDelta(pathname, sigfile):
+    """ Generate the delta of a file against a signature.  Safe to run in the delta threads.
+        Returns the delta file and its size, and the checksum, size, and new signature (if needed) of the file """
+    logger.debug("Generating delta for %s", pathname)
+
+    with open(pathname, "rb") as f:
+        # If we're encrypted, we need to generate a new signature, and send it along.  Or if we're keeping our own copy
+        makeSig = sigParams(os.fstat(f.fileno()).st_size)
+
+        # Create a buffered reader object, which can generate the checksum and an actual filesize while
+        # reading the file.  And, if we need it, the signature
+        reader = CompressedBuffer.BufferedReader(f, hasher=crypt.getHash(), signature=makeSig)
+
+        # Generate the delta file
+        delta = librsync.delta(reader, sigfile)
+        sigfile.close()
+
+    # get the auxiliary info
+    checksum = reader.checksum()
+    filesize = reader.size()
+    newsig = reader.signatureFile()
+
+    # Figure out the size of the delta file.  Seek to the end, do a tell, and go back to the start
+    # Ugly.
+    delta.seek(0, 2)
+    deltasize = delta.tell()
+    delta.seek(0)
+
+    return (delta, deltasize, checksum, filesize, newsig)
+
+def startDelta(inode, pathname, sig=None):
+    """ Start generating the delta of a file against its signature, in the delta pool if it's running.  If the signature
+        (and the basis checksum) weren't prefetched, get it now.
+        Returns a future for the results of makeDelta (None if there's no signature), and the checksum of the basis """
+    if sig:
+        (sigfile, oldchksum) = sig
+    else:
+        (sigfile, oldchksum) = fetchSignature(inode)
+
+    if sigfile is None:
+        return (None, None)
+
+    if deltaPool:
+        job = deltaPool.submit(makeDelta, pathname, sigfile)
+    else:
+        job = concurrent.futures.Future()
+        try:
+            job.set_result(makeDelta(pathname, sigfile))
+        except Exception as e:
+            job.set_exception(e)
+    return (job, oldchksum)
+
+def prefetchDeltas(inodes):
+    """
+    Fetch the signatures for a list of files in batches of args.deltawindow, and, if the delta pool is running, start
+    generating each delta as soon as its signature arrives.  The next batch's signatures are fetched before this batch
+    is handed back to be sent, so generating deltas overlaps both receiving the signatures and sending the deltas.
+    Signatures are never fetched while a delta is being sent, as neither side would be reading.
+    Yields each inode, in order, with its signature and startDelta results (None for either if there aren't any)
+    """
+    if args.full:
+        for inode in inodes:
+            yield (inode, None, None)
+        return
+
+    size = max(args.deltawindow, 1) if deltaPool else max(len(inodes), 1)
+    ready = []
+    for i in range(0, len(inodes), size):
+        batch = inodes[i:i + size]
+        sigs = {}
+        started = {}
+        # Use our own copies of the signatures where we have them, and only ask the server for the rest
+        cached = []
+        if sigCache is not None:
+            for inode in batch:
+                basis = deltaBases.get(inode)
+                sigfile = sigCache.get(basis) if basis else None
+                if sigfile:
+                    cached.append((inode, sigfile, basis))
+        hits = set(c[0] for c in cached)
+        fetch = [x for x in batch if x not in hits]
+        Util.accumulateStat(stats, 'sigsCached', len(cached))
+        for (inode, sigfile, checksum) in itertools.chain(cached, prefetchSigFiles(fetch) if fetch else []):
+            deltaBases.pop(inode, None)
+            if deltaPool and inode in inodeDB:
+                (_, pathname) = inodeDB[inode]
+                try:
+                    started[inode] = startDelta(inode, pathname, (sigfile, checksum))
+                except Exception as e:
+                    # Hand the failure on with the file, so processDelta sends it in full, rather than ending the generator
+                    job = concurrent.futures.Future()
+                    job.set_exception(e)
+                    started[inode] = (job, checksum)
+            else:
+                sigs[inode] = (sigfile, checksum)
+        yield from ready
+        ready = [(inode, sigs.get(inode), started.get(inode)) for inode in batch]
+    yield from ready
+
+def processDelta(inode, sig=None, started=None):
+    """ Generate a delta and send it.  If the delta was started by prefetchDeltas, started holds the startDelta results.
+        Otherwise sig holds the prefetched signature, if there is one """
 
     try:
-        (_, pathname) = inodeDB[inode]
+        (fileInfo, pathname) = inodeDB[inode]
         setProgress("File [D]:", pathname)
         logger.debug("Processing delta: %s :: %s", str(inode), pathname)
 
-        if signatures and inode in signatures:
-            (sigfile, oldchksum) = signatures[inode]
-        else:
-            (sigfile, oldchksum) = fetchSignature(inode)
+        if started is None:
+            started = startDelta(inode, pathname, sig)
+        (job, oldchksum) = started
 
-        if sigfile is not None:
+        if job is not None:
             try:
-                newsig = None
-                # If we're encrypted, we need to generate a new signature, and send it along
-                makeSig = crypt.encrypting() or args.signature
-
-                logger.debug("Generating delta for %s", pathname)
-
-                # Create a buffered reader object, which can generate the checksum and an actual filesize while
-                # reading the file.  And, if we need it, the signature
-                reader = CompressedBuffer.BufferedReader(open(pathname, "rb"), hasher=crypt.getHash(), signature=makeSig)
-                # HACK: Monkeypatch the reader object to have a seek function to keep librsync happy.  Never gets called
-                reader.seek = lambda x, y: 0
-
-                # Generate the delta file
-                delta = librsync.delta(reader, sigfile)
-                sigfile.close()
-
-                # get the auxiliary info
-                checksum = reader.checksum()
-                filesize = reader.size()
-                newsig = reader.signatureFile()
-
-                # Figure out the size of the delta file.  Seek to the end, do a tell, and go back to the start
-                # Ugly.
-                delta.seek(0, 2)
-                deltasize = delta.tell()
-                delta.seek(0)
+                (delta, deltasize, checksum, filesize, newsig) = job.result()
             except Exception as e:
                 logger.warning("Unable to process signature.  Sending full file: %s: %s", pathname, str(e))
                 exceptionLogger.log(e)
@@ -507,27 +690,32 @@ def processDelta(inode, signatures):
                 return
 
             if deltasize < (filesize * float(args.deltathreshold) / 100.0):
-                encrypt, iv, = makeEncryptor()
                 Util.accumulateStat(stats, 'delta')
-                message = {
-                    "message": "DEL",
-                    "inode": inode,
-                    "size": filesize,
-                    "checksum": checksum,
-                    "basis": oldchksum,
-                    "encoding": encoding,
-                    "encrypted": True if iv else False
-                }
-
-                sendMessage(message)
-                #batchMessage(message, flush=True, batch=False, response=False)
                 compress = args.compress if (args.compress and (filesize > args.mincompsize)) else None
-                (sent, _, _) = Util.sendData(conn.sender, delta, encrypt, chunksize=args.chunksize, compress=compress, stats=stats)
+                if rangedFiles and deltasize >= args.rangethreshold:
+                    # Large delta.  Send it in ranges, like a large file, so it can be resumed
+                    (sent, _, _) = sendRanged(inode, fileInfo, delta, compress, None, delta=(oldchksum, checksum, filesize))
+                else:
+                    encrypt, iv, = makeEncryptor()
+                    message = {
+                        "message": "DEL",
+                        "inode": inode,
+                        "size": filesize,
+                        "checksum": checksum,
+                        "basis": oldchksum,
+                        "encoding": encoding,
+                        "encrypted": True if iv else False
+                    }
+
+                    sendMessage(message)
+                    #batchMessage(message, flush=True, batch=False, response=False)
+                    (sent, _, _) = Util.sendData(conn.sender, delta, encrypt, chunksize=args.chunksize, compress=compress, stats=stats, threads=args.compressthreads)
                 delta.close()
 
                 # If we have a signature, send it.
                 sigsize = 0
-                if newsig:
+                cacheSignature(checksum, newsig)
+                if newsig and signatureWanted():
                     message = {
                         "message" : "SIG",
                         "checksum": checksum
@@ -536,8 +724,11 @@ def processDelta(inode, signatures):
                     #batchMessage(message, flush=True, batch=False, response=False)
                     # Send the signature, generated above
                     (sigsize, _, _) = Util.sendData(conn.sender, newsig, TardisCrypto.NullEncryptor(), chunksize=args.chunksize, compress=False, stats=stats) # Don't bother to encrypt the signature
+                if newsig:
                     newsig.close()
 
+                recordChecksum(inode, filesize, checksum)
+
                 if args.report:
                     x = { 'type': 'Delta', 'size': sent, 'sigsize': sigsize }
                     # Convert to Unicode, and normalize any characters, so lengths become reasonable
@@ -547,6 +738,7 @@ def processDelta(inode, signatures):
             else:
                 if logger.isEnabledFor(logging.DEBUG):
                     logger.debug("Delta size for %s is too large.  Sending full content: Delta: %d File: %d", Util.shortPath(pathname, 40), deltasize, filesize)
+                delta.close()
                 sendContent(inode, 'Full')
         else:
             sendContent(inode, 'Full')
@@ -554,6 +746,343 @@ def processDelta(inode, signatures):
         logger.error("ProcessDelta: No inode entry for %s", inode)
         exceptionLogger.log(e)
 
+def recordChecksum(inode, size, checksum):
+    """ Save the checksum of a file we've just sent in the scan state, if the file didn't change size while we were reading it.
+        Also add it to the checksum filter, so any other copies of it get checked with the server, rather than sent again. """
+    if checksumFilter is not None and checksum:
+        checksumFilter.add(checksum)
+    if scanState and checksum and inode in inodeDB:
+        (fileInfo, _) = inodeDB[inode]
+        if fileInfo['size'] == size:
+            scanState.setChecksum(inode[0], inode[1], size, fileInfo['mtime'], fileInfo['ctime'], checksum)
+
+def sizeClass(size):
+    """ Bucket file sizes by powers of 4 """
+    return max(0, (size.bit_length() - 11) // 2)
+
+def checkCompression(pathname, data, filesize):
+    """ Decide whether to compress a file.  Returns the compression to use, and, if the compression model is in
+        use, the class of file to record the results under """
+    compress = args.compress if (args.compress and (filesize > args.mincompsize)) else None
+    if not compress:
+        return (None, None)
+
+    adaptive = scanState and args.adaptivecompress
+    cls = None
+    if adaptive:
+        # Try the extension first.  If the class has a known verdict, there's no need to check the type
+        ext = os.path.splitext(pathname)[1].lower()
+        if ext:
+            cls = "{}:{}".format(ext, sizeClass(filesize))
+            compressible = scanState.isCompressible(cls)
+            if compressible is not None:
+                if not compressible:
+                    logger.debug("Not compressing %s.  Class %s is incompressible", pathname, cls)
+                return (compress if compressible else None, cls)
+
+    # Check if it's a file type we don't want to compress
+    if noCompTypes or (adaptive and cls is None):
+        mimeType = magic.from_buffer(data.read(128), mime=True)
+        data.seek(0)
+        if mimeType in noCompTypes:
+            logger.debug("Not compressing %s.  Type %s", pathname, mimeType)
+            return (None, None)
+        if adaptive and cls is None:
+            cls = "{}:{}".format(mimeType, sizeClass(filesize))
+            if scanState.isCompressible(cls) is False:
+                logger.debug("Not compressing %s.  Class %s is incompressible", pathname, cls)
+                return (None, cls)
+    return (compress, cls)
+
+packedFiles = []
+packedSize  = 0
+
+def flushPacked():
+    """ Send any small files which have been packed together """
+    global packedFiles, packedSize
+    if packedFiles:
+        logger.debug("Sending %d packed files, %d bytes", len(packedFiles), packedSize)
+        message = {
+            "message": "PCK",
+            "files": packedFiles
+        }
+        sendMessage(message)
+        packedFiles = []
+        packedSize  = 0
+
+def packContent(inode, data, encrypt, iv, compress, makeSig):
+    """ Add the content of a small file to the pack of files to be sent together in one PCK message """
+    global packedSize
+    (blob, size, checksum, compressed, sig) = Util.packData(data, encrypt, hasher=crypt.getHash(), chunksize=args.chunksize,
+                                                            compress=compress, signature=makeSig, stats=stats)
+    entry = {
+        "inode":        inode,
+        "checksum":     checksum,
+        "size":         size,
+        "compressed":   compressed,
+        "encrypted":    True if iv else False,
+        "data":         conn.encode(blob)
+    }
+    if sig:
+        cacheSignature(checksum, sig)
+        if signatureWanted():
+            sig.seek(0)
+            entry["sig"] = conn.encode(sig.read())
+        sig.close()
+    packedFiles.append(entry)
+    packedSize += len(blob)
+
+    if len(packedFiles) >= args.packcount or packedSize >= args.chunksize:
+        flushPacked()
+    return (size, checksum)
+
+def isChunked(fileInfo):
+    """ Should this file be sent as a list of chunks """
+    return args.chunkdedup and stat.S_ISREG(fileInfo['mode']) and fileInfo['size'] >= args.chunkthreshold
+
+def sendChunked(inode, fileInfo, data, compress, makeSig):
+    """
+    Send a file as a list of content defined chunks.  The file is read once to find the chunks, and the server
+    is asked which of them it doesn't already have.  Only those are read again and sent, each as its own piece of
+    content, followed by the list of chunks which make up the file.  The server keeps chunks which arrive even if the
+    file isn't finished, so an interrupted upload only has to send what's left.
+    """
+    hasher = crypt.getHash()
+    sigJob = librsync.SignatureJob(**makeSig) if makeSig else None
+    chunks = []
+    size = 0
+    for (offset, chunk) in Chunker.Chunker(data, args.chunkavg):
+        hasher.update(chunk)
+        if sigJob:
+            sigJob.step(chunk)
+        h = crypt.getHash()
+        h.update(chunk)
+        chunks.append((offset, len(chunk), h.hexdigest()))
+        size += len(chunk)
+    if sigJob:
+        sigJob.step(b'')
+    checksum = hasher.hexdigest()
+
+    message = {
+        "message": "CHQ",
+        "inode": inode,
+        "size": fileInfo['size'],
+        "mtime": fileInfo['mtime'],
+        "checksums": list(dict.fromkeys(c[2] for c in chunks))
+    }
+    setMessageID(message)
+    response = sendAndReceive(message)
+    checkMessage(response, 'ACKCHQ')
+    missing = set(response['missing'])
+    logger.debug("Sending %d of %d chunks", len(missing), len(chunks))
+
+    for (offset, length, cks) in chunks:
+        if cks not in missing:
+            Util.accumulateStat(stats, 'chunksDedup')
+            continue
+        missing.discard(cks)
+        data.seek(offset)
+        encrypt, iv = makeEncryptor()
+        message = {
+            "message":      "CNK",
+            "chunk":        cks,
+            "inode":        inode,
+            "offset":       offset,
+            "length":       length,
+            "encrypted":    True if iv else False
+        }
+        sendMessage(message)
+        (_, ck, _) = Util.sendData(conn.sender, io.BytesIO(data.read(length)),
+                                   encrypt, hasher=crypt.getHash(),
+                                   chunksize=args.chunksize,
+                                   compress=compress,
+                                   stats=stats,
+                                   threads=args.compressthreads)
+        if ck != cks:
+            raise Exception("File changed while being sent")
+        Util.accumulateStat(stats, 'chunksSent')
+
+    message = {
+        "message":      "MAN",
+        "inode":        inode,
+        "checksum":     checksum,
+        "size":         size,
+        "encrypted":    crypt.encrypting(),
+        "chunks":       [c[2] for c in chunks]
+    }
+    sendMessage(message)
+    return (size, checksum, sigJob.sigfile() if sigJob else None)
+
+def isRanged(fileInfo):
+    """ Should this file be sent as ranges, so it can be resumed if interrupted """
+    return rangedFiles and stat.S_ISREG(fileInfo['mode']) and fileInfo['size'] >= args.rangethreshold
+
+def packRange(block, encrypt, compress):
+    """ Compress and encrypt one range of a file.  Run in the range pool.  Returns the data stream to send, and its trailer """
+    collector = Util._PackCollector()
+    Util.sendData(collector, io.BytesIO(block), encrypt, hasher=crypt.getHash(), chunksize=args.chunksize, compress=compress)
+    return collector
+
+def makeRangeMessage(inode, fileInfo, offset, length, collector):
+    """ Build the header for a range prepared by packRange.  It carries the version of the file, so whichever connection
+        it goes over, the server can record it against the right upload, and how it's compressed, so the server can
+        check it as it arrives. """
+    return {
+        "message":      "RNG",
+        "inode":        inode,
+        "chunk":        collector.trailer['checksum'],
+        "offset":       offset,
+        "length":       length,
+        "size":         fileInfo['size'],
+        "mtime":        fileInfo['mtime'],
+        "compressed":   collector.trailer['compressed'],
+        "encrypted":    crypt.encrypting()
+    }
+
+def transmitRange(message, chunks, trailer):
+    """ Send a range's header, data and trailer over this process's connection.  The chunks end with the empty frame
+        which closes the data stream. """
+    sendMessage(message)
+    for data in chunks:
+        conn.sender.sendMessage(data, raw=True)
+    conn.sender.sendMessage(trailer)
+
+def sendRange(inode, fileInfo, offset, length, job):
+    """ Send a range prepared by packRange, once it's ready """
+    collector = job.result()
+    transmitRange(makeRangeMessage(inode, fileInfo, offset, length, collector), collector.chunks, collector.trailer)
+    Util.accumulateStat(stats, 'dataSent', sum(map(len, collector.chunks)))
+    Util.accumulateStat(stats, 'dataBacked', length)
+    Util.accumulateStat(stats, 'rangesSent')
+    return collector.trailer['checksum']
+
+def dispatchRange(inode, fileInfo, offset, length, job, dispatched):
+    """ Hand a range prepared by packRange to the range senders, once it's ready.  Remember it, in case it has to be sent again. """
+    (_, jobs, _) = rangeSenders
+    collector = job.result()
+    jobs.put((makeRangeMessage(inode, fileInfo, offset, length, collector), collector.chunks, collector.trailer))
+    dispatched[offset] = (length, job)
+    return collector.trailer['checksum']
+
+def collectRange(dispatched, failed):
+    """ Wait for a range sender to say whether a range arrived intact.  If a sender has died, the ranges still out can't
+        be accounted for, so they're all marked failed, and the senders aren't used again. """
+    (senders, _, results) = rangeSenders
+    while True:
+        try:
+            (offset, ok) = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if all(s.is_alive() for s in senders):
+                continue
+            logger.error("Range connection died.  Sending the rest of the ranges over the main connection")
+            failed.update(dispatched)
+            dispatched.clear()
+            stopRangeSenders()
+            return
+    if offset not in dispatched:
+        return
+    if ok:
+        (length, job) = dispatched.pop(offset)
+        Util.accumulateStat(stats, 'dataSent', sum(map(len, job.result().chunks)))
+        Util.accumulateStat(stats, 'dataBacked', length)
+        Util.accumulateStat(stats, 'rangesSent')
+    else:
+        failed[offset] = dispatched.pop(offset)
+
+def sendRanged(inode, fileInfo, data, compress, makeSig, delta=None):
+    """
+    Send a large file as a list of fixed size ranges.  The file is read sequentially, but each range is compressed,
+    encrypted and checksummed in the range pool, if it's running, so several are prepared at once, and sent in order as
+    they're ready.  If range senders are running, the ranges are spread over their connections instead, and any which
+    don't arrive intact are sent again here.  The server stores each range as its own piece of content, checks it as it
+    arrives, and records the file as the list of ranges once they've all arrived.  Ranges which arrived in an earlier,
+    interrupted, session aren't sent again, if they still match.
+    If delta is set, data is a delta, rather than the file, and delta holds the basis checksum, and the new file's checksum and size.
+    """
+    message = {
+        "message":      "RNQ",
+        "inode":        inode,
+        "size":         fileInfo['size'],
+        "mtime":        fileInfo['mtime']
+    }
+    setMessageID(message)
+    response = sendAndReceive(message)
+    checkMessage(response, 'ACKRNQ')
+    received = {offset: (length, cks) for (offset, length, cks) in response['ranges']}
+
+    hasher = crypt.getHash()
+    sigJob = librsync.SignatureJob(**makeSig) if makeSig else None
+    pending = collections.deque()
+    chunks = []
+    size = 0
+    dispatched = {}                 # Ranges handed to the range senders, which they haven't reported on yet
+    failed = {}                     # Ranges the range senders couldn't send intact
+
+    def send(offset, length, job):
+        # The range senders can be stopped part way through, if one fails
+        if rangeSenders:
+            return dispatchRange(inode, fileInfo, offset, length, job, dispatched)
+        return sendRange(inode, fileInfo, offset, length, job)
+    while True:
+        block = data.read(args.rangesize)
+        if not block:
+            break
+        hasher.update(block)
+        if sigJob:
+            sigJob.step(block)
+        if received.get(size, (None, None))[0] == len(block):
+            h = crypt.getHash()
+            h.update(block)
+            if h.hexdigest() == received[size][1]:
+                while pending:
+                    chunks.append(send(*pending.popleft()))
+                chunks.append(received[size][1])
+                Util.accumulateStat(stats, 'rangesResumed')
+                size += len(block)
+                continue
+        encrypt, _ = makeEncryptor()
+        if rangePool:
+            job = rangePool.submit(packRange, block, encrypt, compress)
+        else:
+            job = concurrent.futures.Future()
+            job.set_result(packRange(block, encrypt, compress))
+        pending.append((size, len(block), job))
+        size += len(block)
+        # Keep the pool busy, but don't hold more than a couple of ranges per thread in memory
+        while len(pending) > 2 * args.rangethreads:
+            chunks.append(send(*pending.popleft()))
+        # Nor more than a couple per connection waiting to be sent
+        while rangeSenders and len(dispatched) > 2 * len(rangeSenders[0]):
+            collectRange(dispatched, failed)
+    while pending:
+        chunks.append(send(*pending.popleft()))
+    while dispatched:
+        collectRange(dispatched, failed)
+    # Anything which didn't make it over the range connections goes again over this one
+    for offset in sorted(failed):
+        (length, job) = failed[offset]
+        logger.debug("Resending range %d of %s", offset, inode)
+        sendRange(inode, fileInfo, offset, length, job)
+    if sigJob:
+        sigJob.step(b'')
+    checksum = hasher.hexdigest()
+
+    message = {
+        "message":      "MAN",
+        "inode":        inode,
+        "checksum":     checksum,
+        "size":         size,
+        "encrypted":    crypt.encrypting(),
+        "chunks":       chunks,
+        "ranged":       True
+    }
+    if delta:
+        (basis, checksum, filesize) = delta
+        message.update({"checksum": checksum, "size": filesize, "deltasize": size, "basis": basis})
+    sendMessage(message)
+    return (size, checksum, sigJob.sigfile() if sigJob else None)
+
 def sendContent(inode, reportType):
     """ Send the content of a file.  Compress and encrypt, as specified by the options. """
 
@@ -602,27 +1131,40 @@ def sendContent(inode, reportType):
 
             # Attempt to send the data.
             sig = None
+            size = 0
             sigsize = 0
             try:
-                compress = args.compress if (args.compress and (filesize > args.mincompsize)) else None
-                # Check if it's a file type we don't want to compress
-                if compress and noCompTypes:
-                    mimeType = magic.from_buffer(data.read(128), mime=True)
-                    data.seek(0)
-                    if mimeType in noCompTypes:
-                        logger.debug("Not compressing %s.  Type %s", pathname, mimeType)
-                        compress = False
-                makeSig = crypt.encrypting() or args.signature
-                sendMessage(message)
-                #batchMessage(message, batch=False, flush=True, response=False)
-                (size, checksum, sig) = Util.sendData(conn.sender, data,
-                                                      encrypt, hasher=crypt.getHash(),
-                                                      chunksize=args.chunksize,
-                                                      compress=compress,
-                                                      signature=makeSig,
-                                                      stats=stats)
-
-                if sig:
+                (compress, compressClass) = checkCompression(pathname, data, filesize)
+                makeSig = sigParams(filesize)
+                sentBefore = stats['dataSent']
+                if isChunked(fileInfo):
+                    # Large file.  Send it as content defined chunks, so only the chunks the server doesn't have get sent
+                    (size, checksum, sig) = sendChunked(inode, fileInfo, data, compress, makeSig)
+                    compressClass = None
+                elif isRanged(fileInfo):
+                    # Very large file.  Prepare and send it in ranges, several at once
+                    (size, checksum, sig) = sendRanged(inode, fileInfo, data, compress, makeSig)
+                    compressClass = None
+                elif packFiles and filesize <= args.packsize:
+                    # Small file.  Pack it together with others, rather than sending it on its own
+                    (size, checksum) = packContent(inode, data, encrypt, iv, compress, makeSig)
+                else:
+                    sendMessage(message)
+                    #batchMessage(message, batch=False, flush=True, response=False)
+                    (size, checksum, sig) = Util.sendData(conn.sender, data,
+                                                          encrypt, hasher=crypt.getHash(),
+                                                          chunksize=args.chunksize,
+                                                          compress=compress,
+                                                          signature=makeSig,
+                                                          stats=stats,
+                                                          threads=args.compressthreads)
+
+                # Record how well the compression did, if we tried it
+                if compressClass and compress and size:
+                    scanState.recordCompression(compressClass, size, stats['dataSent'] - sentBefore)
+
+                cacheSignature(checksum, sig)
+                if sig and signatureWanted():
                     sig.seek(0)
                     message = {
                         "message" : "SIG",
@@ -642,6 +1184,7 @@ def sendContent(inode, reportType):
                     sig.close()
 
             Util.accumulateStat(stats, 'new')
+            recordChecksum(inode, size, checksum)
             if args.report:
                 repInfo = { 'type': reportType, 'size': size, 'sigsize': sigsize }
                 report[os.path.split(pathname)] = repInfo
@@ -724,6 +1267,10 @@ def handleAckDir(message):
     cksum   = message.setdefault("cksum", {})
     refresh = message.setdefault("refresh", {})
 
+    if sigCache is not None:
+        for (inode, dev, basis) in message.get('bases', []):
+            deltaBases[(inode, dev)] = basis
+
     if verbosity > 2:
         path = message['path']
         if crypt:
@@ -742,8 +1289,16 @@ def handleAckDir(message):
 def pushFiles():
     global allContent, allDelta, allCkSum, allRefresh
     logger.debug("Pushing files")
+    # Take the current lists.  Sending files can cause more responses to be handled, which will
+    # start new lists, and call pushFiles again.
+    (content, refresh, delta, cksum) = (allContent, allRefresh, allDelta, allCkSum)
+    allContent = []
+    allDelta   = []
+    allCkSum   = []
+    allRefresh = []
+
     # If checksum content in NOT specified, send the data for each file
-    for i in [tuple(x) for x in allContent]:
+    for i in [tuple(x) for x in content]:
         try:
             if logger.isEnabledFor(logging.FILES):
                 logFileInfo(i, 'N')
@@ -754,7 +1309,7 @@ def pushFiles():
         delInode(i)
 
 
-    for i in [tuple(x) for x in allRefresh]:
+    for i in [tuple(x) for x in refresh]:
         if logger.isEnabledFor(logging.FILES):
             logFileInfo(i, 'N')
         try:
@@ -764,12 +1319,23 @@ def pushFiles():
 
         delInode(i)
 
-    # If there are any delta files requested, ask for them
-    signatures = None
-    if not args.full and len(allDelta) != 0:
-        signatures = prefetchSigFiles(allDelta)
+    # Large files which are stored as chunks are always sent that way, rather than as deltas
+    if args.chunkdedup:
+        chunked = [tuple(x) for x in delta if tuple(x) in inodeDB and isChunked(inodeDB[tuple(x)][0])]
+        if chunked:
+            skip = set(chunked)
+            delta = [x for x in delta if tuple(x) not in skip]
+        for i in chunked:
+            if logger.isEnabledFor(logging.FILES):
+                logFileInfo(i, 'N')
+            try:
+                sendContent(i, 'New')
+            except Exception as e:
+                logger.error("Unable to backup %s: %s", str(i), str(e))
+            delInode(i)
 
-    for i in [tuple(x) for x in allDelta]:
+    # If there are any delta files requested, ask for them
+    for (i, sig, d) in prefetchDeltas([tuple(x) for x in delta]):
         # If doing a full backup, send the full file, else just a delta.
         try:
             if args.full:
@@ -781,21 +1347,17 @@ def pushFiles():
                     if i in inodeDB:
                         (x, name) = inodeDB[i]
                         logger.log(logging.FILES, "[D]: %s", Util.shortPath(name))
-                processDelta(i, signatures)
+                processDelta(i, sig, d)
         except Exception as e:
             logger.error("Unable to backup %s: ", str(i), str(e))
         delInode(i)
 
     # If checksum content is specified, concatenate the checksums and content requests, and handle checksums
     # for all of them.
-    if len(allCkSum) > 0:
-        processChecksums([tuple(x) for x in allCkSum])
+    if len(cksum) > 0:
+        processChecksums([tuple(x) for x in cksum])
 
-    # Clear out the files
-    allContent = []
-    allDelta   = []
-    allCkSum   = []
-    allRefresh = []
+    flushPacked()
 
     #if message['last']:
     #    sendDirHash(message['inode'])
@@ -804,23 +1366,29 @@ def addMeta(meta):
     """
     Add data to the metadata cache
     """
-    if meta in metaCache:
-        return metaCache[meta]
-    else:
-        m = crypt.getHash()
-        m.update(bytes(meta, 'utf8'))
-        digest = m.hexdigest()
-        metaCache[meta] = digest
-        newmeta.append(digest)
-        return digest
-
-def mkFileInfo(dir, name):
+    # Can be called from the scanner threads, so lock it.
+    with metaLock:
+        if meta in metaCache:
+            return metaCache[meta]
+        else:
+            m = crypt.getHash()
+            m.update(bytes(meta, 'utf8'))
+            digest = m.hexdigest()
+            metaCache[meta] = digest
+            newmeta.append(digest)
+            return digest
+
+def mkFileInfo(dir, name, s=None, register=True):
+    """ Create the file info block for a file.  If the stat info is already available (from a DirEntry,
+        for instance), pass it in as s.  If register is false, the caller is responsible for entering the
+        file into the inodeDB """
     pathname = os.path.join(dir, name)
 
     # Cleanup any bogus characters
     name = name.encode('utf8', 'backslashreplace').decode('utf8')
 
-    s = os.lstat(pathname)
+    if s is None:
+        s = os.lstat(pathname)
     mode = s.st_mode
     # If we don't want to even create dir entries for things we can't access, just return None 
     # if we can't access the file itself
@@ -829,21 +1397,21 @@ def mkFileInfo(dir, name):
 
     if stat.S_ISREG(mode) or stat.S_ISDIR(mode) or stat.S_ISLNK(mode):
         name = crypt.encryptFilename(name)
-        finfo =  {
-            'name':   name,
-            'inode':  s.st_ino,
-            'dir':    stat.S_ISDIR(mode),
-            'link':   stat.S_ISLNK(mode),
-            'nlinks': s.st_nlink,
-            'size':   s.st_size,
-            'mtime':  int(s.st_mtime),              # We strip these down to the integer value beacuse FP conversions on the back side can get confused.
-            'ctime':  int(s.st_ctime),
-            'atime':  int(s.st_atime),
-            'mode':   s.st_mode,
-            'uid':    s.st_uid,
-            'gid':    s.st_gid,
-            'dev':    s.st_dev
-            }
+        finfo = InodeDB.FileInfo(
+            name   = name,
+            inode  = s.st_ino,
+            dir    = stat.S_ISDIR(mode),
+            link   = stat.S_ISLNK(mode),
+            nlinks = s.st_nlink,
+            size   = s.st_size,
+            mtime  = int(s.st_mtime),               # We strip these down to the integer value beacuse FP conversions on the back side can get confused.
+            ctime  = int(s.st_ctime),
+            atime  = int(s.st_atime),
+            mode   = s.st_mode,
+            uid    = s.st_uid,
+            gid    = s.st_gid,
+            dev    = s.st_dev
+            )
 
         if support_xattr and args.xattr:
             try:
@@ -870,7 +1438,8 @@ def mkFileInfo(dir, name):
             except:
                 logger.warning("Could not read ACL's from %s.   Ignoring", pathname.encode('utf8', 'backslashreplace').decode('utf8'))
 
-        inodeDB[(s.st_ino, s.st_dev)] = (finfo, pathname)
+        if register:
+            inodeDB[(s.st_ino, s.st_dev)] = (finfo, pathname)
     else:
         if verbosity:
             logger.info("Skipping special file: %s", pathname)
@@ -929,6 +1498,85 @@ def getDirContents(dir, dirstat, excludes=[]):
 
     return (files, subdirs, excludes)
 
+def scanDirContents(dir, dirstat, excludes=[]):
+    """ Read a directory via scandir, reusing the stat information from the DirEntry's.
+        Equivalent to getDirContents, but safe to run in the scanner threads.   Doesn't touch
+        the inodeDB or the stats, those are handled by registerScan in the main thread.
+        Returns a list of (fileinfo, pathname) tuples, a list of (subdir, stat) tuples, and the new
+        list of excluded patterns """
+    device = dirstat.st_dev
+
+    # Process an exclude file which will be passed on down to the receivers
+    newExcludes = loadExcludeFile(os.path.join(dir, excludeFile))
+    newExcludes.extend(excludes)
+    excludes = newExcludes
+
+    # Add a list of local files to exclude.  These won't get passed to lower directories
+    localExcludes = list(excludes)
+    localExcludes.extend(loadExcludeFile(os.path.join(dir, args.localexcludefile)))
+
+    entries = []
+    subdirs = []
+
+    try:
+        with os.scandir(dir) as it:
+            for entry in it:
+                pathname = entry.path
+                if any(p.match(pathname) for p in localExcludes):
+                    continue
+                try:
+                    s = entry.stat(follow_symlinks=False)
+                    fInfo = mkFileInfo(dir, entry.name, s, register=False)
+                    if fInfo and (args.crossdev or device == fInfo['dev']):
+                        if stat.S_ISDIR(s.st_mode):
+                            if pathname in excludeDirs:
+                                logger.debug("%s excluded.  Skipping", pathname)
+                                continue
+                            else:
+                                subdirs.append((pathname, s))
+                        entries.append((fInfo, pathname))
+                except (IOError, OSError) as e:
+                    logger.error("Error processing %s: %s", pathname, str(e))
+                except Exception as e:
+                    logger.error("Error processing %s: %s", pathname, str(e))
+                    exceptionLogger.log(e)
+    except (IOError, OSError) as e:
+        logger.error("Error reading directory %s: %s" ,dir, str(e))
+
+    return (entries, subdirs, excludes)
+
+def scanDir(dir, dirstat, excludes):
+    """ Scanner thread entry point.  Returns None if the directory should be skipped """
+    if skipDir(dir):
+        return None
+    return scanDirContents(dir, dirstat, excludes)
+
+def registerScan(entries):
+    """ Enter the results of a scanDirContents into the inodeDB and the stats.  Returns the list of file infos """
+    Util.accumulateStat(stats, 'dirs')
+    files = []
+    for (fInfo, pathname) in entries:
+        mode = fInfo["mode"]
+        if stat.S_ISLNK(mode):
+            Util.accumulateStat(stats, 'links')
+        elif stat.S_ISREG(mode):
+            Util.accumulateStat(stats, 'files')
+            Util.accumulateStat(stats, 'backed', fInfo['size'])
+        inodeDB[(fInfo['inode'], fInfo['dev'])] = (fInfo, pathname)
+        files.append(fInfo)
+    return files
+
+def prefetchScans(subdirs, excludes):
+    """ Submit the scans of a list of sibling directories to the scanner pool, and yield them back in order.
+        Keeps at most args.scanthreads scans outstanding beyond the one being returned """
+    pending = collections.deque()
+    for (subdir, substat) in subdirs:
+        pending.append((subdir, substat, scanPool.submit(scanDir, subdir, substat, excludes)))
+        if len(pending) > args.scanthreads:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
 def handleAckClone(message):
     checkMessage(message, 'ACKCLN')
     if verbosity > 2:
@@ -943,7 +1591,7 @@ def handleAckClone(message):
     for i in done:
         inode = tuple(i)
         if inode in cloneContents:
-            (path, files) = cloneContents[inode]
+            (_, files) = cloneContents[inode]
             for f in files:
                 key = (f['inode'], f['dev'])
                 delInode(key)
@@ -958,6 +1606,7 @@ def handleAckClone(message):
         finfo = tuple(i)
         if finfo in cloneContents:
             (path, files) = cloneContents[finfo]
+            path = inodeDB.paths.path(path)
             if logdirs:
                 logger.log(logging.DIRS, "[R]: %s", Util.shortPath(path))
             sendDirChunks(path, finfo, files)
@@ -978,9 +1627,7 @@ def makeCloneMessage():
 def sendClones():
     message = makeCloneMessage()
     setMessageID(message)
-    response = sendAndReceive(message)
-    checkMessage(response, 'ACKCLN')
-    handleAckClone(response)
+    sendPipelined(message)
 
 def flushClones():
     if cloneDirs:
@@ -990,40 +1637,43 @@ def flushClones():
         else:
             sendClones()
 
+def checkBatchResponse(message, response):
+    """ Check that a batch got a response for each message in it """
+    checkMessage(response, 'ACKBTCH')
+    batchSize = message['batchsize']
+    respSize = len(response['responses'])
+    logger.debug("Got response.  %d responses", respSize)
+    if respSize != batchSize:
+        logger.error("Response size does not equal batch size: ID: %d B: %d R: %d", message['msgid'], batchSize, respSize)
+        if logger.isEnabledFor(logging.DEBUG):
+            msgs = set([x['msgid'] for x in message['batch']])
+            resps = set([x['respid'] for x in response['responses']])
+            diffs1 = msgs.difference(resps)
+            logger.debug("Missing Messages: %s", str(list(diffs1)))
+
 def sendBatchMsgs():
     global batchMsgs, _batchStartTime
-    batchSize = len(batchMsgs)
+    # Take the messages out of the batch before sending, as handling the responses can start the next batch.
+    msgs = batchMsgs
+    batchMsgs = []
+    _batchStartTime = None
+
+    batchSize = len(msgs)
     if batchSize == 1:
         # If there's only one, don't batch it up, just send it.
-        response = sendAndReceive(batchMsgs[0])
+        sendPipelined(msgs[0])
     else:
-        logger.debug("Sending %d batch messages", len(batchMsgs))
+        logger.debug("Sending %d batch messages", batchSize)
         message = {
             'message'  : 'BATCH',
             'batchsize': batchSize,
-            'batch'    : batchMsgs
+            'batch'    : msgs
         }
-        msgId = setMessageID(message)
-        logger.debug("BATCH Starting. %s commands", len(batchMsgs))
-
-        response = sendAndReceive(message)
-        checkMessage(response, 'ACKBTCH')
-        respSize = len(response['responses'])
-        logger.debug("Got response.  %d responses", respSize)
-        if respSize != batchSize:
-            logger.error("Response size does not equal batch size: ID: %d B: %d R: %d", msgId, batchSize, respSize)
-            if logger.isEnabledFor(logging.DEBUG):
-                msgs = set([x['msgid'] for x in batchMsgs])
-                resps = set([x['respid'] for x in response['responses']])
-                diffs1 = msgs.difference(resps)
-                logger.debug("Missing Messages: %s", str(list(diffs1)))
+        setMessageID(message)
+        logger.debug("BATCH Starting. %s commands", batchSize)
+        sendPipelined(message)
         logger.debug("BATCH Ending.")
 
-    batchMsgs = []
-    _batchStartTime = None
-    # Process the response messages
-    handleResponse(response)
-
 def flushBatchMsgs():
     if len(batchMsgs):
         sendBatchMsgs()
@@ -1056,8 +1706,11 @@ def sendDirChunks(path, inode, files):
         if verbosity > 3:
             logger.debug("---- Generating chunk %d ----", chunkNum)
         chunkNum += 1
-        chunk = files[x : x + args.dirslice]
-        message["files"] = chunk
+        chunk = [f.toDict() for f in files[x : x + args.dirslice]]
+        if columnarDirs:
+            message["columns"] = DirColumns.encode(chunk)
+        else:
+            message["files"] = chunk
         message["last"]  = (x + args.dirslice > len(files))
         if verbosity > 3:
             logger.debug("---- Sending chunk ----")
@@ -1091,8 +1744,30 @@ def setProgress(mode, name):
 
 processedDirs = set()
 
-def recurseTree(dir, top, depth=0, excludes=[]):
-    """ Process a directory, send any contents along, and then dive down into subdirectories and repeat. """
+def skipDir(dir):
+    """ Check if a directory contains a skip file, or a valid CACHEDIR.TAG file """
+    if os.path.lexists(os.path.join(dir, args.skipfile)):
+        logger.debug("Skip file found.  Skipping %s", dir)
+        return True
+
+    if args.skipcaches and os.path.lexists(os.path.join(dir, 'CACHEDIR.TAG')):
+        logger.debug("CACHEDIR.TAG file found.  Analyzing")
+        try:
+            with open(os.path.join(dir, 'CACHEDIR.TAG'), 'r') as f:
+                line = f.readline()
+                if line.startswith('Signature: 8a477f597d28d172789f06886806bc55'):
+                    logger.debug("Valid CACHEDIR.TAG file found.  Skipping %s", dir)
+                    return True
+        except:
+            logger.warning("Could not read %s.  Backing up directory %s", os.path.join(dir, 'CACHEDIR.TAG'), dir)
+    return False
+
+def recurseTree(dir, top, depth=0, excludes=[], dirstat=None, scan=None, split=None):
+    """ Process a directory, send any contents along, and then dive down into subdirectories and repeat.
+        If the scanner pool is running, dirstat and scan hold the stat info for the directory, and a future
+        for its scanDir results, as prefetched by the parent directory.
+        If split is specified, the subdirectories aren't processed, but passed to it to be processed later,
+        possibly over another connection. """
     global dirHashes
 
     newdepth = 0
@@ -1102,7 +1777,7 @@ def recurseTree(dir, top, depth=0, excludes=[]):
     setProgress("Dir:", dir)
 
     try:
-        s = os.lstat(dir)
+        s = dirstat if dirstat else os.lstat(dir)
         if not stat.S_ISDIR(s.st_mode):
             return
 
@@ -1113,24 +1788,30 @@ def recurseTree(dir, top, depth=0, excludes=[]):
             logger.debug("%s excluded.  Skipping", dir)
             return
 
-        if os.path.lexists(os.path.join(dir, args.skipfile)):
-            logger.debug("Skip file found.  Skipping %s", dir)
+        if treeUnchanged(dir, s):
             return
 
-        if args.skipcaches and os.path.lexists(os.path.join(dir, 'CACHEDIR.TAG')):
-            logger.debug("CACHEDIR.TAG file found.  Analyzing")
-            try:
-                with file(os.path.join(dir, 'CACHEDIR.TAG'), 'r') as f:
-                    line = f.readline()
-                    if line.startswith('Signature: 8a477f597d28d172789f06886806bc55'):
-                        logger.debug("Valid CACHEDIR.TAG file found.  Skipping %s", dir)
-                        return
-            except:
-                logger.warning("Could not read %s.  Backing up directory %s", os.path.join(dir, 'CACHEDIR.TAG'), dir)
-
-        (files, subdirs, subexcludes) = getDirContents(dir, s, excludes)
-
-        h = Util.hashDir(crypt, files)
+        if scanPool:
+            # Scans of subdirectories arrive prefetched.  The top level ones are run here.
+            scanned = scan.result() if scan else scanDir(dir, s, excludes)
+            if scanned is None:
+                return
+            (entries, subdirs, subexcludes) = scanned
+            files = registerScan(entries)
+            entries = None
+        else:
+            if skipDir(dir):
+                return
+            (files, subdirs, subexcludes) = getDirContents(dir, s, excludes)
+
+        h = None
+        if scanState:
+            # If the directory hasn't changed since the last backup, reuse the hash from then.
+            h = scanState.getDirHash(s.st_ino, s.st_dev, s.st_mtime_ns, s.st_ctime_ns, len(files))
+        if h is None:
+            h = Util.hashDir(crypt, files)
+            if scanState:
+                scanState.setDirHash(s.st_ino, s.st_dev, s.st_mtime_ns, s.st_ctime_ns, h)
         #logger.debug("Dir: %s (%d, %d): Hash: %s Size: %d.", Util.shortPath(dir), s.st_ino, s.st_dev, h[0], h[1])
         dirHashes[(s.st_ino, s.st_dev)] = h
 
@@ -1180,8 +1861,22 @@ def recurseTree(dir, top, depth=0, excludes=[]):
             # Purge out the lists.  Allow garbage collection to take place.  These can get largish.
             files = oldFiles = newFiles = None
             # Process the sub directories
-            for subdir in sorted(subdirs):
-                recurseTree(subdir, top, newdepth, subexcludes)
+            if split:
+                for subdir in sorted(subdirs):
+                    split((subdir, top, newdepth, subexcludes))
+            elif scanPool:
+                # Scan the next few siblings in the pool while this one is being processed.
+                # Don't bother scanning unchanged trees
+                subdirs = [(subdir, substat) for (subdir, substat) in subdirs if not treeUnchanged(subdir, substat)]
+                for (subdir, substat, future) in prefetchScans(sorted(subdirs), subexcludes):
+                    recurseTree(subdir, top, newdepth, subexcludes, dirstat=substat, scan=future)
+            else:
+                for subdir in sorted(subdirs):
+                    recurseTree(subdir, top, newdepth, subexcludes)
+
+        # Everything below here has been sent, so the tree's digest can be recorded.  If split, the subdirectories haven't been.
+        if treeMode and not split:
+            recordTreeDigest(s.st_ino, s.st_dev)
     except ExitRecursionException:
         raise
     except OSError as e:
@@ -1198,6 +1893,88 @@ def recurseTree(dir, top, depth=0, excludes=[]):
         raise ExitRecursionException(e)
 
 
+def digestTree(dir, depth, excludes, dirstat=None):
+    """ Scan a directory tree, and calculate the digests of it, and each tree below it, into treeDigests.
+        Returns the digest, an empty string if the directory isn't backed up, or None if any of the tree couldn't be read,
+        in which case the directory gets no digest, and is always backed up normally. """
+    try:
+        s = dirstat if dirstat else os.lstat(dir)
+        if not stat.S_ISDIR(s.st_mode) or dir in excludeDirs:
+            return ''
+        scanned = scanDir(dir, s, excludes)
+        if scanned is None:
+            return ''
+        (entries, subdirs, subexcludes) = scanned
+        entries = [f for (f, _) in entries]
+
+        subtrees = {}
+        complete = True
+        if depth != 1:
+            for (subdir, substat) in sorted(subdirs):
+                digest = digestTree(subdir, max(depth - 1, 0), subexcludes, substat)
+                if digest is None:
+                    complete = False
+                subtrees[(substat.st_ino, substat.st_dev)] = digest
+
+        digest = Util.hashTree(crypt, entries, subtrees) if complete else None
+        treeDigests[(s.st_ino, s.st_dev)] = (digest, list(subtrees.keys()))
+        return digest
+    except (IOError, OSError) as e:
+        logger.error("Error reading directory %s: %s", dir, str(e))
+        return None
+
+def checkTrees(dirs):
+    """ Compare the digests of the trees below the top level directories with the server's, and descend, a level at a time,
+        into those that have changed, until all the unchanged trees are found.  The server clones those whole. """
+    pending = []
+    for dir in dirs:
+        try:
+            s = os.lstat(dir)
+        except OSError:
+            continue
+        if (s.st_ino, s.st_dev) in treeDigests:
+            pending.append((s.st_ino, s.st_dev))
+
+    while pending:
+        changed = [key for key in pending if treeDigests[key][0] is None]
+        query = [[inode, device, treeDigests[(inode, device)][0]] for (inode, device) in pending if treeDigests[(inode, device)][0] is not None]
+        for x in range(0, len(query), args.dirslice):
+            message = {
+                'message': 'TREE',
+                'dirs': query[x : x + args.dirslice]
+            }
+            setMessageID(message)
+            response = sendAndReceive(message)
+            checkMessage(response, 'ACKTREE')
+            unchangedTrees.update(tuple(i) for i in response['done'])
+            changed.extend(tuple(i) for i in response['changed'])
+        pending = [sub for key in changed for sub in treeDigests[key][1]]
+    logger.debug("%d unchanged trees, of %d", len(unchangedTrees), len(treeDigests))
+
+def treeUnchanged(dir, s):
+    """ Check if the server found the tree below a directory unchanged, and cloned it """
+    if (s.st_ino, s.st_dev) in unchangedTrees:
+        if logger.isEnabledFor(logging.DIRS):
+            logger.log(logging.DIRS, "[T]: %s", Util.shortPath(dir))
+        return True
+    return False
+
+def recordTreeDigest(inode, device):
+    (digest, _) = treeDigests.get((inode, device), (None, None))
+    if digest:
+        pendingTreeDigests.append([inode, device, digest])
+        if len(pendingTreeDigests) >= args.dirslice:
+            flushTreeDigests()
+
+def flushTreeDigests():
+    global pendingTreeDigests
+    if pendingTreeDigests:
+        batchMessage({
+            'message': 'TRDG',
+            'digests': pendingTreeDigests
+        })
+        pendingTreeDigests = []
+
 def cloneDir(inode, device, files, path, info=None):
     """ Send a clone message, containing the hash of the filenames, and the number of files """
     if info:
@@ -1207,7 +1984,7 @@ def cloneDir(inode, device, files, path, info=None):
 
     message = {'inode':  inode, 'dev': device, 'numfiles': s, 'cksum': h}
     cloneDirs.append(message)
-    cloneContents[(inode, device)] = (path, files)
+    cloneContents[(inode, device)] = (inodeDB.paths.add(path), files)
     if len(cloneDirs) >= args.clones:
         flushClones()
 
@@ -1312,9 +2089,15 @@ def receiveMessage():
     return response
 
 waittime = 0
+pendingMsgs = collections.deque()                   # Messages sent, but whose responses haven't been received yet, in order
+receivedResponses = collections.deque()             # Responses received, with the messages they answer, but not yet handled
+handlingResponses = False                           # Set while handleResponses is running, so it's never reentered
 
 def sendAndReceive(message):
     global waittime
+    # Everything sent earlier must be answered before this response can be read.  Handling those answers can send more.
+    while pendingMsgs:
+        receiveResponses()
     s = time.time()
     sendMessage(message)
     response = receiveMessage()
@@ -1322,6 +2105,63 @@ def sendAndReceive(message):
     waittime += e - s
     return response
 
+def receiveResponse():
+    """ Receive the response to the oldest outstanding message.  It's queued, to be handled by handleResponses """
+    global waittime
+    message = pendingMsgs.popleft()
+    s = time.time()
+    response = receiveMessage()
+    e = time.time()
+    waittime += e - s
+    if response.get('respid') != message['msgid']:
+        raise ProtocolError("Expected response to message {}, received {} ({})".format(message['msgid'], response.get('respid'), response.get('message')))
+    receivedResponses.append((message, response))
+
+def handleResponses():
+    """
+    Handle the responses received, then send the files they asked for.  Sending can mean receiving more responses.
+    Those are queued, and handled here once the current ones are finished, rather than in the middle of them, so
+    handlers never run inside each other.
+    """
+    global handlingResponses
+    if handlingResponses:
+        return
+    handlingResponses = True
+    try:
+        while receivedResponses:
+            while receivedResponses:
+                (message, response) = receivedResponses.popleft()
+                if message['message'] == 'BATCH':
+                    checkBatchResponse(message, response)
+                handleResponse(response, doPush=False)
+            try:
+                pushFiles()
+            except Exception as e:
+                logger.error("Error sending files: %s", e)
+                exceptionLogger.log(e)
+    finally:
+        handlingResponses = False
+
+def receiveResponses(window=0):
+    """ Receive responses until no more than window messages are outstanding, and handle them """
+    while len(pendingMsgs) > window:
+        receiveResponse()
+    handleResponses()
+
+def responsesWaiting():
+    """ Check if a response can be received without blocking """
+    return conn.sender.hasData()
+
+def sendPipelined(message):
+    """ Send a message which gets a response.  If a window is set, don't wait for the response, just keep
+        no more than window messages outstanding.  Otherwise, wait for the response and handle it. """
+    # Pick up any responses that have already arrived, so the server isn't blocked sending them while this is sent
+    while pendingMsgs and responsesWaiting():
+        receiveResponse()
+    sendMessage(message)
+    pendingMsgs.append(message)
+    receiveResponses(args.window)
+
 def sendKeys(password, client, includeKeys=True):
     logger.debug("Sending keys")
     (f, c) = crypt.getKeys()
@@ -1370,6 +2210,8 @@ def handleResponse(response, doPush=True, pause=0):
         elif msgtype == 'ACKDHSH':
             # TODO: Respond
             pass
+        elif msgtype == 'ACKTRDG':
+            pass
         elif msgtype == 'ACKCLICONFIG':
             # Ignore
             pass
@@ -1420,7 +2262,8 @@ def batchMessage(message, batch=True, flush=False, response=True):
     if not batch:
         if response:
             respmessage = sendAndReceive(message)
-            handleResponse(respmessage)
+            receivedResponses.append((message, respmessage))
+            handleResponses()
         else:
             sendMessage(message)
 
@@ -1428,10 +2271,9 @@ def sendDirEntry(parent, device, files):
     # send a fake root directory
     message = {
         'message': 'DIR',
-        'files': files,
         'path' : None,
         'inode': [parent, device],
-        'files': files,
+        'files': [f.toDict() for f in files if f],
         'last' : True
         }
 
@@ -1569,8 +2411,180 @@ def doSrpAuthentication(response):
         raise AuthenticationFailed("response incomplete")
     
 
-def startBackup(name, priority, client, autoname, force, full=False, create=False, password=None, version=Tardis.__versionstring__):
-    global sessionid, clientId, lastTimestamp, backupName, newBackup, filenameKey, contentKey, crypt
+def startPools():
+    """ Start the directory scanners, checksum and delta threads, if requested """
+    global scanPool, checksumPool, deltaPool, rangePool
+    if args.scanthreads > 0:
+        scanPool = concurrent.futures.ThreadPoolExecutor(max_workers=args.scanthreads)
+    if args.checksumthreads > 0:
+        checksumPool = concurrent.futures.ThreadPoolExecutor(max_workers=args.checksumthreads)
+    if args.deltathreads > 0:
+        deltaPool = concurrent.futures.ThreadPoolExecutor(max_workers=args.deltathreads)
+    if args.rangethreads > 0:
+        rangePool = concurrent.futures.ThreadPoolExecutor(max_workers=args.rangethreads)
+
+def drainMessages():
+    """ Send any metadata, clone or batch requests still lying around, and handle all the responses """
+    if newmeta:
+        batchMessage(makeMetaMessage())
+    flushClones()
+    flushTreeDigests()
+    while flushBatchMsgs() or pendingMsgs:
+        receiveResponses()
+    flushPacked()
+
+def processWork(work, nextWork):
+    """ Process directories from the shared list of work, until it's used up """
+    while True:
+        with nextWork.get_lock():
+            i = nextWork.value
+            nextWork.value += 1
+        if i >= len(work):
+            break
+        (directory, top, depth, excludes) = work[i]
+        recurseTree(directory, top, depth=depth, excludes=excludes)
+
+def runSubSession(work, nextWork, results, server, port, name, auto, password, session):
+    """ Run in a forked process.  Open another connection, joined to the main session, and process directories from the shared list of work. """
+    global conn, scanState, forkedState, stats, report, rangeSenders
+    joined = False
+    # The range senders belong to the main process.  Ranges of files found here go over this connection.
+    rangeSenders = None
+    try:
+        # The scan state's database connection belongs to the main process.  Use a copy, and send the changes back.
+        forkedState = scanState
+        if forkedState:
+            scanState = forkedState.forked()
+        stats = dict.fromkeys(stats, 0)
+        report = {}
+
+        conn = getConnection(server, port)
+        startBackup(name, args.priority, args.client, auto, args.force, args.full, False, password, join=session)
+        joined = True
+        results.put(('joined', os.getpid(), None))
+
+        startPools()
+        processWork(work, nextWork)
+        drainMessages()
+        conn.close()
+        changes = None
+        if scanState:
+            changes = scanState.changes()
+            scanState.close()
+        results.put(('done', os.getpid(), (stats, report, changes)))
+    except Exception as e:
+        logger.error("Connection %d failed: %s", os.getpid(), str(e))
+        exceptionLogger.log(e)
+        results.put(('failed' if joined else 'joinfailed', os.getpid(), str(e)))
+    finally:
+        # Make sure the results get to the main process before exiting.
+        results.close()
+        results.join_thread()
+
+def startSubSessions(work, count, server, port, name, auto, password):
+    """ Fork off processes, each of which opens its own connection, joined to this session, to share the work """
+    ctx = multiprocessing.get_context('fork')
+    nextWork = ctx.Value('i', 0)
+    results = ctx.Queue()
+    workers = [ctx.Process(target=runSubSession, args=(work, nextWork, results, server, port, name, auto, password, str(sessionid)))
+               for _ in range(count)]
+    for w in workers:
+        w.start()
+    return (workers, nextWork, results)
+
+def runRangeSender(jobs, results, server, port, name, auto, password, session):
+    """ Run in a forked process.  Open another connection, joined to the main session, and send the ranges the main process
+        prepares, telling it whether each arrived intact.  If the connection fails, keep answering, so the main process
+        sends them itself. """
+    global conn
+    try:
+        conn = getConnection(server, port)
+        startBackup(name, args.priority, args.client, auto, args.force, args.full, False, password, join=session)
+    except Exception as e:
+        logger.error("Range connection %d failed: %s", os.getpid(), str(e))
+        exceptionLogger.log(e)
+        conn = None
+    try:
+        for (message, chunks, trailer) in iter(jobs.get, None):
+            ok = False
+            if conn:
+                try:
+                    message['ack'] = True
+                    setMessageID(message)
+                    transmitRange(message, chunks, trailer)
+                    response = receiveMessage()
+                    checkMessage(response, 'ACKRNG')
+                    ok = response['status'] == 'OK'
+                except Exception as e:
+                    logger.error("Range connection %d failed: %s", os.getpid(), str(e))
+                    exceptionLogger.log(e)
+                    conn = None
+            results.put((message['offset'], ok))
+        if conn:
+            conn.close()
+    finally:
+        # Make sure the results get to the main process before exiting.
+        results.close()
+        results.join_thread()
+
+def startRangeSenders(count, server, port, name, auto, password):
+    """ Fork off processes, each of which opens its own connection, joined to this session, to send ranges of large files over """
+    global rangeSenders
+    ctx = multiprocessing.get_context('fork')
+    jobs = ctx.Queue()
+    results = ctx.Queue()
+    senders = [ctx.Process(target=runRangeSender, args=(jobs, results, server, port, name, auto, password, str(sessionid)))
+               for _ in range(count)]
+    for s in senders:
+        s.start()
+    rangeSenders = (senders, jobs, results)
+
+def stopRangeSenders():
+    """ Tell the range senders there's nothing more to send, and wait for them to close their connections """
+    global rangeSenders
+    if rangeSenders:
+        (senders, jobs, _) = rangeSenders
+        rangeSenders = None
+        for _ in senders:
+            jobs.put(None)
+        for s in senders:
+            s.join()
+
+def waitSubSessions(workers, results, states, joining):
+    """ Collect the reports from the sub-sessions.  If joining, wait until each has joined (or failed to), otherwise until they've all finished. """
+    waitFor = ('starting',) if joining else ('starting', 'joined')
+    while True:
+        pending = [w for w in workers if states[w.pid] in waitFor]
+        if not pending:
+            break
+        try:
+            reports = [results.get(timeout=1)]
+        except queue.Empty:
+            # Make sure the ones we're waiting on are still running.  Anything sent before they exited is already in the queue.
+            dead = [w for w in pending if not w.is_alive()]
+            if not dead:
+                continue
+            reports = []
+            try:
+                while True:
+                    reports.append(results.get_nowait())
+            except queue.Empty:
+                pass
+            for w in dead:
+                states[w.pid] = 'failed' if states[w.pid] == 'joined' else 'joinfailed'
+        for (state, worker, data) in reports:
+            states[worker] = state
+            if state == 'done':
+                (subStats, subReport, changes) = data
+                for k in subStats:
+                    stats[k] = stats.get(k, 0) + subStats[k]
+                report.update(subReport)
+                if scanState and changes:
+                    scanState.apply(changes)
+    return states
+
+def startBackup(name, priority, client, autoname, force, full=False, create=False, password=None, version=Tardis.__versionstring__, join=None):
+    global sessionid, clientId, lastTimestamp, backupName, newBackup, filenameKey, contentKey, crypt, columnarDirs, treeMode, packFiles, rangedFiles
 
     # Create a BACKUP message
     message = {
@@ -1583,8 +2597,14 @@ def startBackup(name, priority, client, autoname, force, full=False, create=Fals
             'time'      : time.time(),
             'version'   : version,
             'full'      : full,
-            'create'    : create
+            'create'    : create,
+            'sighash'   : args.sighash,
+            'contenthash': args.contenthash,
+            'contenthashes': TardisCrypto.getContentHashNames()
     }
+    if join:
+        # Add to the backup set being created by another session, rather than creating a new one
+        message['join'] = join
 
     # BACKUP { json message }
     resp = sendAndReceive(message)
@@ -1611,6 +2631,13 @@ def startBackup(name, priority, client, autoname, force, full=False, create=Fals
         contentKey = resp['contentKey']
     if crypt is None:
         crypt = TardisCrypto.getCrypto(TardisCrypto.noCryptoScheme, None, client)
+    # Identify content with whatever hash the database currently uses
+    crypt.setContentHash(resp.get('contenthash', TardisCrypto.defaultContentHash))
+    # Older servers only understand directories as lists of files
+    columnarDirs = args.columnardirs and resp.get('columnar', False)
+    treeMode = args.treedigests and resp.get('treedigests', False)
+    packFiles = args.packsize > 0 and resp.get('pack', False)
+    rangedFiles = args.rangethreshold > 0 and resp.get('ranges', False)
 
     # Set up the encryption, if needed.
     ### TODO
@@ -1651,7 +2678,14 @@ def getConnection(server, port):
     #    setEncoder("bin")
     #elif args.protocol == 'msgp':
 
-    conn = Connection.MsgPackConnection(server, port, compress=args.compressmsgs, timeout=args.timeout)
+    # The dictionary is only used if the server has the same one
+    dictionary = None
+    if args.compressmsgs.startswith('zstd') and args.msgdictionary:
+        dictionary = Messages.loadDictionary(Util.fullPath(args.msgdictionary))
+
+    conn = Connection.MsgPackConnection(server, port, compress=args.compressmsgs, timeout=args.timeout, dictionary=dictionary)
+    if dictionary is not None and conn.dictionary is None:
+        logger.info("Server doesn't have the message dictionary %s.  Compressing without it", args.msgdictionary)
     setEncoder("bin")
     return conn
 
@@ -1732,6 +2766,10 @@ def processCommandLine():
 
     parser.add_argument('--compress-data',  '-Z',   dest='compress', const='zlib', default=c.get(t, 'CompressData'), nargs='?', choices=CompressedBuffer.getCompressors(),
                         help='Compress files.  ' + _def)
+    parser.add_argument('--compress-threads',       dest='compressthreads', type=int, default=c.getint(t, 'CompressThreads'),
+                        help='Number of threads to compress data with.  0 to compress in the sending thread.  zlib and zstd only. ' + _def)
+    parser.add_argument('--adaptive-compress',      dest='adaptivecompress', action=Util.StoreBoolean, default=c.getboolean(t, 'AdaptiveCompress'),
+                        help='Learn which classes of files (by extension or type, and size) compress, and skip compressing, and type checking, the ones that don\'t.  Requires --scan-state. ' + _def)
     parser.add_argument('--compress-min',           dest='mincompsize', type=int, default=c.getint(t, 'CompressMin'),   help='Minimum size to compress.  ' + _def)
     parser.add_argument('--nocompress-types',       dest='nocompressfile', default=splitList(c.get(t, 'NoCompressFile')), action='append',
                         help='File containing a list of MIME types to not compress.  ' + _def)
@@ -1750,6 +2788,34 @@ def processCommandLine():
     parser.add_argument('--priority',           dest='priority', type=int, default=None,                                help='Set the priority of this backup')
     parser.add_argument('--maxdepth', '-d',     dest='maxdepth', type=int, default=0,                                   help='Maximum depth to search')
     parser.add_argument('--crossdevice',        dest='crossdev', action=Util.StoreBoolean, default=False,               help='Cross devices. ' + _def)
+    parser.add_argument('--connections',        dest='connections', type=int, default=c.getint(t, 'Connections'),       help='Number of connections to send the backup over.  The subdirectories of the directories being backed up are split among them. ' + _def)
+    parser.add_argument('--scan-threads',       dest='scanthreads', type=int, default=c.getint(t, 'ScanThreads'),       help='Number of threads to scan directories with.  0 to scan in the main thread. ' + _def)
+    parser.add_argument('--checksum-threads',   dest='checksumthreads', type=int, default=c.getint(t, 'ChecksumThreads'), help='Number of threads to calculate checksums with.  0 to calculate them in the main thread. ' + _def)
+    parser.add_argument('--delta-threads',      dest='deltathreads', type=int, default=c.getint(t, 'DeltaThreads'),     help='Number of threads to generate deltas with.  0 to generate them in the main thread. ' + _def)
+    parser.add_argument('--delta-window',       dest='deltawindow', type=int, default=8,                            help=_d('Number of files to fetch signatures for, and generate deltas of, at a time. ' + _def))
+    parser.add_argument('--scan-state',         dest='scanstate', action=Util.StoreBoolean, default=c.getboolean(t, 'ScanState'),
+                        help='Keep a local record of directory hashes and file checksums to avoid recalculating them for unchanged files. ' + _def)
+    parser.add_argument('--scan-state-dir',     dest='scanstatedir', default=c.get(t, 'ScanStateDir'),                    help='Directory to keep the scan state in. ' + _def)
+
+    parser.add_argument('--chunk-dedup',        dest='chunkdedup', action=Util.StoreBoolean, default=c.getboolean(t, 'ChunkDedup'),
+                        help='Store large files as content defined chunks, which are deduplicated across files and backups. ' + _def)
+    parser.add_argument('--chunk-threshold',    dest='chunkthreshold', type=int, default=c.getint(t, 'ChunkThreshold'),
+                        help='Minimum size of files to store as chunks. ' + _def)
+    parser.add_argument('--range-threads',      dest='rangethreads', type=int, default=c.getint(t, 'RangeThreads'),
+                        help='Number of threads to prepare ranges of very large files with.  0 to prepare them in the main thread. ' + _def)
+    parser.add_argument('--range-threshold',    dest='rangethreshold', type=int, default=c.getint(t, 'RangeThreshold'),
+                        help='Minimum size of files and deltas to send as ranges, which can be resumed if the backup is interrupted.  0 to send them as a single stream. ' + _def)
+    parser.add_argument('--range-connections',  dest='rangeconnections', type=int, default=c.getint(t, 'RangeConnections'),
+                        help='Number of extra connections to send ranges over, in parallel.  0 to send them over the main connection. ' + _def)
+
+    parser.add_argument('--sig-hash',           dest='sighash', default=c.get(t, 'SignatureHash'), choices=sorted(librsync.SIG_MAGICS.keys()),
+                        help='Hash to use in file signatures.  blake2 requires librsync 2.0 or later. ' + _def)
+    parser.add_argument('--content-hash',       dest='contenthash', default=c.get(t, 'ContentHash'), choices=TardisCrypto.getContentHashNames(),
+                        help='Change the hash used to identify new content.  Recorded in the client database.  Content already backed up keeps its checksums.  Default: the database\'s current hash')
+    parser.add_argument('--sig-cache',          dest='sigcache', action=Util.StoreBoolean, default=c.getboolean(t, 'SigCache'),
+                        help='Keep a copy of the signature of each file sent, so it doesn\'t need to be fetched from the server for the next delta. ' + _def)
+    parser.add_argument('--sig-cache-size',     dest='sigcachesize', type=int, default=c.getint(t, 'SigCacheSize'),
+                        help='Maximum size of the signature cache, in bytes. ' + _def)
 
     parser.add_argument('--basepath',           dest='basepath', default='full', choices=['none', 'common', 'full'],    help='Select style of root path handling ' + _def)
 
@@ -1777,14 +2843,28 @@ def processCommandLine():
 
     comgrp = parser.add_argument_group('Communications options', 'Options for specifying details about the communications protocol.')
     comgrp.add_argument('--compress-msgs', '-Y',    dest='compressmsgs', nargs='?', const='snappy',
-                        choices=['none', 'zlib', 'zlib-stream', 'snappy'], default=c.get(t, 'CompressMsgs'),
+                        choices=Messages.compressors, default=c.get(t, 'CompressMsgs'),
                         help='Compress messages.  ' + _def)
+    comgrp.add_argument('--msg-dictionary',         dest='msgdictionary', default=c.get(t, 'MsgDictionary'),
+                        help='Dictionary to compress messages with, if using zstd or zstd-stream.  Must match the server\'s.  ' + _def)
+    comgrp.add_argument('--window',                 dest='window', type=int, default=c.getint(t, 'Window'),
+                        help='Maximum number of messages to keep outstanding while waiting for responses.  0 to wait for each response.  ' + _def)
+    comgrp.add_argument('--checksum-filter',        dest='checksumfilter', action=Util.StoreBoolean, default=c.getboolean(t, 'ChecksumFilter'),
+                        help='Get a filter of the checksums the server has, and send files it definitely doesn\'t have without asking first. ' + _def)
+    comgrp.add_argument('--columnar-dirs',          dest='columnardirs', action=Util.StoreBoolean, default=c.getboolean(t, 'ColumnarDirs'),
+                        help='Send directories as packed columns of names, sizes, times, etc, rather than as a list of files.  Smaller, and faster for the server to read. ' + _def)
+    comgrp.add_argument('--tree-digests',           dest='treedigests', action=Util.StoreBoolean, default=c.getboolean(t, 'TreeDigests'),
+                        help='Scan the whole tree first, and skip directory trees whose digests match the last backup\'s. ' + _def)
 
     comgrp.add_argument('--clones', '-L',           dest='clones', type=int, default=1024,              help=_d('Maximum number of clones per chunk.  0 to disable cloning.  ' + _def))
     comgrp.add_argument('--minclones',              dest='clonethreshold', type=int, default=64,        help=_d('Minimum number of files to do a partial clone.  If less, will send directory as normal: ' + _def))
     comgrp.add_argument('--batchdir', '-B',         dest='batchdirs', type=int, default=16,             help=_d('Maximum size of small dirs to send.  0 to disable batching.  ' + _def))
     comgrp.add_argument('--batchsize',              dest='batchsize', type=int, default=100,            help=_d('Maximum number of small dirs to batch together.  ' + _def))
     comgrp.add_argument('--batchduration',          dest='batchduration', type=float, default=30.0,     help=_d('Maximum time to hold a batch open.  ' + _def))
+    comgrp.add_argument('--packsize',               dest='packsize', type=int, default=4096,            help=_d('Maximum size of files to pack together into a single message.  0 to disable packing.  ' + _def))
+    comgrp.add_argument('--packcount',              dest='packcount', type=int, default=256,            help=_d('Maximum number of files to pack into a single message.  ' + _def))
+    comgrp.add_argument('--chunk-avg',              dest='chunkavg', type=int, default=1024*1024,       help=_d('Average size of content defined chunks.  Changing this changes all chunk boundaries.  ' + _def))
+    comgrp.add_argument('--range-size',             dest='rangesize', type=int, default=32*1024*1024,   help=_d('Size of the ranges very large files are sent in.  ' + _def))
     comgrp.add_argument('--chunksize',              dest='chunksize', type=int, default=256*1024,       help=_d('Chunk size for sending data.  ' + _def))
     comgrp.add_argument('--dirslice',               dest='dirslice', type=int, default=128*1024,        help=_d('Maximum number of directory entries per message.  ' + _def))
     comgrp.add_argument('--logmessages',            dest='logmessages', type=argparse.FileType('w'),    help=_d('Log messages to file'))
@@ -1937,6 +3017,11 @@ def setupLogging(logfiles, verbosity, logExceptions):
     # Create a special logger just for messages
     return logger
 
+def peakMemory(who=resource.RUSAGE_SELF):
+    """ Peak resident set size, in bytes.  MacOS reports it in bytes, everything else in KB """
+    rss = resource.getrusage(who).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
 def printStats(starttime, endtime):
     connstats = conn.getStats()
 
@@ -1954,6 +3039,25 @@ def printStats(starttime, endtime):
         logger.log(logging.STATS, "Files Not Sent:   Disappeared: {:,}  Permission Denied: {:,}".format(stats['gone'], stats['denied']))
 
 
+    if args.checksumfilter:
+        logger.log(logging.STATS, "Checksum Filter:  Sent without checking: {:,}".format(stats['filterMisses']))
+
+    if args.chunkdedup:
+        logger.log(logging.STATS, "Chunks:           Sent: {:,}  Deduplicated: {:,}".format(stats['chunksSent'], stats['chunksDedup']))
+
+    if rangedFiles:
+        logger.log(logging.STATS, "Ranges:           Sent: {:,}  Resumed: {:,}".format(stats['rangesSent'], stats['rangesResumed']))
+
+    if sigCache:
+        logger.log(logging.STATS, "Signature Cache:  Signatures not fetched: {:,}".format(stats['sigsCached']))
+
+    if scanState:
+        logger.log(logging.STATS, "Scan State:       Dirs Reused: {:,}  Checksums Reused: {:,}".format(scanState.dirHits, scanState.checksumHits))
+
+    logger.log(logging.STATS, "Memory:           Peak RSS: {:}  Pending Files (peak): {:,}  Directories: {:,}".format(Util.fmtSize(peakMemory()), inodeDB.peak, len(inodeDB.paths)))
+    if args.connections > 1:
+        logger.log(logging.STATS, "Session Memory:   Peak RSS: {:}".format(Util.fmtSize(peakMemory(resource.RUSAGE_CHILDREN))))
+
     logger.log(logging.STATS, "Wait Times:   {:}".format(str(datetime.timedelta(0, waittime))))
     logger.log(logging.STATS, "Sending Time: {:}".format(str(datetime.timedelta(0, Util._transmissionTime))))
 
@@ -2018,7 +3122,7 @@ def lockRun(server, port, client):
     return pidfile
 
 def main():
-    global starttime, args, config, conn, verbosity, crypt, noCompTypes, srpUsr, statusBar
+    global starttime, args, config, conn, verbosity, crypt, noCompTypes, srpUsr, statusBar, scanState, sigCache
     # Read the command line arguments.
     commandLine = ' '.join(sys.argv) + '\n'
     (args, config) = processCommandLine()
@@ -2130,6 +3234,12 @@ def main():
 
     # If we're using a local connection, create the domain socket, and start the server running.
     if args.local:
+        if args.connections > 1:
+            logger.warning("--connections is not supported with --local.  Using a single connection")
+            args.connections = 1
+        if args.rangeconnections > 0:
+            logger.warning("--range-connections is not supported with --local.  Sending ranges over the main connection")
+            args.rangeconnections = 0
         tempsocket = os.path.join(tempfile.gettempdir(), "tardis_local_" + str(os.getpid()))
         port = tempsocket
         server = None
@@ -2149,9 +3259,12 @@ def main():
     if verbosity or args.stats or args.report:
         logger.log(logging.STATS, "Name: {} Server: {}:{} Session: {}".format(backupName, server, port, sessionid))
 
+    # Start the range senders, if there'll be ranges to send.  Before any threads are running, as they're forked.
+    if rangedFiles and args.rangeconnections > 0:
+        startRangeSenders(args.rangeconnections, server, port, name, auto, password)
 
-    # Initialize the progress bar, if requested
-    if args.progress:
+    # Initialize the progress bar, if requested.  With multiple connections, not until the other processes have been forked.
+    if args.progress and args.connections <= 1:
         statusBar = initProgressBar()
 
     # Send a command line
@@ -2185,8 +3298,46 @@ def main():
         }
         batchMessage(message)
 
+    # Open the saved state of the last backup, if requested
+    if args.scanstate:
+        try:
+            stateFile = os.path.join(Util.fullPath(args.scanstatedir), str(clientId) + ".state")
+            logger.debug("Using scan state file %s", stateFile)
+            scanState = ScanState.ScanState(stateFile, crypt.getHash().hexdigest())
+        except Exception as e:
+            logger.warning("Unable to open scan state %s: %s.  Continuing without it", args.scanstatedir, str(e))
+            exceptionLogger.log(e)
+    elif args.adaptivecompress:
+        logger.warning("--adaptive-compress requires --scan-state.  Ignoring")
+
+    # And the signature cache.  Kept in the same directory
+    if args.sigcache:
+        try:
+            sigDir = os.path.join(Util.fullPath(args.scanstatedir), str(clientId) + ".sigs")
+            logger.debug("Using signature cache %s", sigDir)
+            sigCache = SigCache.SigCache(sigDir, args.sigcachesize)
+        except Exception as e:
+            logger.warning("Unable to open signature cache %s: %s.  Continuing without it", args.scanstatedir, str(e))
+            exceptionLogger.log(e)
+
     # Now, do the actual work here.
+    completed = False
+    workers = []
+    work = []
     try:
+        if args.connections > 1:
+            # Only the top level directories are processed here.  Their subdirectories are split up among all the connections.
+            split = work.append
+        else:
+            split = None
+            startPools()
+
+        if treeMode:
+            # Scan everything first, and find the trees which haven't changed, so they can be skipped
+            for directory in directories:
+                digestTree(directory, args.maxdepth, globalExcludes)
+            checkTrees(directories)
+
         # Now, process all the actual directories
         for directory in directories:
             # skip if already processed.
@@ -2201,14 +3352,28 @@ def main():
                 f = mkFileInfo(root, name)
                 sendDirEntry(0, 0, [f])
             # And run the directory
-            recurseTree(directory, root, depth=args.maxdepth, excludes=globalExcludes)
+            recurseTree(directory, root, depth=args.maxdepth, excludes=globalExcludes, split=split)
+
+        if split:
+            # Finish off everything outstanding before forking, so the other processes start with nothing pending.
+            drainMessages()
+            logger.debug("Splitting %d directories among %d connections", len(work), args.connections)
+            (workers, nextWork, results) = startSubSessions(work, args.connections - 1, server, port, name, auto, password)
+            states = { w.pid: 'starting' for w in workers }
+            if args.progress:
+                statusBar = initProgressBar()
+            startPools()
+            processWork(work, nextWork)
 
         # If any metadata, clone or batch requests still lying around, send them now
-        if newmeta:
-            batchMessage(makeMetaMessage())
-        flushClones()
-        while flushBatchMsgs():
-            pass
+        drainMessages()
+
+        if workers:
+            # Don't end this session until the others have joined it, so the server knows to wait for them before completing the backup set.
+            waitSubSessions(workers, results, states, joining=True)
+
+        # The range senders joined this session, so close their connections before this one
+        stopRangeSenders()
 
         # Send a purge command, if requested.
         if args.purge:
@@ -2217,6 +3382,19 @@ def main():
             else:
                 sendPurge(True)
         conn.close()
+        completed = True
+
+        if workers:
+            waitSubSessions(workers, results, states, joining=False)
+            for w in workers:
+                w.join()
+            failed = len([x for x in states.values() if x == 'failed'])
+            if failed:
+                logger.error("%d of %d connections failed.  Backup is incomplete", failed, args.connections)
+                completed = False
+            notJoined = len([x for x in states.values() if x == 'joinfailed'])
+            if notJoined:
+                logger.warning("%d of %d connections could not join the backup.  Their share of the work was done over the others", notJoined, args.connections)
     except KeyboardInterrupt as e:
         logger.warning("Backup Interupted")
         #exceptionLogger.log(e)
@@ -2228,7 +3406,28 @@ def main():
         logger.error("Caught exception: %s, %s", e.__class__.__name__, e)
         exceptionLogger.log(e)
 
-    if args.progress:
+    if scanPool:
+        scanPool.shutdown(wait=False)
+    if checksumPool:
+        checksumPool.shutdown(wait=False)
+    if deltaPool:
+        deltaPool.shutdown(wait=False)
+    if rangePool:
+        rangePool.shutdown(wait=False)
+    stopRangeSenders()
+
+    # Only keep the scan state if the backup completed
+    if scanState:
+        scanState.close(completed)
+
+    if sigCache:
+        try:
+            sigCache.prune()
+        except Exception as e:
+            logger.warning("Unable to prune signature cache: %s", str(e))
+            exceptionLogger.log(e)
+
+    if statusBar:
         statusBar.shutdown()
 
     if args.local:
@@ -2243,7 +3442,7 @@ def main():
             logger.warning("Some cloned directories not processed: %d", len(cloneContents))
             for key in cloneContents:
                 (path, files) = cloneContents[key]
-                print("{}:: {}".format(path, len(files)))
+                print("{}:: {}".format(inodeDB.paths.path(path), len(files)))
 
         # This next one is usually non-zero, for some reason.  Enable to debug.
         if len(inodeDB) != 0:
@@ -28,10 +28,15 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import os
 import sys
 import zlib
 import bz2
 import lzma
+import struct
+import collections
+import threading
+import concurrent.futures
 import zstandard as zstd
 
 import Tardis.librsync as librsync
@@ -68,8 +73,11 @@ def _updateAlg(alg):
         alg = 'zlib'
     return alg
 
-def getCompressor(alg='zlib'):
+def getCompressor(alg='zlib', threads=0):
     alg = _updateAlg(alg)
+    if alg == 'zstd' and threads:
+        # zstd can compress a single frame with multiple threads
+        return zstd.ZstdCompressor(level=5, threads=threads).compressobj()
     return _compressors[alg][0](**(_compressors[alg][2]))
 
 def getDecompressor(alg='zlib'):
@@ -81,13 +89,24 @@ def getCompressors():
     return list(_compressors.keys())
 
 class BufferedReader(object):
+    """
+    Read a stream in chunks, hashing (and optionally generating a signature for) the data as it goes.
+    signature can be True, for a signature with the default parameters, or a dict of parameters for librsync.SignatureJob.
+    Subclasses transform the chunks by overriding _get.  Chunks are handed out without copying where possible:
+    read() returns a whole chunk as is when it can, and slices the current chunk through a memoryview otherwise,
+    and readinto() copies straight from the chunk into the caller's buffer.
+    """
     def __init__(self, stream, chunksize=_defaultChunksize, hasher=None, signature=False):
         self.stream = stream
         self.chunksize = chunksize
         self.numbytes = 0
-        self.buffer = ""
+        self.buffer = b''
+        self.offset = 0
         self.hasher = hasher
-        self.sig = librsync.SignatureJob() if signature else None
+        if isinstance(signature, dict):
+            self.sig = librsync.SignatureJob(**signature)
+        else:
+            self.sig = librsync.SignatureJob() if signature else None
 
     def _get(self):
         #print "_get called"
@@ -102,31 +121,50 @@ class BufferedReader(object):
             self.sig.step(buf)
         return buf
 
+    def _fill(self):
+        """ Make sure there's data in the buffer.  Returns the number of bytes available, 0 at EOF """
+        if self.offset >= len(self.buffer):
+            self.buffer = self._get() or b''
+            self.offset = 0
+        return len(self.buffer) - self.offset
+
     def read(self, size=0x7fffffff):
-        #avail = 0
-        #if self.buffer:
-        #    avail = len(self.buffer)
-        #print "read called: {}  {} bytes available".format(size, avail)
-        out = b''
+        pieces = []
         left = size
-        while len(out) < size:
-            #print "read loop: so far: {}".format(len(out))
-            if (not self.buffer) or (len(self.buffer) == 0):
-                #print "Calling _get"
-                self.buffer = self._get()
-                #print "Back from _get"
-                if not self.buffer:
-                    #print "_get return None, leaving read: {}".format(len(out))
-                    return out
-                #print "_get returned {} bytes".format(len(self.buffer))
-            amount = min(left, len(self.buffer))
-            #print "Adding {} bytes to output".format(amount)
-            out = out + self.buffer[:amount]
-            self.buffer = self.buffer[amount:]
-            left -= amount
-
-        #print "leaving read: {}".format(len(out))
-        return out
+        while left > 0:
+            avail = self._fill()
+            if not avail:
+                break
+            if self.offset == 0 and avail <= left:
+                # Take the whole chunk, no copy needed
+                piece = self.buffer
+            else:
+                amount = min(left, avail)
+                piece = memoryview(self.buffer)[self.offset:self.offset + amount]
+            self.offset += len(piece)
+            left -= len(piece)
+            pieces.append(piece)
+
+        if len(pieces) == 1 and isinstance(pieces[0], bytes):
+            return pieces[0]
+        return b''.join(pieces)
+
+    def readinto(self, b):
+        """ Read into a preallocated buffer.  Returns the number of bytes read, 0 at EOF """
+        out = memoryview(b).cast('B')
+        done = 0
+        while done < len(out):
+            avail = self._fill()
+            if not avail:
+                break
+            amount = min(len(out) - done, avail)
+            out[done:done + amount] = memoryview(self.buffer)[self.offset:self.offset + amount]
+            self.offset += amount
+            done += amount
+        return done
+
+    def readable(self):
+        return True
 
     def checksum(self):
         return self.hasher.hexdigest() if self.hasher else None
@@ -155,10 +193,11 @@ class CompressedBufferedReader(BufferedReader):
 
     def _get(self):
         #print "_get called"
-        ret = b''
-        uncomp = b''
+        # Collect the output, and the input the first time through, as lists of pieces, and join them once
+        out = []
+        uncomp = []
         if self.stream:
-            while not ret:
+            while not out:
                 buf = self.stream.read(self.chunksize)
                 self.uncompressed += len(buf)
                 if self.hasher:
@@ -166,31 +205,34 @@ class CompressedBufferedReader(BufferedReader):
                 if self.sig:
                     self.sig.step(buf)
                 if self.first and buf:
-                    uncomp = uncomp + buf
+                    uncomp.append(buf)
                 if self.compressor:
                     if not buf:
                         #print "_get: Done"
                         #ret = self.compressor.flush(zlib.Z_FINISH)
-                        ret = ret + self.compressor.flush()
+                        data = self.compressor.flush()
                         self.stream = None
                     else:
                         #print "_get: {} bytes read".format(len(buf))
-                        ret = ret + self.compressor.compress(buf)
+                        data = self.compressor.compress(buf)
+                    if data:
+                        out.append(data)
+                    elif not self.stream:
+                        break
                 else:
-                    ret = buf
+                    out.append(buf)
                     break       # Make sure we don't got around the loop at the EOF
                 # end while
+            ret = out[0] if len(out) == 1 else b''.join(out)
             # First time around, create a compressor and check the compression ratio
             if self.first:
                 self.first = False
-                # Flush the buf and colculate the size
-                #ret += self.compressor.flush(zlib.Z_SYNC_FLUSH)
                 # Now, check what we've got back.
-                if ret:
+                if ret and self.uncompressed:
                     ratio = float(len(ret)) / float(self.uncompressed)
                     #print "Initial ratio: {} {} {}".format(ratio, len(ret), len(buf))
                     if ratio > self.threshold:
-                        ret = uncomp
+                        ret = b''.join(uncomp)
                         self.compressor = None
             self.compressed += len(ret)
             return ret
@@ -212,6 +254,116 @@ class CompressedBufferedReader(BufferedReader):
     def isCompressed(self):
         return self.compressor != None
 
+# Compression pools, shared by all the readers using the same number of threads
+_pools = {}
+_poolLock = threading.Lock()
+
+def _getPool(threads):
+    with _poolLock:
+        pool = _pools.get(threads)
+        if pool is None:
+            pool = _pools[threads] = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        return pool
+
+def _resetPools():
+    """ A forked process doesn't get the pool threads, just the executors, which would never run anything """
+    global _poolLock
+    _pools.clear()
+    _poolLock = threading.Lock()
+
+os.register_at_fork(after_in_child=_resetPools)
+
+def _completed(data):
+    future = concurrent.futures.Future()
+    future.set_result(data)
+    return future
+
+_zlibHeader     = b'\x78\x9c'
+_zlibFinalBlock = b'\x03\x00'        # An empty, final, fixed huffman block
+_zlibWindow     = 32 * 1024
+
+def _deflate(data, dictionary):
+    """ Compress a block as raw deflate data, primed with the preceding data, and flushed to a byte boundary so the blocks can be joined """
+    if dictionary:
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+class ParallelCompressedBufferedReader(CompressedBufferedReader):
+    """
+    Compress the stream using multiple threads, producing the same stream format as CompressedBufferedReader.
+    zlib streams are built like pigz does:  each chunk is compressed independently in a thread pool, primed with the last 32K
+    of the chunk before it, and the chunks are joined into a single zlib stream.  zstd uses the zstd library's own threads.
+    Other compressors run serially.
+    """
+    def __init__(self, stream, threads, chunksize=_defaultChunksize, hasher=None, threshold=0.80, signature=False, compressor='zlib'):
+        super(ParallelCompressedBufferedReader, self).__init__(stream, chunksize=chunksize, hasher=hasher, threshold=threshold, signature=signature, compressor=compressor)
+        alg = _updateAlg(compressor)
+        self.parallel = (alg == 'zlib')
+        if alg == 'zstd':
+            self.compressor = getCompressor(alg, threads)
+        self.pool = _getPool(threads)
+        self.window = 2 * threads
+        self.pending = collections.deque()
+        self.adler = zlib.adler32(b'')
+        self.dictionary = None
+
+    def _read(self):
+        buf = self.stream.read(self.chunksize)
+        self.uncompressed += len(buf)
+        if self.hasher:
+            self.hasher.update(buf)
+        # Always send the buffer, even if it's null at eof.  Will cause the signature job to clean up.
+        if self.sig:
+            self.sig.step(buf)
+        return buf
+
+    def _submit(self):
+        buf = self._read()
+        if buf:
+            self.adler = zlib.adler32(buf, self.adler)
+            self.pending.append(self.pool.submit(_deflate, buf, self.dictionary))
+            self.dictionary = buf[-_zlibWindow:]
+        else:
+            # End the stream with an empty final block and the checksum of the uncompressed data
+            self.pending.append(_completed(_zlibFinalBlock + struct.pack("!I", self.adler & 0xffffffff)))
+            self.stream = None
+
+    def _get(self):
+        if not self.parallel:
+            return super(ParallelCompressedBufferedReader, self)._get()
+
+        if self.first:
+            # Compress the first chunk here, and check the compression ratio, as CompressedBufferedReader does
+            self.first = False
+            buf = self._read()
+            if not buf:
+                self.stream = None
+                ret = _zlibHeader + _zlibFinalBlock + struct.pack("!I", self.adler)
+                self.compressed += len(ret)
+                return ret
+            ret = _deflate(buf, None)
+            if float(len(ret)) / float(len(buf)) > self.threshold:
+                self.compressor = None
+                self.parallel = False
+                self.compressed += len(buf)
+                return buf
+            self.adler = zlib.adler32(buf, self.adler)
+            self.dictionary = buf[-_zlibWindow:]
+            ret = _zlibHeader + ret
+            self.compressed += len(ret)
+            return ret
+
+        # Keep the pool busy
+        while self.stream and len(self.pending) < self.window:
+            self._submit()
+        if not self.pending:
+            return None
+        ret = self.pending.popleft().result()
+        self.compressed += len(ret)
+        return ret
+
 class UncompressedBufferedReader(BufferedReader):
     def __init__(self, stream, chunksize=_defaultChunksize, compressor='zlib'):
         super(UncompressedBufferedReader, self).__init__(stream, chunksize=chunksize)
@@ -221,25 +373,25 @@ class UncompressedBufferedReader(BufferedReader):
 
     def _get(self):
         #print "_get called"
-        ret = None
-        while not ret:
-            if self.stream:
-                buf = self.stream.read(self.chunksize)
-                if not buf:
-                    #print "_get: Done"
-                    try:
-                        ret = self.compressor.flush()
-                    except AttributeError:
-                        ret = ''
-                    if ret:
-                        self.uncompressed = self.uncompressed + len(ret)
-                    self.stream = None
-                else:
-                    #print "_get: {} bytes read".format(len(buf))
-                    ret = self.compressor.decompress(buf)
-                    self.compressed = self.uncompressed + len(buf)
-                    self.uncompressed = self.compressed + len(ret)
-            return ret
+        # Keep going until the decompressor produces something, or the stream ends
+        while self.stream:
+            buf = self.stream.read(self.chunksize)
+            if not buf:
+                #print "_get: Done"
+                try:
+                    ret = self.compressor.flush()
+                except AttributeError:
+                    ret = b''
+                if ret:
+                    self.uncompressed += len(ret)
+                self.stream = None
+                return ret
+            #print "_get: {} bytes read".format(len(buf))
+            ret = self.compressor.decompress(buf)
+            self.compressed += len(buf)
+            self.uncompressed += len(ret)
+            if ret:
+                return ret
         return None
 
 if __name__ == "__main__":
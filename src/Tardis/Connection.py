@@ -45,8 +45,10 @@ class ConnectionException(Exception):
 
 class Connection(object):
     """ Root class for handling connections to the tardis server """
-    def __init__(self, host, port, encoding, compress, timeout=None, validate=False):
+    def __init__(self, host, port, encoding, compress, timeout=None, validate=False, dictionary=None):
+        """ If a compression dictionary is specified, it's offered to the server, and used if the server has the same one """
         self.stats = { 'messagesRecvd': 0, 'messagesSent' : 0, 'bytesRecvd': 0, 'bytesSent': 0 }
+        self.dictionary = None
 
         # Create and open the socket
         if host:
@@ -74,12 +76,16 @@ class Connection(object):
             elif message != headerString:
                 raise Exception("Unknown protocol: {}".format(message))
             resp = { 'encoding': encoding, 'compress': compress }
+            if dictionary is not None:
+                resp['dictionary'] = Messages.dictionaryId(dictionary)
             self.put(bytes(json.dumps(resp), 'utf8'))
 
             message = self.sock.recv(256).strip()
             fields = json.loads(message)
             if fields['status'] != 'OK':
                 raise ConnectionException("Unable to connect")
+            if dictionary is not None and fields.get('dictionary') == resp['dictionary']:
+                self.dictionary = dictionary
         except Exception:
             self.sock.close()
             raise
@@ -111,8 +117,8 @@ class Connection(object):
 
 class ProtocolConnection(Connection):
     sender = None
-    def __init__(self, host, port, protocol, compress, timeout):
-        Connection.__init__(self, host, port, protocol, compress)
+    def __init__(self, host, port, protocol, compress, timeout, dictionary=None):
+        Connection.__init__(self, host, port, protocol, compress, dictionary=dictionary)
 
     def send(self, message, compress=True):
         self.sender.sendMessage(message, compress)
@@ -143,16 +149,16 @@ class JsonConnection(ProtocolConnection):
         self.sender = Messages.JsonMessages(self.sock, stats=self.stats)
 
 class BsonConnection(ProtocolConnection):
-    def __init__(self, host, port, compress, timeout):
-        ProtocolConnection.__init__(self, host, port, 'BSON', compress, timeout)
+    def __init__(self, host, port, compress, timeout, dictionary=None):
+        ProtocolConnection.__init__(self, host, port, 'BSON', compress, timeout, dictionary)
         # Really, cons this up in the connection, but it needs access to the sock parameter, so.....
-        self.sender = Messages.BsonMessages(self.sock, stats=self.stats, compress=compress)
+        self.sender = Messages.BsonMessages(self.sock, stats=self.stats, compress=compress, dictionary=self.dictionary)
 
 class MsgPackConnection(ProtocolConnection):
-    def __init__(self, host, port, compress, timeout):
-        ProtocolConnection.__init__(self, host, port, 'MSGP', compress, timeout)
+    def __init__(self, host, port, compress, timeout, dictionary=None):
+        ProtocolConnection.__init__(self, host, port, 'MSGP', compress, timeout, dictionary)
         # Really, cons this up in the connection, but it needs access to the sock parameter, so.....
-        self.sender = Messages.MsgPackMessages(self.sock, stats=self.stats, compress=compress)
+        self.sender = Messages.MsgPackMessages(self.sock, stats=self.stats, compress=compress, dictionary=self.dictionary)
 
 if __name__ == "__main__":
     """
@@ -29,7 +29,6 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import os
-import types
 import sys
 import string
 import pwd
@@ -46,9 +45,13 @@ import tempfile
 import shutil
 import traceback
 import signal
+import time
 import threading
 import json
 import base64
+import concurrent.futures
+import asyncio
+import functools
 from datetime import datetime
 
 # For profiling
@@ -58,6 +61,7 @@ import pstats
 
 import daemonize
 import colorlog
+import msgpack
 
 import Tardis
 import Tardis.ConnIdLogAdapter as ConnIdLogAdapter
@@ -71,6 +75,8 @@ import Tardis.Connection as Connection
 import Tardis.CompressedBuffer as CompressedBuffer
 import Tardis.TardisCrypto as TardisCrypto
 import Tardis.librsync as librsync
+import Tardis.DirColumns as DirColumns
+import Tardis.LoopSocket as LoopSocket
 
 DONE    = 0
 CONTENT = 1
@@ -142,6 +148,12 @@ configDefaults = {
     'SkipFileName'      : skipFile,
     'DBBackups'         : '0',
     'CksContent'        : '65536',
+    'PartialUploadDays' : '7',
+    'SignatureThreads'  : '4',
+    'AsyncServer'       : str(False),
+    'AsyncWorkers'      : '16',
+    'MsgDictionary'     : Defaults.getDefault('TARDIS_MSG_DICTIONARY'),
+    'RecordMessages'    : '',
     'AutoPurge'         : str(False),
     'SaveConfig'        : str(True),
     'AllowClientOverrides'  :  str(True),
@@ -196,6 +208,9 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
     saveFull = False
     lastCompleted = None
     maxChain = 0
+    joined = None
+    sigHash = 'md4'
+    checkThreads = True
 
     def checkMessage(self, message, expected):
         """ Check that a message is of the expected type.  Throw an exception if not """
@@ -205,6 +220,7 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
 
     def setup(self):
         self.statCommands = {}
+        self.partials = {}
         self.sessionid = str(uuid.uuid1())
         log            = logging.getLogger('Tardis')
         self.idstr  = self.sessionid[0:13]   # Leading portion (ie, timestamp) of the UUID.  Sufficient for logging.
@@ -224,6 +240,11 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
         self.logger.info("Ending session %s from %s", self.sessionid, self.address)
         self.server.rmSession(self.sessionid)
 
+    def updateStats(self):
+        """ Record the session statistics in the backupset.  Sessions which joined another report theirs to it when they end instead """
+        if not self.joined:
+            self.db.setStats(self.statNewFiles, self.statUpdFiles, self.statBytesReceived)
+
     def setXattrAcl(self, inode, device, xattr, acl):
         self.logger.debug("Setting Xattr and ACL info: %d %s %s", inode, xattr, acl)
         if xattr:
@@ -259,13 +280,14 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
         else:
             return CONTENT
 
-    def checkFile(self, parent, f, dirhash):
+    def checkFile(self, parent, f, dirhash, bases=None):
         """
         Process an individual file.  Check to see if it's different from what's there already
+        If a delta is wanted, the checksum of the version it's to be based on is added to bases
         """
         xattr = None
         acl = None
-        self.logger.debug("Processing file: %s %s", str(f), str(parent))
+        self.logger.debug("Processing file: %s %s", f, parent)
         name = f["name"]
         inode = f["inode"]
         device = f["dev"]
@@ -366,6 +388,8 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
                         # Full backup, request the full version anyhow.
                         retVal = CONTENT
                     else:
+                        if bases is not None:
+                            bases[(inode, device)] = old['checksum']
                         retVal = DELTA
             else:
                 # Create a new record for this file
@@ -427,11 +451,15 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
         refresh = set()
 
         attrs = set()
+        bases = {}
         # Keep the order
         queues = [done, content, cksum, delta, refresh]
 
         parentInode = tuple(data['inode'])      # Contains both inode and device in message
-        files = data['files']
+        if 'columns' in data:
+            files = DirColumns.DirColumns(data['columns'])
+        else:
+            files = data['files']
 
         dirhash = {}
         oldDir = None
@@ -462,8 +490,8 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
 
         for f in files:
             fileId = (f['inode'], f['dev'])
-            self.logger.debug('Processing file: %s %s', f['name'], str(fileId))
-            res = self.checkFile(parentInode, f, dirhash)
+            self.logger.debug('Processing file: %s %s', f['name'], fileId)
+            res = self.checkFile(parentInode, f, dirhash, bases)
             # Shortcut for this:
             #if res == 0: done.append(inode)
             #elif res == 1: content.append(inode)
@@ -494,7 +522,8 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
             "content"   : list(content),
             "delta"     : list(delta),
             "refresh"   : list(refresh),
-            "xattrs"    : list(attrs)
+            "xattrs"    : list(attrs),
+            "bases"     : [[i, d, c] for ((i, d), c) in bases.items() if (i, d) in delta]
         }
 
         return (response, True)
@@ -515,10 +544,36 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
         return (response, False)
 
     def processManySigsRequest(self, message):
-        inodes = message['inodes']
-        for i in inodes:
-            (inode, dev) = i
-            self.sendSignature(inode, dev)
+        """ Send the signatures for a list of files, each as soon as it's available.  Cached signatures are sent straight
+            away, while those which have to be generated are built in the server's signature pool, if it's running, and
+            sent in the order they're finished.  The client matches them up by inode. """
+        jobs = {}
+        for (inode, dev) in message['inodes']:
+            chksum = self.getSigChecksum(inode, dev)
+            if chksum is None:
+                continue
+            if self.cache.exists(chksum + ".sig") or self.server.sigPool is None:
+                self.sendSignature(inode, dev, chksum)
+                continue
+            # The pool threads can't use the database, so get everything the regenerator needs here.  Chunked files
+            # need to look up their chunks as they go, so are done here as well
+            chain = self.db.getChecksumInfoChain(chksum)
+            if chain and not any(c['chunked'] for c in chain):
+                jobs[self.server.sigPool.submit(self.makeSignature, inode, chksum, chain)] = (inode, dev, chksum)
+            else:
+                self.sendSignature(inode, dev, chksum)
+
+        for job in concurrent.futures.as_completed(jobs):
+            (inode, dev, chksum) = jobs[job]
+            try:
+                sig = job.result()
+                if sig is not None:
+                    self.sendSigData(inode, dev, chksum, sig)
+            except Exception as e:
+                self.logger.error("Could not recover data for checksum: %s: %s", chksum, str(e))
+                if args.exceptions:
+                    logger.exception(e)
+
         response = {
             'message': "SIG",
             'status' : "DONE"
@@ -531,17 +586,61 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
         (inode, dev) = message["inode"]
         return self.sendSignature(inode, dev)
 
-    def sendSignature(self, inode, dev):
-        response = None
-        chksum = None
-        errmsg = None
-
+    def getSigChecksum(self, inode, dev):
+        """ Find the checksum of the current version of a file, which a signature is wanted for """
         ### TODO: Remove this function.  Clean up.
         info = self.db.getFileInfoByInode((inode, dev), current=True)
         if info:
-            chksum = self.db.getChecksumByName(info["name"], (info["parent"], info["parentdev"]))      ### Assumption: Current parent is same as old
-        else:
-            self.logger.error("No Checksum Info available for %s in (%d, %d)", info['name'], info['parent'], info['parentdev'])
+            return self.db.getChecksumByName(info["name"], (info["parent"], info["parentdev"]))      ### Assumption: Current parent is same as old
+        self.logger.error("No Checksum Info available for (%d, %d)", inode, dev)
+        return None
+
+    def makeSignature(self, inode, chksum, chain=None):
+        """ Generate the signature for a checksum, and cache it.  Safe to run in the signature pool if the chain is supplied.
+            Returns None if it can't be generated """
+        sig = None
+        sigfile = chksum + ".sig"
+        # Use the same parameters the client would have, had it generated the signature itself
+        info = chain[0] if chain else self.db.getChecksumInfo(chksum)
+        params = librsync.sigParams(info['size'] if info and info['size'] else 0, self.sigHash)
+        rpipe = self.regenerator.recoverChecksum(chksum, chain=chain)
+        #pipe = subprocess.Popen(["rdiff", "signature"], stdin=rpipe, stdout=subprocess.PIPE)
+        #pipe = subprocess.Popen(["rdiff", "signature", self.cache.path(chksum)], stdout=subprocess.PIPE)
+        #(sig, err) = pipe.communicate()
+        # Cache the signature for later use.  Just in case.
+        # TODO: Better logic on this?
+        if rpipe:
+            try:
+                s = librsync.signature(rpipe, **params)
+                sig = s.read()
+
+                outfile = self.cache.open(sigfile, "wb")
+                outfile.write(sig)
+                outfile.close()
+
+            except (librsync.LibrsyncError, Regenerator.RegenerateException) as e:
+                self.logger.error("Unable to generate signature for inode: {}, checksum: {}: {}".format(inode, chksum, e))
+        return sig
+
+    def sendSigData(self, inode, dev, chksum, sig):
+        # TODO: Break the signature out of here.
+        response = {
+            "message": "SIG",
+            "inode": (inode, dev),
+            "status": "OK",
+            "encoding": self.messenger.getEncoding(),
+            "checksum": chksum,
+            "size": len(sig) }
+        self.sendMessage(response)
+        sigio = io.BytesIO(sig)
+        Util.sendDataPlain(self.messenger, sigio, compress=None)
+
+    def sendSignature(self, inode, dev, chksum=None):
+        response = None
+        errmsg = None
+
+        if chksum is None:
+            chksum = self.getSigChecksum(inode, dev)
 
         if chksum:
             try:
@@ -551,35 +650,10 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
                     sig = sigfile.read()       # TODO: Does this always read the entire file?
                     sigfile.close()
                 else:
-                    rpipe = self.regenerator.recoverChecksum(chksum)
-                    #pipe = subprocess.Popen(["rdiff", "signature"], stdin=rpipe, stdout=subprocess.PIPE)
-                    #pipe = subprocess.Popen(["rdiff", "signature", self.cache.path(chksum)], stdout=subprocess.PIPE)
-                    #(sig, err) = pipe.communicate()
-                    # Cache the signature for later use.  Just in case.
-                    # TODO: Better logic on this?
-                    if rpipe:
-                        try:
-                            s = librsync.signature(rpipe)
-                            sig = s.read()
-
-                            outfile = self.cache.open(sigfile, "wb")
-                            outfile.write(sig)
-                            outfile.close()
-
-                        except (librsync.LibrsyncError, Regenerator.RegenerateException) as e:
-                            self.logger.error("Unable to generate signature for inode: {}, checksum: {}: {}".format(inode, chksum, e))
-                # TODO: Break the signature out of here.
-                response = {
-                    "message": "SIG",
-                    "inode": (inode, dev),
-                    "status": "OK",
-                    "encoding": self.messenger.getEncoding(),
-                    "checksum": chksum,
-                    "size": len(sig) }
-                self.sendMessage(response)
-                sigio = io.BytesIO(sig)
-                Util.sendDataPlain(self.messenger, sigio, compress=None)
-                return (None, False)
+                    sig = self.makeSignature(inode, chksum)
+                if sig is not None:
+                    self.sendSigData(inode, dev, chksum, sig)
+                    return (None, False)
             except Exception as e:
                 self.logger.error("Could not recover data for checksum: %s: %s", chksum, str(e))
                 if args.exceptions:
@@ -639,7 +713,7 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
 
         Util.recordMetaData(self.cache, checksum, size, compressed, encrypted, bytesReceived, basis=basis, logger=self.logger)
         # update the database stats
-        self.db.setStats(self.statNewFiles, self.statUpdFiles, self.statBytesReceived)
+        self.updateStats()
 
         if output:
             try:
@@ -647,22 +721,19 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
                     output.seek(0)
                     if compressed:
                         delta = CompressedBuffer.UncompressedBufferedReader(output)
-                        # HACK: Monkeypatch the buffer reader object to have a seek function to keep librsync happy.  Never gets called
-                        delta.seek = lambda x, y: 0
                     else:
                         delta = output
 
                     # Process the delta file into the new file.
                     #subprocess.call(["rdiff", "patch", self.cache.path(basis), output.name], stdout=self.cache.open(checksum, "wb"))
                     basisFile = self.regenerator.recoverChecksum(basis)
-                    # Can't use isinstance
-                    if type(basisFile) != types.FileType:
-                        # TODO: Is it possible to get here?  Is this just dead code?
+                    # The basis needs random access, the delta doesn't
+                    if not (callable(getattr(basisFile, 'seekable', None)) and basisFile.seekable()):
                         temp = basisFile
                         basisFile = tempfile.TemporaryFile(dir=self.tempdir, prefix=self.tempPrefix)
                         shutil.copyfileobj(temp, basisFile)
-                    patched = librsync.patch(basisFile, delta)
-                    shutil.copyfileobj(patched, self.cache.open(checksum, "wb"))
+                    with self.cache.open(checksum, "wb") as patched:
+                        librsync.patch(basisFile, delta, patched)
                     self.db.insertChecksumFile(checksum, encrypted, size=size, disksize=bytesReceived)
                 else:
                     if self.server.linkBasis:
@@ -719,7 +790,7 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
             # Check to see if the checksum exists
             # TODO: Is this faster than checking if the file exists?  Probably, but should test.
             info = self.db.getChecksumInfo(cksum)
-            if info and info['isfile'] and info['size'] >= 0:
+            if info and (info['isfile'] or info['chunked']) and info['size'] >= 0:
                 self.db.setChecksum(inode, dev, cksum)
                 done.append(f['inode'])
             else:
@@ -858,12 +929,44 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
                 content.append(inoDev)
         return ({"message" : "ACKCLN", "done" : done, 'content' : content }, True)
 
+    def processTreeQuery(self, message):
+        """ Check the digests of directory trees against those from the last completed backup.  Trees which match, and
+            have the contents of all their files, are cloned whole.  A full backup clones nothing, so every file can be
+            checked for deltas. """
+        done = []
+        changed = []
+        for (inode, device, digest) in message['dirs']:
+            inoDev = (inode, device)
+            if not self.full and \
+               self.db.getTreeDigest(inoDev, current=False) == digest and \
+               self.db.getTreeMissing(inoDev, current=False) == 0:
+                cloned = self.db.cloneTree(inoDev)
+                self.logger.debug("Tree %s unchanged.  Cloned %d files", inoDev, cloned)
+                done.append(inoDev)
+            else:
+                changed.append(inoDev)
+        return ({"message": "ACKTREE", "done": done, "changed": changed}, True)
+
+    def processTreeDigests(self, message):
+        """ Record the digests of directory trees which have been backed up """
+        for (inode, device, digest) in message['digests']:
+            self.db.setTreeDigest((inode, device), digest)
+        return ({"message": "ACKTRDG", "status": "OK"}, False)
+
 
     _sequenceNumber = 0
 
     def processContent(self, message):
         """ Process a content message, including all the data content chunks """
         self.logger.debug("Processing content message: %s", message)
+        self._receiveContent(message, message['inode'])
+        #return {"message" : "OK", "inode": message["inode"]}
+        #flush = True if bytesReceived > 1000000 else False
+        return (None, False)
+
+    def _receiveContent(self, message, inode=None, hasher=None):
+        """ Receive a block of content into the cache, and record it.  If an inode is specified, it gets this content.
+            If a hasher is specified, the content is hashed with it as it arrives """
         tempName = None
         checksum = None
         if "checksum" in message:
@@ -880,7 +983,7 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
 
         encrypted = message.get('encrypted', False)
 
-        (bytesReceived, status, size, checksum, compressed) = Util.receiveData(self.messenger, output)
+        (bytesReceived, status, size, checksum, compressed) = Util.receiveData(self.messenger, output, hasher=hasher, compressed=message.get('compressed'))
         self.logger.debug("Data Received: %d %s %d %s %s", bytesReceived, status, size, checksum, compressed)
 
         output.close()
@@ -909,25 +1012,287 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
             else:
                 self.db.insertChecksumFile(checksum, encrypted, size, compressed=compressed, disksize=bytesReceived)
 
-            (inode, dev) = message['inode']
-
-            self.logger.debug("Setting checksum for inode %d to %s", inode, checksum)
-            self.db.setChecksum(inode, dev, checksum)
-            self.statNewFiles += 1
+            if inode:
+                (inode, dev) = inode
+                self.logger.debug("Setting checksum for inode %d to %s", inode, checksum)
+                self.db.setChecksum(inode, dev, checksum)
+                self.statNewFiles += 1
             # Record the metadata.  Do it here after we've inserted the file because on a full backup we could overwrite
             # a version which had a basis without updating the base file.
             Util.recordMetaData(self.cache, checksum, size, compressed, encrypted, bytesReceived, logger=self.logger)
             # Update the database stats
-            self.db.setStats(self.statNewFiles, self.statUpdFiles, self.statBytesReceived)
+            self.updateStats()
         except Exception as e:
             self.logger.error("Could insert checksum %s info: %s", checksum, str(e))
             if self.server.exceptions:
                 self.logger.exception(e)
 
         self.statBytesReceived += bytesReceived
+        return checksum
+
+    def getChecksumFilter(self, errorRate):
+        """ Get a Bloom filter of all the checksums with content stored.  The filter is saved beside the database, and only
+            the checksums added since it was saved are added to it.  It's rebuilt when it's had more added than it was sized
+            for, or a different error rate is wanted.  Checksums which have since been removed stay in it until then, but
+            that only costs the client a question """
+        path = self.dbfile + ".bloom"
+        bloom = None
+        if os.path.exists(path):
+            try:
+                bloom = Util.BloomFilter.load(path)
+            except Exception as e:
+                self.logger.warning("Unable to read checksum filter %s: %s.  Rebuilding", path, str(e))
+        if bloom is None or bloom.errorRate != errorRate or bloom.count > bloom.capacity:
+            count = self.db.countContentChecksums()
+            # Leave room for the checksums added in this and the next few sessions
+            bloom = Util.BloomFilter.forCapacity(count + count // 4 + 1024, errorRate)
+        position = bloom.position
+        for (checksumId, cksum) in self.db.listContentChecksums(after=bloom.position):
+            bloom.add(cksum)
+            bloom.position = checksumId
+        if bloom.position != position:
+            try:
+                bloom.save(path)
+            except Exception as e:
+                self.logger.warning("Unable to save checksum filter %s: %s", path, str(e))
+        return bloom
 
-        #return {"message" : "OK", "inode": message["inode"]}
-        #flush = True if bytesReceived > 1000000 else False
+    def processChecksumFilter(self, message):
+        """ Send a Bloom filter of all the checksums with content stored, so the client can tell which ones definitely aren't here """
+        bloom = self.getChecksumFilter(message.get('errorrate', 0.01))
+        self.logger.debug("Sending checksum filter: %d checksums, %d bits, %d hashes", bloom.count, bloom.bits, bloom.hashes)
+        response = {
+            "message": "ACKCKF",
+            "status": "OK",
+            "bits": bloom.bits,
+            "hashes": bloom.hashes,
+            "filter": self.messenger.encode(bytes(bloom.data))
+        }
+        return (response, False)
+
+    def startPartial(self, message):
+        """ Note the version of a file about to be sent in pieces, so the pieces can be kept if the upload doesn't finish.
+            Returns the pieces of that version which arrived in earlier sessions """
+        (inode, dev) = message['inode']
+        self.partials[(inode, dev)] = (message['size'], message['mtime'])
+        return self.db.getPartialUpload(inode, dev, message['size'], message['mtime'])
+
+    def recordPartial(self, message, checksum):
+        """ Record a piece of a file which has arrived intact.  The version of the file is given in the message, or was
+            noted when the upload started on this connection """
+        key = tuple(message['inode'])
+        version = (message['size'], message['mtime']) if 'mtime' in message else self.partials.get(key)
+        if version:
+            (size, mtime) = version
+            self.db.insertPartialUpload(key[0], key[1], size, mtime, message['offset'], message['length'], checksum)
+
+    def endPartial(self, inode, dev):
+        """ The file has been recorded, or given up on.  Its pieces no longer need to be kept for it """
+        self.partials.pop((inode, dev), None)
+        self.db.deletePartialUpload(inode, dev)
+
+    def processRangeQuery(self, message):
+        """ Find which ranges of a file to be sent in ranges were received intact by an earlier session.  Commits, so the
+            session's other connections can record ranges without waiting on this one """
+        self.logger.debug("Processing range query: %s", message)
+        pieces = self.startPartial(message)
+        if pieces:
+            self.logger.debug("Resuming upload of %s: %d ranges already received", message['inode'], len(pieces))
+        response = {
+            "message": "ACKRNQ",
+            "status": "OK",
+            "ranges": [list(p) for p in pieces]
+        }
+        return (response, True)
+
+    def processChunkQuery(self, message):
+        """ Determine which of a list of chunks need to be sent """
+        self.logger.debug("Processing chunk query: %d chunks", len(message['checksums']))
+        if 'inode' in message:
+            self.startPartial(message)
+        missing = []
+        for cksum in message['checksums']:
+            info = self.db.getChecksumInfo(cksum)
+            if not (info and info['isfile'] and info['size'] >= 0):
+                missing.append(cksum)
+        response = {
+            "message": "ACKCHQ",
+            "status": "OK",
+            "missing": missing
+        }
+        return (response, False)
+
+    def processChunk(self, message):
+        """ Receive a single chunk of a chunked file.  Stored as ordinary content, but not attached to any file until the manifest arrives. """
+        self.logger.debug("Processing chunk message: %s", message)
+        checksum = self._receiveContent(message)
+        if checksum != message['chunk']:
+            self.logger.warning("Chunk checksum mismatch.  Expected %s, received %s", message['chunk'], checksum)
+        elif 'inode' in message:
+            self.recordPartial(message, checksum)
+        return (None, False)
+
+    def processRange(self, message):
+        """ Receive one range of a file being sent in ranges.  Stored as ordinary content, and checked, but not attached
+            to the file until the manifest arrives.  Ranges can arrive over any of the session's connections, so good ones
+            are recorded in the database, with the file's other pieces.  If the client asks, it's told whether the range
+            was good, once it's been committed. """
+        self.logger.debug("Processing range message: %s", message)
+        hasher = None
+        if not message.get('encrypted', False):
+            # Check the range as it arrives, rather than reading it back afterwards
+            hasher = TardisCrypto.getContentHasher(self.db.getContentHash())
+        checksum = self._receiveContent(message, hasher=hasher)
+        valid = self.checkRange(message, checksum, hasher)
+        if valid:
+            self.recordPartial(message, checksum)
+        if not message.get('ack', False):
+            return (None, False)
+        response = {
+            "message": "ACKRNG",
+            "status": "OK" if valid else "FAIL",
+            "offset": message['offset']
+        }
+        return (response, True)
+
+    def checkRange(self, message, checksum, hasher=None):
+        """ Check a range was received intact.  Encrypted ranges can only be checked against what the client says it sent.
+            Unencrypted ones are checked against the hash of what arrived, in hasher. """
+        if checksum != message['chunk']:
+            self.logger.error("Range %d checksum mismatch.  Expected %s, received %s", message['offset'], message['chunk'], checksum)
+            return False
+        info = self.db.getChecksumInfo(checksum)
+        if info is None or info['size'] != message['length']:
+            self.logger.error("Range %d of %s not recorded with the expected size %d", message['offset'], checksum, message['length'])
+            return False
+        if hasher and hasher.hexdigest() != checksum:
+            self.logger.error("Range %d contents don't match checksum %s", message['offset'], checksum)
+            return False
+        return True
+
+    def checkRanges(self, message):
+        """ Check all the ranges of a file (or delta) arrived intact, over any of the session's connections, and, in order,
+            cover the whole of it """
+        (inode, dev) = message['inode']
+        ranges = {offset: (checksum, length) for (offset, length, checksum) in self.db.getPartialPieces(inode, dev)}
+        offset = 0
+        for chunk in message['chunks']:
+            (checksum, length) = ranges.get(offset, (None, 0))
+            if checksum != chunk:
+                self.logger.error("Range %d of %s missing or invalid", offset, message['checksum'])
+                return False
+            offset += length
+        size = message.get('deltasize', message['size'])
+        if offset != size:
+            self.logger.error("Ranges of %s don't cover the file.  %d of %d bytes", message['checksum'], offset, size)
+            return False
+        return True
+
+    def saveRangedDelta(self, message):
+        """ Record a delta sent in ranges as a list of chunks, with its basis.  As in processDelta, the patched file is
+            saved instead if the server saves full files, or the basis's chain is already too long, if it's not encrypted. """
+        checksum = message['checksum']
+        basis = message['basis']
+        encrypted = message.get('encrypted', False)
+        if encrypted or not (self.server.savefull or self.db.getChainLength(basis) >= self.maxChain):
+            self.db.insertChunkedFile(checksum, message['chunks'], encrypted, size=message['size'], basis=basis, deltasize=message['deltasize'])
+            return
+
+        self.logger.debug("Saving full copy of %s, rather than a delta", checksum)
+        delta = io.BufferedReader(Regenerator.ChunkedReader(self.regenerator, message['chunks']), buffer_size=1024 * 1024)
+        basisFile = self.regenerator.recoverChecksum(basis)
+        # The basis needs random access, the delta doesn't
+        if not (callable(getattr(basisFile, 'seekable', None)) and basisFile.seekable()):
+            temp = basisFile
+            basisFile = tempfile.TemporaryFile(dir=self.tempdir, prefix=self.tempPrefix)
+            shutil.copyfileobj(temp, basisFile)
+            temp.close()
+            basisFile.seek(0)
+        with self.cache.open(checksum, "wb") as patched:
+            librsync.patch(basisFile, delta, patched)
+        delta.close()
+        basisFile.close()
+        # The ranges aren't part of anything now, so they'll be removed with the other orphans
+        self.db.insertChecksumFile(checksum, encrypted, size=message['size'], disksize=self.cache.size(checksum))
+
+    def processManifest(self, message):
+        """ Record a file as the list of chunks it's built from.  All the chunks must already have been received.
+            A manifest with a basis is a delta, sent in ranges. """
+        self.logger.debug("Processing manifest for %s: %d chunks", message['checksum'], len(message['chunks']))
+        checksum = message['checksum']
+        (inode, dev) = message['inode']
+        valid = not message.get('ranged', False) or self.checkRanges(message)
+        self.endPartial(inode, dev)
+        if not valid:
+            self.logger.error("File %s not recorded", checksum)
+            return (None, False)
+        try:
+            if self.db.getChecksumInfo(checksum) is None:
+                missing = [c for c in set(message['chunks']) if self.db.getChecksumInfo(c) is None]
+                if missing:
+                    self.logger.error("Chunked file %s is missing %d chunks.  Not recorded", checksum, len(missing))
+                    return (None, False)
+                if 'basis' in message:
+                    self.saveRangedDelta(message)
+                else:
+                    self.db.insertChunkedFile(checksum, message['chunks'], message.get('encrypted', False), size=message['size'])
+
+            self.logger.debug("Setting checksum for inode %d to %s", inode, checksum)
+            self.db.setChecksum(inode, dev, checksum)
+            if 'basis' in message:
+                self.sizes.add(message['size'])
+                self.statUpdFiles += 1
+            else:
+                self.statNewFiles += 1
+            self.updateStats()
+        except Exception as e:
+            self.logger.error("Could not insert chunked file %s: %s", checksum, str(e))
+            if self.server.exceptions:
+                self.logger.exception(e)
+        return (None, False)
+
+    def processPacked(self, message):
+        """ Process a packed content message, containing the contents of many small files.  Since the checksums are
+            known up front, the files are written directly into the cache, and are all recorded in a single transaction """
+        self.logger.debug("Processing packed content message: %d files", len(message['files']))
+        for f in message['files']:
+            checksum = f['checksum']
+            (inode, dev) = f['inode']
+            size = f['size']
+            compressed = f['compressed']
+            encrypted = f.get('encrypted', False)
+            data = self.messenger.decode(f['data'])
+            try:
+                ckInfo = self.db.getChecksumInfo(checksum)
+                if ckInfo and self.cache.exists(checksum) and not self.full:
+                    self.logger.debug("Checksum file %s already exists", checksum)
+                else:
+                    with self.cache.open(checksum, 'wb') as output:
+                        output.write(data)
+                    if ckInfo is None:
+                        self.db.insertChecksumFile(checksum, encrypted, size, compressed=compressed, disksize=len(data))
+                    else:
+                        self.logger.debug("Replacing existing checksum file for %s", checksum)
+                        self.db.updateChecksumFile(checksum, encrypted, size, compressed=compressed, disksize=len(data))
+                    Util.recordMetaData(self.cache, checksum, size, compressed, encrypted, len(data), logger=self.logger)
+
+                if 'sig' in f:
+                    sigfile = checksum + ".sig"
+                    if not self.cache.exists(sigfile):
+                        with self.cache.open(sigfile, 'wb') as output:
+                            output.write(self.messenger.decode(f['sig']))
+
+                self.logger.debug("Setting checksum for inode %d to %s", inode, checksum)
+                self.db.setChecksum(inode, dev, checksum)
+                self.statNewFiles += 1
+            except Exception as e:
+                self.logger.error("Could insert checksum %s info: %s", checksum, str(e))
+                if self.server.exceptions:
+                    self.logger.exception(e)
+            self.statBytesReceived += len(data)
+
+        # Update the database stats
+        self.updateStats()
         return (None, False)
 
     def processBatch(self, message):
@@ -1016,10 +1381,28 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
             (response, flush) = self.processDelta(message)
         elif messageType == "CON":
             (response, flush) = self.processContent(message)
+        elif messageType == "PCK":
+            (response, flush) = self.processPacked(message)
+        elif messageType == "CKF":
+            (response, flush) = self.processChecksumFilter(message)
+        elif messageType == "CHQ":
+            (response, flush) = self.processChunkQuery(message)
+        elif messageType == "CNK":
+            (response, flush) = self.processChunk(message)
+        elif messageType == "RNQ":
+            (response, flush) = self.processRangeQuery(message)
+        elif messageType == "RNG":
+            (response, flush) = self.processRange(message)
+        elif messageType == "MAN":
+            (response, flush) = self.processManifest(message)
         elif messageType == "CKS":
             (response, flush) = self.processChecksum(message)
         elif messageType == "CLN":
             (response, flush) = self.processClone(message)
+        elif messageType == "TREE":
+            (response, flush) = self.processTreeQuery(message)
+        elif messageType == "TRDG":
+            (response, flush) = self.processTreeDigests(message)
         elif messageType == "BATCH":
             (response, flush) = self.processBatch(message)
         elif messageType == "PRG":
@@ -1041,8 +1424,27 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
             response['respid'] = message['msgid']
         self.db.commit()
 
+        if self.server.recordDir and messageType in self.recordTypes:
+            self.recordMessage(message)
+            if response:
+                self.recordMessage(response)
+
         return (response, flush)
 
+    # Message types to save samples of, for training a dictionary to compress messages with
+    recordTypes = ('DIR', 'CLN')
+    _recordNumber = 0
+
+    def recordMessage(self, message):
+        """ Save a message, encoded as it would be sent, as a sample for tools/trainMsgDictionary.py """
+        name = os.path.join(self.server.recordDir, "{}-{}-{}".format(self.sessionid, self._recordNumber, message['message']))
+        self._recordNumber += 1
+        try:
+            with open(name, 'wb') as f:
+                f.write(msgpack.packb(message, use_bin_type=True))
+        except OSError as e:
+            self.logger.warning("Unable to record message sample %s: %s", name, str(e))
+
     def genPaths(self):
         self.basedir    = os.path.join(self.server.basedir, self.client)
         dbdir           = os.path.join(self.server.dbdir, self.client)
@@ -1070,6 +1472,7 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
         journal = None
 
         (dbdir, dbfile) = self.genPaths()
+        self.dbfile = dbfile
 
         if create and os.path.exists(dbfile):
             raise InitFailedException("Cannot create client %s.  Already exists" % (client))
@@ -1096,7 +1499,9 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
                                     group=self.server.group,
                                     numbackups=self.server.dbbackups,
                                     journal=journal,
-                                    allow_upgrade = self.server.allowUpgrades)
+                                    allow_upgrade = self.server.allowUpgrades,
+                                    check_threads=self.checkThreads,
+                                    timeout=self.server.dbTimeout)
 
         self.regenerator = Regenerator.Regenerator(self.cache, self.db)
         return ret
@@ -1182,6 +1587,35 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
         if not os.path.exists(self.tempdir):
             os.makedirs(self.tempdir)
 
+    def checkContentHash(self, contentHash, contentHashes):
+        """
+        Switch the hash new content is identified by, if the client asks, and make sure the client can use the hash the
+        backup set uses.  Checksums already stored keep the hash they were generated with, so nothing is rehashed.
+        contentHash is the hash the client asked to switch to, or None to keep the current one.  contentHashes lists the
+        hashes the client can use.  Clients which don't send it predate selectable hashes, and only know MD5.
+        """
+        if contentHash and contentHash != self.db.getContentHash():
+            if contentHash not in TardisCrypto.getContentHashNames():
+                raise InitFailedException("Content hash %s is not available on this server" % contentHash)
+            self.db.setContentHash(contentHash)
+        current = self.db.getContentHash()
+        if contentHashes is None:
+            if current != 'md5':
+                # It would send MD5 checksums, which don't match the rest
+                raise InitFailedException("Client uses MD5 content hashes, but this backup set uses %s.  Please upgrade the client" % current)
+        elif current not in contentHashes:
+            raise InitFailedException("Client can't use content hash %s, which this backup set uses" % current)
+
+    def joinSession(self, session):
+        """ Join another session which is running for this client, and add files to its backupset """
+        if not self.server.joinSession(session, self.client):
+            raise InitFailedException("No session {} running for client {}".format(session, self.client))
+        self.joined = session
+        self.lastCompleted = self.db.joinBackupSet(session)
+        self.tempdir = os.path.join(self.basedir, "tmp")
+        if not os.path.exists(self.tempdir):
+            os.makedirs(self.tempdir)
+
     def endSession(self):
         try:
             pass
@@ -1206,16 +1640,16 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
         name = starttime.strftime("Backup_%Y-%m-%d_%H:%M:%S")
         return (name, 0, 0, False)
 
-    def mkMessenger(self, sock, encoding, compress):
+    def mkMessenger(self, sock, encoding, compress, dictionary=None):
         """
         Create the messenger object to handle communications with the client
         """
         if encoding == "JSON":
             self.messenger = Messages.JsonMessages(sock, compress=compress)
         elif encoding == 'MSGP':
-            self.messenger = Messages.MsgPackMessages(sock, compress=compress)
+            self.messenger = Messages.MsgPackMessages(sock, compress=compress, dictionary=dictionary)
         elif encoding == "BSON":
-            self.messenger = Messages.BsonMessages(sock, compress=compress)
+            self.messenger = Messages.BsonMessages(sock, compress=compress, dictionary=dictionary)
         else:
             message = {"status": "FAIL", "error": "Unknown encoding: {}".format(encoding)}
             sock.sendall(bytes(json.dumps(message), 'utf-8'))
@@ -1288,238 +1722,303 @@ class TardisServerHandler(socketserver.BaseRequestHandler):
             raise e
 
     def handle(self):
-        started   = False
-        completed = False
-        starttime = datetime.now()
-        client = ""
+        """ Run a whole session, from the header to the client's BYE.  TardisAsyncServer runs the same steps, but waits
+            for each message on its event loop, rather than in processNext """
+        self.beginSession()
+        try:
+            self.sendHeader(self.request)
+            self.initSession()
+            while not self.processNext():
+                pass
+            self.completeSession()
+        except Exception as e:
+            self.sessionFailed(e)
+        finally:
+            self.closeSession()
+
+    def beginSession(self):
+        self.started   = False
+        self.completed = False
+        self.starttime = datetime.now()
+        self.client = ""
+        self.sock = self.request
 
         if self.server.profiler:
             self.logger.info("Starting Profiler")
             self.server.profiler.enable()
 
+    def sendHeader(self, sock):
+        """ Send the header identifying the server, and switch the connection to SSL, if it's on """
+        sock.settimeout(args.timeout)
+
+        if self.server.ssl:
+            sock.sendall(bytes(Connection.sslHeaderString, 'utf-8'))
+            sock = ssl.wrap_socket(sock, server_side=True, certfile=self.server.certfile, keyfile=self.server.keyfile)
+        else:
+            sock.sendall(bytes(Connection.headerString, 'utf-8'))
+        self.sock = sock
+
+    def initSession(self):
+        """ Agree on the encoding with the client, authenticate it, and start its backup set, or join another session's """
+        sock = self.sock
+
+        # Receive the initial messages.  Defines the communication parameters.
+        # Should be : { "encoding": "MSGP", "compress": "snappy" }
+
+        message = sock.recv(1024)
+        self.logger.debug(message)
+        message = str(message, 'utf-8').strip()
+
+        fields = json.loads(message)
+
+        # Use the message compression dictionary if the client has the same one
+        dictionary = None
+        if self.server.msgDictionary is not None and fields.get('dictionary') == Messages.dictionaryId(self.server.msgDictionary):
+            dictionary = self.server.msgDictionary
+        resp = {'status': 'OK', 'dictionary': Messages.dictionaryId(dictionary)}
+        sock.sendall(bytes(json.dumps(resp), 'utf-8'))
+
+        # Create the messenger object.  From this point on, ALL communications should
+        # go through messenger, not director to the socket
+        self.mkMessenger(sock, fields['encoding'], fields['compress'], dictionary)
+
         try:
-            sock = self.request
-            sock.settimeout(args.timeout)
+            fields = self.recvMessage()
+            messType    = fields['message']
+            if not messType == 'BACKUP':
+                raise InitFailedException("Unknown message type: {}".format(messType))
+
+            client      = fields['host']            # TODO: Change at client as well.
+            clienttime  = fields['time']
+            version     = fields['version']
+
+            autoname    = fields.get('autoname', True)
+            name        = fields.get('name', None)
+            full        = fields.get('full', False)
+            priority    = fields.get('priority', 0)
+            force       = fields.get('force', False)
+            create      = fields.get('create', False)
+            join        = fields.get('join', None)
+            sigHash     = fields.get('sighash', None)
+            contentHash = fields.get('contenthash', None)
+            contentHashes = fields.get('contenthashes', None)
+
+            self.logger.info("Creating backup for %s: %s (Autoname: %s) %s %s", client, name, str(autoname), version, clienttime)
+        except ValueError as e:
+            raise InitFailedException("Cannot parse JSON field: {}".format(message))
+        except KeyError as e:
+            raise InitFailedException(str(e))
 
-            if self.server.ssl:
-                sock.sendall(bytes(Connection.sslHeaderString, 'utf-8'))
-                sock = ssl.wrap_socket(sock, server_side=True, certfile=self.server.certfile, keyfile=self.server.keyfile)
-            else:
-                sock.sendall(bytes(Connection.headerString, 'utf-8'))
+        self.client = client
+        self.server.addSession(self.sessionid, client)
 
-            # Receive the initial messages.  Defines the communication parameters.
-            # Should be : { "encoding": "MSGP", "compress": "snappy" }
+        serverName = None
+        serverForceFull = False
+        authResp = {}
+        keys = None
 
-            message = sock.recv(1024)
-            self.logger.debug(message)
-            message = str(message, 'utf-8').strip()
+        try:
+            (_, dbfile) = self.genPaths()
+            if create and os.path.exists(dbfile):
+                raise Exception("Client %s already exists" % client)
+            elif not create and not os.path.exists(dbfile):
+                raise Exception("Unknown client: %s" % client)
+
+            # If we're creating, and we need keys, do the thing.
+            if self.server.requirePW and create and self.server.allowNew:
+                keys = self.doGetKeys()
+
+            newBackup = self.getDB(client, create)
+
+            if self.server.requirePW and not self.db.needsAuthentication():
+                raise InitFailedException("Passwords required on this server.  Please add a password (sonic setpass) and encrypt the DB if necessary")
+
+            # Store the Cryptography Info
+            if create:
+                if keys:
+                    self.logger.debug("Setting keys into new client DB")
+                    (srpSalt, srpVkey, filenameKey, contentKey, cryptoScheme) = keys
+                    ret = self.db.setKeys(srpSalt, srpVkey, filenameKey, contentKey)
+                    self.db.setConfigValue('CryptoScheme', cryptoScheme)
+                    keys = None
+                else:
+                    self.db.setConfigValue('CryptoScheme', TardisCrypto.noCryptoScheme)
 
-            fields = json.loads(message)
-            resp = {'status': 'OK'}
-            sock.sendall(bytes(json.dumps(resp), 'utf-8'))
 
-            # Create the messenger object.  From this point on, ALL communications should
-            # go through messenger, not director to the socket
-            self.mkMessenger(sock, fields['encoding'], fields['compress'])
+            self.logger.debug("Ready for authentication")
+            if self.db.needsAuthentication():
+                authResp = self.doSrpAuthentication()
 
-            try:
-                fields = self.recvMessage()
-                messType    = fields['message']
-                if not messType == 'BACKUP':
-                    raise InitFailedException("Unknown message type: {}".format(messType))
-
-                client      = fields['host']            # TODO: Change at client as well.
-                clienttime  = fields['time']
-                version     = fields['version']
-
-                autoname    = fields.get('autoname', True)
-                name        = fields.get('name', None)
-                full        = fields.get('full', False)
-                priority    = fields.get('priority', 0)
-                force       = fields.get('force', False)
-                create      = fields.get('create', False)
-
-                self.logger.info("Creating backup for %s: %s (Autoname: %s) %s %s", client, name, str(autoname), version, clienttime)
-            except ValueError as e:
-                raise InitFailedException("Cannot parse JSON field: {}".format(message))
-            except KeyError as e:
-                raise InitFailedException(str(e))
-
-            self.client = client
-            self.server.addSession(self.sessionid, client)
-
-            serverName = None
-            serverForceFull = False
-            authResp = {}
-            keys = None
+            disabled = self.db.getConfigValue('Disabled')
+            if disabled is not None and int(disabled) != 0:
+                raise InitFailedException("Client %s is currently disabled." % client)
 
-            try:
-                (_, dbfile) = self.genPaths()
-                if create and os.path.exists(dbfile):
-                    raise Exception("Client %s already exists" % client)
-                elif not create and not os.path.exists(dbfile):
-                    raise Exception("Unknown client: %s" % client)
-
-                # If we're creating, and we need keys, do the thing.
-                if self.server.requirePW and create and self.server.allowNew:
-                    keys = self.doGetKeys()
-
-                newBackup = self.getDB(client, create)
-
-                if self.server.requirePW and not self.db.needsAuthentication():
-                    raise InitFailedException("Passwords required on this server.  Please add a password (sonic setpass) and encrypt the DB if necessary")
-
-                # Store the Cryptography Info
-                if create:
-                    if keys:
-                        self.logger.debug("Setting keys into new client DB")
-                        (srpSalt, srpVkey, filenameKey, contentKey, cryptoScheme) = keys
-                        ret = self.db.setKeys(srpSalt, srpVkey, filenameKey, contentKey)
-                        self.db.setConfigValue('CryptoScheme', cryptoScheme)
-                        keys = None
-                    else:
-                        self.db.setConfigValue('CryptoScheme', TardisCrypto.noCryptoScheme)
-                
+            self.setConfig()
 
-                self.logger.debug("Ready for authentication")
-                if self.db.needsAuthentication():
-                    authResp = self.doSrpAuthentication()
+            # Record the hash the client uses in its signatures, so any generated here match
+            if sigHash and sigHash != self.db.getConfigValue('SignatureHash'):
+                self.db.setConfigValue('SignatureHash', sigHash)
+            self.sigHash = self.db.getConfigValue('SignatureHash') or 'md4'
 
-                disabled = self.db.getConfigValue('Disabled')
-                if disabled is not None and int(disabled) != 0:
-                    raise InitFailedException("Client %s is currently disabled." % client)
+            self.checkContentHash(contentHash, contentHashes)
 
-                self.setConfig()
+            if join:
+                self.joinSession(join)
+            else:
                 self.startSession(name, force)
 
-                # Create a name
-                if autoname:
-                    (serverName, serverPriority, serverKeepDays, serverForceFull) = self.calcAutoInfo(clienttime)
-                    self.logger.debug("Setting name, priority, keepdays to %s", (serverName, serverPriority, serverKeepDays))
-                    if serverName:
-                        self.serverKeepTime = serverKeepDays * 3600 * 24
-                        self.serverPriority = serverPriority
-                    else:
-                        self.serverKeepTime = None
-                        self.serverPriority = None
+            # Create a name
+            if autoname and not join:
+                (serverName, serverPriority, serverKeepDays, serverForceFull) = self.calcAutoInfo(clienttime)
+                self.logger.debug("Setting name, priority, keepdays to %s", (serverName, serverPriority, serverKeepDays))
+                if serverName:
+                    self.serverKeepTime = serverKeepDays * 3600 * 24
+                    self.serverPriority = serverPriority
                 else:
                     self.serverKeepTime = None
                     self.serverPriority = None
+            else:
+                self.serverKeepTime = None
+                self.serverPriority = None
 
-                # Either the server or the client can specify a full backup.
-                self.full = full or serverForceFull
+            # Either the server or the client can specify a full backup.
+            self.full = full or serverForceFull
 
-                if priority is None:
-                    priority = 0
+            if priority is None:
+                priority = 0
 
-                # Create the actual backup set
+            # Create the actual backup set, unless we're adding to another session's
+            if not join:
                 self.db.newBackupSet(name, self.sessionid, priority, clienttime, version, self.address, self.full, self.server.serverSessionID)
-            except Exception as e:
-                message = {"status": "FAIL", "error": str(e)}
-                self.sendMessage(message)
-                if self.server.exceptions:
-                    self.logger.exception(e)
-                raise InitFailedException(str(e))
+        except Exception as e:
+            message = {"status": "FAIL", "error": str(e)}
+            self.sendMessage(message)
+            if self.server.exceptions:
+                self.logger.exception(e)
+            raise InitFailedException(str(e))
 
-            response = {
-                "message": "INIT",
-                "status": "OK",
-                "sessionid": self.sessionid,
-                "prevDate": str(self.db.prevBackupDate),
-                "new": newBackup,
-                "name": serverName if serverName else name,
-                "clientid": str(self.db.clientId)
-                }
-
-            if authResp:
-                response.update(authResp)
-                filenameKey = self.db.getConfigValue('FilenameKey')
-                contentKey  = self.db.getConfigValue('ContentKey')
-
-                if (filenameKey is None) ^ (contentKey is None):
-                    self.logger.warning("Name Key and Data Key are both not in the same state. FilenameKey: %s  ContentKey: %s", filenameKey, contentKey)
-
-                if filenameKey:
-                    response['filenameKey'] = filenameKey
-                if contentKey:
-                    response['contentKey'] = contentKey
+        response = {
+            "message": "INIT",
+            "status": "OK",
+            "sessionid": self.sessionid,
+            "prevDate": str(self.db.prevBackupDate),
+            "new": newBackup,
+            "name": serverName if serverName else name,
+            "clientid": str(self.db.clientId),
+            "contenthash": self.db.getContentHash(),
+            "columnar": True,
+            "treedigests": True,
+            "pack": True,
+            "ranges": True
+            }
 
+        if authResp:
+            response.update(authResp)
+            filenameKey = self.db.getConfigValue('FilenameKey')
+            contentKey  = self.db.getConfigValue('ContentKey')
+
+            if (filenameKey is None) ^ (contentKey is None):
+                self.logger.warning("Name Key and Data Key are both not in the same state. FilenameKey: %s  ContentKey: %s", filenameKey, contentKey)
+
+            if filenameKey:
+                response['filenameKey'] = filenameKey
+            if contentKey:
+                response['contentKey'] = contentKey
+
+        self.sendMessage(response)
+
+        self.started = True
+        self.autoname = autoname
+        self.backupName = name
+        self.serverName = serverName
+
+    def processNext(self):
+        """ Receive and process one message.  Returns True when the client has finished """
+        message = self.recvMessage()
+        if message["message"] == "BYE":
+            return True
+        (response, flush) = self.processMessage(message)
+        if response:
             self.sendMessage(response)
-
-            started = True
-
-            #sock.sendall("OK {} {} {}".format(str(self.sessionid), str(self.db.prevBackupDate), serverName if serverName else name))
-            done = False
-
-            while not done:
-                flush = False
-                message = self.recvMessage()
-                if message["message"] == "BYE":
-                    done = True
-                else:
-                    (response, flush) = self.processMessage(message)
-                    if response:
-                        self.sendMessage(response)
-                if flush:
-                    self.db.commit()
+        if flush:
+            self.db.commit()
+        return False
+
+    def completeSession(self):
+        if not self.joined:
+            # Don't mark the set complete until every session which joined it has finished
+            (failed, newFiles, updFiles, bytesReceived) = self.server.waitSubSessions(self.sessionid)
+            self.statNewFiles += newFiles
+            self.statUpdFiles += updFiles
+            self.statBytesReceived += bytesReceived
+            if failed:
+                raise Exception("{} joined sessions did not complete".format(failed))
 
             self.db.completeBackup()
 
-            if autoname and serverName is not None:
-                self.logger.debug("Changing backupset name from %s to %s.  Priority is %s", name, serverName, serverPriority)
-                self.db.setBackupSetName(serverName, serverPriority)
-                #self.db.renameBackupSet(newName, newPriority)
+        if self.autoname and self.serverName is not None:
+            self.logger.debug("Changing backupset name from %s to %s.  Priority is %s", self.backupName, self.serverName, self.serverPriority)
+            self.db.setBackupSetName(self.serverName, self.serverPriority)
+            #self.db.renameBackupSet(newName, newPriority)
+
 
+        self.completed = True
 
-            completed = True
-        except InitFailedException as e:
+    def sessionFailed(self, e):
+        if isinstance(e, InitFailedException):
             self.logger.error("Connection initialization failed: %s", e)
-            if self.server.exceptions:
-                self.logger.exception(e)
-        except Exception as e:
+        else:
             self.logger.error("Caught exception %s: %s", type(e), e)
-            if self.server.exceptions:
-                self.logger.exception(e)
-        finally:
-            sock.close()
-            if started:
-                self.db.setClientEndTime()
-                # Autopurge if it's set.
-                if self.autoPurge and not self.purged and completed:
-                    self.processPurge()
-                self.endSession()
-                self.db.setStats(self.statNewFiles, self.statUpdFiles, self.statBytesReceived)
-
-            if self.server.profiler:
-                self.logger.info("Stopping Profiler")
-                self.server.profiler.disable()
-                s = io.StringIO()
-                sortby = 'cumulative'
-                ps = pstats.Stats(self.server.profiler, stream=s).sort_stats(sortby)
-                ps.print_stats()
-                print(s.getvalue())
-
-            if started:
-                (count, size, _) = Util.removeOrphans(self.db, self.cache)
-                endtime = datetime.now()
-
-                self.logger.info("Connection completed successfully: %s  Runtime: %s", str(completed), str(endtime - starttime))
-                self.logger.info("New or replaced files:    %d", self.statNewFiles)
-                self.logger.info("Updated files:            %d", self.statUpdFiles)
-                self.logger.info("Total file data received: %s (%d)", Util.fmtSize(self.statBytesReceived), self.statBytesReceived)
-                self.logger.info("Command breakdown:        %s", self.statCommands)
-                self.logger.info("Purged Sets and File:     %d %d", self.statPurgedSets, self.statPurgedFiles)
-                self.logger.info("Removed Orphans           %d (%s)", count, Util.fmtSize(size))
-
-                self.logger.debug("Removing orphans")
-
-                self.db.commit()
-                self.db.compact()
-
-            if self.db:
-                self.db.close(started)
-
-        self.logger.info("Session from %s {%s} Ending: %s: %s", client, self.sessionid, str(completed), str(datetime.now() - starttime))
+        if self.server.exceptions:
+            self.logger.exception(e)
+
+    def closeSession(self):
+        self.sock.close()
+        if self.joined:
+            self.db.commit()
+            self.server.leaveSession(self.joined, self.completed, self.statNewFiles, self.statUpdFiles, self.statBytesReceived)
+        elif self.started:
+            self.db.setClientEndTime()
+            # Autopurge if it's set.
+            if self.autoPurge and not self.purged and self.completed:
+                self.processPurge()
+            self.endSession()
+            self.updateStats()
+
+        if self.server.profiler:
+            self.logger.info("Stopping Profiler")
+            self.server.profiler.disable()
+            s = io.StringIO()
+            sortby = 'cumulative'
+            ps = pstats.Stats(self.server.profiler, stream=s).sort_stats(sortby)
+            ps.print_stats()
+            print(s.getvalue())
+
+        if self.started and not self.joined:
+            # Give up on uploads which haven't been resumed in a while, so their pieces get removed with the other orphans
+            stale = self.db.deleteStalePartialUploads(time.time() - self.server.partialDays * 24 * 3600)
+            if stale:
+                self.logger.debug("Removed %d pieces of abandoned uploads", stale)
+            (count, size, _) = Util.removeOrphans(self.db, self.cache)
+            endtime = datetime.now()
+
+            self.logger.info("Connection completed successfully: %s  Runtime: %s", str(self.completed), str(endtime - self.starttime))
+            self.logger.info("New or replaced files:    %d", self.statNewFiles)
+            self.logger.info("Updated files:            %d", self.statUpdFiles)
+            self.logger.info("Total file data received: %s (%d)", Util.fmtSize(self.statBytesReceived), self.statBytesReceived)
+            self.logger.info("Command breakdown:        %s", self.statCommands)
+            self.logger.info("Purged Sets and File:     %d %d", self.statPurgedSets, self.statPurgedFiles)
+            self.logger.info("Removed Orphans           %d (%s)", count, Util.fmtSize(size))
+
+            self.logger.debug("Removing orphans")
+
+            self.db.commit()
+            self.db.compact()
+
+        if self.db:
+            self.db.close(self.started and not self.joined)
+
+        self.logger.info("Session from %s {%s} Ending: %s: %s", self.client, self.sessionid, str(self.completed), str(datetime.now() - self.starttime))
 
 class TardisServer(object):
     # HACK.  Operate on an object, but not in the class.
@@ -1534,6 +2033,13 @@ class TardisServer(object):
         self.maxChain       = config.getint(configSection, 'MaxDeltaChain')
         self.deltaPercent   = float(config.getint(configSection, 'MaxChangePercent')) / 100.0        # Convert to a ratio
         self.cksContent     = config.getint(configSection, 'CksContent')
+        self.partialDays    = config.getint(configSection, 'PartialUploadDays')
+
+        self.msgDictionary  = Messages.loadDictionary(config.get(configSection, 'MsgDictionary'))
+        self.recordDir      = config.get(configSection, 'RecordMessages')
+
+        sigThreads          = config.getint(configSection, 'SignatureThreads')
+        self.sigPool        = concurrent.futures.ThreadPoolExecutor(max_workers=sigThreads) if sigThreads > 0 else None
 
         self.dbname         = args.dbname
         self.allowNew       = args.newhosts
@@ -1575,6 +2081,9 @@ class TardisServer(object):
         self.group = None
 
         self.sessions = {}
+        self.subSessions = {}
+        self.subSessionCond = threading.Condition()
+        self.dbTimeout = 60.0
 
         # If the User or Group is set, attempt to determine the users
         # Note, these will throw exeptions if the User or Group is unknown.  Will get
@@ -1602,11 +2111,42 @@ class TardisServer(object):
         self.sessions[sessionId] = client
 
     def rmSession(self, sessionId):
-        del self.sessions[sessionId]
+        self.sessions.pop(sessionId, None)
 
     def checkSession(self, sessionId):
         return sessionId in self.sessions
 
+    def joinSession(self, sessionId, client):
+        """ Register a session which is joining a running session for the same client """
+        with self.subSessionCond:
+            if self.sessions.get(sessionId) != client:
+                return False
+            info = self.subSessions.setdefault(sessionId, {'active': 0, 'failed': 0, 'stats': (0, 0, 0)})
+            info['active'] += 1
+            return True
+
+    def leaveSession(self, sessionId, completed, newFiles, updFiles, bytesReceived):
+        """ Record that a joined session has ended, and pass its statistics along to the session it joined """
+        with self.subSessionCond:
+            info = self.subSessions[sessionId]
+            info['active'] -= 1
+            if not completed:
+                info['failed'] += 1
+            info['stats'] = tuple(map(sum, zip(info['stats'], (newFiles, updFiles, bytesReceived))))
+            self.subSessionCond.notify_all()
+
+    def waitSubSessions(self, sessionId):
+        """ Wait for all the sessions which joined a session to end.  Returns the number which failed, and their combined statistics """
+        with self.subSessionCond:
+            while self.subSessions.get(sessionId, {}).get('active'):
+                self.subSessionCond.wait()
+            info = self.subSessions.pop(sessionId, {'failed': 0, 'stats': (0, 0, 0)})
+        return (info['failed'],) + info['stats']
+
+    def subSessionsActive(self, sessionId):
+        with self.subSessionCond:
+            return bool(self.subSessions.get(sessionId, {}).get('active'))
+
 #class TardisSocketServer(SocketServer.TCPServer):
 class TardisSocketServer(socketserver.ThreadingMixIn, socketserver.TCPServer, TardisServer):
     def __init__(self):
@@ -1627,6 +2167,128 @@ class TardisDomainSocketServer(socketserver.UnixStreamServer, TardisServer):
         TardisServer.__init__(self)
         logger.info("Unix Domain Socket %s Server Running", Tardis.__versionstring__)
 
+class TardisAsyncHandler(TardisServerHandler):
+    """ A session on a TardisAsyncServer.  Unlike a socketserver handler, it isn't run when it's created, but a step at a time by the server """
+    # Steps of a session run on whichever worker is free, one at a time
+    checkThreads = False
+    # Message types followed by a data stream, which has to arrive before the message is handled
+    dataMessages = ('CON', 'DEL', 'SIG', 'CNK', 'RNG', 'METADATA')
+
+    def __init__(self, request, client_address, server):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.setup()
+
+    def sendHeader(self, sock):
+        # Already sent by the server
+        self.sock = sock
+
+class TardisAsyncServer(TardisServer):
+    """
+    Server with one asyncio event loop doing the socket I/O, and SSL, for every connection, and gathering each
+    message, with any data which follows it.  Sessions run in a bounded pool of worker threads, holding a worker only
+    while they've a whole message to process, rather than for the whole connection, so slow uploads don't tie up workers.
+    Speaks the same protocol as the threaded servers.
+    """
+    def __init__(self):
+        TardisServer.__init__(self)
+        self.workers    = concurrent.futures.ThreadPoolExecutor(max_workers=args.workers)
+        self.loop       = None
+        self.stopped    = None
+        self.single     = False
+        self.tasks      = set()
+        self.subSessionEvents = {}
+        self.sslContext = None
+        if self.ssl:
+            self.sslContext = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            self.sslContext.load_cert_chain(self.certfile, self.keyfile)
+        logger.info("Async Server %s Running, %d workers", Tardis.__versionstring__, args.workers)
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    def handle_request(self):
+        """ Run a single session, and stop """
+        self.single = True
+        asyncio.run(self.serve())
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.stopped.set)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        factory = lambda: LoopSocket.LoopSocket(self.loop, self.newConnection)
+        if args.local:
+            listener = await self.loop.create_unix_server(factory, args.local)
+        else:
+            listener = await self.loop.create_server(factory, port=args.port, reuse_address=args.reuseaddr)
+        async with listener:
+            await self.stopped.wait()
+        # Let the sessions still running finish
+        if self.tasks:
+            await asyncio.wait(self.tasks)
+        self.workers.shutdown()
+
+    def newConnection(self, sock):
+        task = self.loop.create_task(self.runSession(sock))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def runSession(self, sock):
+        """ Run the same steps as TardisServerHandler.handle, each in a worker, waiting for each message to arrive first """
+        handler = TardisAsyncHandler(sock, sock.address, self)
+        run = functools.partial(self.loop.run_in_executor, self.workers)
+        handler.beginSession()
+        try:
+            sock.settimeout(args.timeout)
+            if self.ssl:
+                sock.transport.write(bytes(Connection.sslHeaderString, 'utf-8'))
+                await sock.startTls(self.sslContext)
+            else:
+                sock.transport.write(bytes(Connection.headerString, 'utf-8'))
+
+            await run(handler.initSession)
+            messenger = handler.messenger
+            sock.startMessages('text' if isinstance(messenger, Messages.TextMessages) else 'bin',
+                               getattr(messenger, 'decompress', None), messenger.decodeMessage, handler.dataMessages, handler.tempdir)
+            while True:
+                await sock.waitForMessage()
+                if await run(handler.processNext):
+                    break
+
+            # Sessions which joined this one need workers to finish, so don't hold one waiting for them
+            await self.waitSubSessionsEnd(handler.sessionid)
+            await run(handler.completeSession)
+        except Exception as e:
+            handler.sessionFailed(e)
+        finally:
+            await run(handler.closeSession)
+            handler.finish()
+            if self.single:
+                self.stopped.set()
+
+    def leaveSession(self, sessionId, completed, newFiles, updFiles, bytesReceived):
+        TardisServer.leaveSession(self, sessionId, completed, newFiles, updFiles, bytesReceived)
+        self.loop.call_soon_threadsafe(self.subSessionLeft, sessionId)
+
+    def subSessionLeft(self, sessionId):
+        event = self.subSessionEvents.get(sessionId)
+        if event:
+            event.set()
+
+    async def waitSubSessionsEnd(self, sessionId):
+        """ Wait, on the loop, until all the sessions which joined a session have ended.  Each one ending sets the event """
+        event = asyncio.Event()
+        self.subSessionEvents[sessionId] = event
+        try:
+            while self.subSessionsActive(sessionId):
+                await event.wait()
+                event.clear()
+        finally:
+            del self.subSessionEvents[sessionId]
+
 
 
 def setupLogging():
@@ -1673,7 +2335,10 @@ def run_server():
             # Allow reuse of the address before timeout if requested.
             socketserver.TCPServer.allow_reuse_address = True
 
-        if args.local:
+        if args.asyncserver:
+            logger.info("Starting Async Server on %s", args.local if args.local else "Port: {}".format(args.port))
+            server = TardisAsyncServer()
+        elif args.local:
             logger.info("Starting Server. Socket: %s", args.local)
             server = TardisDomainSocketServer()
         elif args.threaded:
@@ -1741,6 +2406,10 @@ def processArgs():
     parser.add_argument('--local',              dest='local',           default=config.get(t, 'Local'),
                         help='Run as a Unix Domain Socket Server on the specified filename')
     parser.add_argument('--threads',            dest='threaded',        action=Util.StoreBoolean, default=True, help='Run a threaded server.  Default: %(default)s')
+    parser.add_argument('--async',              dest='asyncserver',     action=Util.StoreBoolean, default=config.getboolean(t, 'AsyncServer'),
+                        help='Handle all connections in one event loop, with a pool of workers processing messages (Default: %(default)s)')
+    parser.add_argument('--workers',            dest='workers',         default=config.getint(t, 'AsyncWorkers'), type=int,
+                        help='Number of workers processing messages, with --async (Default: %(default)s)')
 
     parser.add_argument('--timeout',            dest='timeout',         default=config.getint(t, 'Timeout'), type=float, help='Timeout, in seconds.  0 for no timeout (Default: %(default)s)')
     parser.add_argument('--journal', '-j',      dest='journal',         default=config.get(t, 'JournalFile'), help='Journal file actions to this file (Default: %(default)s)')
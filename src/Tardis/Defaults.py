@@ -64,6 +64,7 @@ _defaults = {
     'TARDIS_DEFAULTS'       : '/etc/tardis/system.defaults',
     'TARDIS_PWFILE'         : '',
     'TARDIS_KEYFILE'        : '',
+    'TARDIS_MSG_DICTIONARY' : '',
 }
 
 try:
@@ -0,0 +1,165 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2020, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Columnar encoding of the file lists in DIR messages.  Rather than a dict per file, each repeating the key names, a
+directory is sent as a list of names, a packed array for each numeric field, a byte of flags per file, and lists of
+(index, checksum) pairs for the few files with extended attributes or ACLs.
+Each array uses the narrowest integer type which holds all its values, and the type codes are sent in a string
+alongside them.  Arrays are little endian, whatever the byte order of either end.
+"""
+
+import sys
+import array
+
+# Numeric fields, in the order their type codes are sent.
+_intFields = ['inode', 'dev', 'size', 'mtime', 'ctime', 'atime', 'mode', 'uid', 'gid', 'nlinks']
+_sparseFields = ['xattr', 'acl']
+_fields = ['name', 'dir', 'link'] + _intFields
+
+_DIR  = 0x01
+_LINK = 0x02
+
+# Type codes, narrowest first.  b, h, i, and q are 1, 2, 4, and 8 bytes on all the platforms we run on.
+_unsignedCodes = [('B', 1 << 8), ('H', 1 << 16), ('I', 1 << 32), ('Q', 1 << 64)]
+_signedCodes   = [('b', 1 << 7), ('h', 1 << 15), ('i', 1 << 31), ('q', 1 << 63)]
+
+def _typecode(values):
+    if not values:
+        return 'B'
+    low = min(values)
+    high = max(values)
+    if low >= 0:
+        return next(code for (code, limit) in _unsignedCodes if high < limit)
+    return next(code for (code, limit) in _signedCodes if -limit <= low and high < limit)
+
+def _pack(typecode, values):
+    a = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a.tobytes()
+
+def _unpack(typecode, data):
+    a = array.array(typecode)
+    a.frombytes(data)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+def encode(files):
+    """ Encode a list of file infos (dicts, or anything indexable the same way) as columns """
+    columns = {
+        'name':  [f['name'] for f in files],
+        'flags': bytes((_DIR if f['dir'] else 0) | (_LINK if f['link'] else 0) for f in files)
+    }
+    typecodes = []
+    for field in _intFields:
+        values = [f[field] for f in files]
+        typecode = _typecode(values)
+        typecodes.append(typecode)
+        columns[field] = _pack(typecode, values)
+    columns['types'] = ''.join(typecodes)
+    for field in _sparseFields:
+        values = [[i, f[field]] for (i, f) in enumerate(files) if field in f]
+        if values:
+            columns[field] = values
+    return columns
+
+class DirColumns:
+    """ A decoded set of columns.  Indexing, or iterating, gives FileRow views of each file, rather than dicts """
+    def __init__(self, columns):
+        self.names = columns['name']
+        self.flags = columns['flags']
+        self.ints = {field: _unpack(typecode, columns[field]) for (field, typecode) in zip(_intFields, columns['types'])}
+        self.sparse = {field: dict(columns.get(field, [])) for field in _sparseFields}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        return FileRow(self, i)
+
+    def __iter__(self):
+        for i in range(len(self.names)):
+            yield FileRow(self, i)
+
+    def value(self, field, i):
+        column = self.ints.get(field)
+        if column is not None:
+            return column[i]
+        elif field == 'name':
+            return self.names[i]
+        elif field == 'dir':
+            return (self.flags[i] & _DIR) != 0
+        elif field == 'link':
+            return (self.flags[i] & _LINK) != 0
+        elif field in self.sparse and i in self.sparse[field]:
+            return self.sparse[field][i]
+        raise KeyError(field)
+
+    def has(self, field, i):
+        return field in self.ints or field in ('name', 'dir', 'link') or (field in self.sparse and i in self.sparse[field])
+
+class FileRow:
+    """ One file in a DirColumns.  Reads like the file's dict would.  copy() and items() build the dict, for the
+        database calls which need one. """
+    __slots__ = ('columns', 'index')
+
+    def __init__(self, columns, index):
+        self.columns = columns
+        self.index = index
+
+    def __getitem__(self, field):
+        column = self.columns.ints.get(field)
+        if column is not None:
+            return column[self.index]
+        return self.columns.value(field, self.index)
+
+    def __contains__(self, field):
+        return self.columns.has(field, self.index)
+
+    def get(self, field, default=None):
+        try:
+            return self.columns.value(field, self.index)
+        except KeyError:
+            return default
+
+    def copy(self):
+        d = {field: self.columns.value(field, self.index) for field in _fields}
+        for field in _sparseFields:
+            if self.columns.has(field, self.index):
+                d[field] = self.columns.value(field, self.index)
+        return d
+
+    def items(self):
+        return self.copy().items()
+
+    def __repr__(self):
+        return repr(self.copy())
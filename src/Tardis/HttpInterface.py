@@ -345,6 +345,11 @@ def getChecksumInfo(checksum):
     db = getDB()
     return createResponse(makeDict(db.getChecksumInfo(checksum)))
 
+@app.route('/getChunks/<checksum>')
+def getChunks(checksum):
+    db = getDB()
+    return createResponse(db.getChunks(checksum))
+
 @app.route('/getChecksumInfoChain/<checksum>')
 def getChecksumInfoChain(checksum):
     #app.logger.info("getChecksumInfo Invoked: %s", checksum)
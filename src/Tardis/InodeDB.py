@@ -0,0 +1,143 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2020, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import os
+import sys
+import array
+
+class FileInfo:
+    """
+    Information about a file, as sent to the server in DIR messages.  Kept in slots rather than a dict, as the client
+    holds one of these for every file it hasn't heard back from the server about, which on large trees is millions.
+    Supports enough of the dict interface (indexing, in, and get) to be used in place of one.
+    Optional fields (xattr and acl) are left unset if the file doesn't have them.
+    """
+    __slots__ = ('name', 'inode', 'dir', 'link', 'nlinks', 'size', 'mtime', 'ctime', 'atime', 'mode', 'uid', 'gid', 'dev',
+                 'xattr', 'acl')
+
+    def __init__(self, **fields):
+        for (key, value) in fields.items():
+            setattr(self, key, value)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def toDict(self):
+        """ Convert to a dict, for sending in a message """
+        return {key: getattr(self, key) for key in self.__slots__ if hasattr(self, key)}
+
+class PathTable:
+    """
+    Table of directory paths.  Each entry holds one path component, and the index of its parent's entry, so the
+    common prefixes of paths are stored once, rather than once per file.  Components are interned.
+    Paths are expected to be added roughly in the order the tree is walked.  Only the most recently added path is
+    remembered, so a path added again out of order gets new entries.  That costs a little space, but nothing else.
+    """
+    def __init__(self):
+        self.parents = array.array('q')
+        self.names = []
+        self._last = []
+
+    def add(self, path):
+        """ Add a directory path, and return its index """
+        parts = path.split(os.sep)
+        ids = self._last
+        common = 0
+        while common < len(parts) and common < len(ids) and self.names[ids[common]] == parts[common]:
+            common += 1
+        ids = ids[:common]
+        for name in parts[common:]:
+            self.parents.append(ids[-1] if ids else -1)
+            self.names.append(sys.intern(name))
+            ids.append(len(self.names) - 1)
+        self._last = ids
+        return ids[-1]
+
+    def path(self, index):
+        """ Get the path for an index """
+        parts = []
+        while index >= 0:
+            parts.append(self.names[index])
+            index = self.parents[index]
+        return os.sep.join(reversed(parts))
+
+    def __len__(self):
+        return len(self.names)
+
+class InodeDB:
+    """
+    The files the client has told the server about, but not yet finished with, keyed by (inode, device).
+    Entries are set and read as (fileinfo, pathname) tuples, like a dict of them, but the path is held as an index
+    into a PathTable for the directory, and the name of the file, rather than a string of its own.
+    """
+    def __init__(self):
+        self.paths = PathTable()
+        self.entries = {}
+        self.peak = 0
+
+    def __setitem__(self, key, value):
+        (info, pathname) = value
+        if pathname is None:
+            self.entries[key] = (info, -1, None)
+        else:
+            (dirname, name) = os.path.split(pathname)
+            self.entries[key] = (info, self.paths.add(dirname), name)
+        self.peak = max(self.peak, len(self.entries))
+
+    def __getitem__(self, key):
+        (info, parent, name) = self.entries[key]
+        if name is None:
+            return (info, None)
+        return (info, os.path.join(self.paths.path(parent), name))
+
+    def __delitem__(self, key):
+        del self.entries[key]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        return self.entries.keys()
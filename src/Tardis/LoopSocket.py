@@ -0,0 +1,362 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2020, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+A connection whose I/O is done by an asyncio event loop, for code written against blocking sockets.  The loop reads
+every connection, splits what arrives into messages, and writes out whatever's queued, so the threads using the
+connections never block in the kernel, and a thread is only needed once a whole message, including any data which
+follows it, has arrived.  Parts of messages too big to keep in memory are spooled to a file.
+"""
+
+import asyncio
+import collections
+import socket
+import struct
+import sys
+import tempfile
+import threading
+
+# Before 3.12, transports join the buffers passed to writelines into one.  Small ones are still worth joining, to send
+# a frame's header with its body.
+_vectoredWrites = sys.version_info >= (3, 12)
+_joinSize = 64 * 1024
+
+class _Spool:
+    """ Part of a message, kept in a file.  Written by the loop, then read by the thread handling the message, once it's all arrived """
+    def __init__(self, dir):
+        self.file = tempfile.TemporaryFile(dir=dir)
+        self.size = 0
+        self.pos = 0
+
+    def __len__(self):
+        return self.size - self.pos
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def read(self, n):
+        if self.pos == 0:
+            self.file.flush()
+            self.file.seek(0)
+        data = self.file.read(min(n, len(self)))
+        self.pos += len(data)
+        if not len(self):
+            self.file.close()
+        return data
+
+class LoopSocket(asyncio.Protocol):
+    """
+    A connection, both as a protocol for the event loop, and as a blocking socket for threads.  The socket methods
+    (recv, recv_into, sendall, sendmsg, settimeout, and close) must not be called from the loop.  connected is called,
+    on the loop, when the connection is made.
+    Until startMessages is called, what arrives is passed straight through.  After it, the loop splits it into frames,
+    as sent by Messages, uncompressing them, and finds where each message, and the data stream which follows some
+    message types, ends.  waitForMessage waits, on the loop, for a whole message.
+    Reading stops when more than highWater bytes are waiting, unless a message is being waited for.  Then the rest of
+    it is spooled.  Writes block once more than highWater bytes are queued, or the transport's buffer is full.
+    """
+    highWater = 4 * 1024 * 1024
+    lowWater  = 1 * 1024 * 1024
+
+    def __init__(self, loop, connected=None):
+        self.loop       = loop
+        self.connected  = connected
+        self.transport  = None
+        self.address    = None
+        self.cond       = threading.Condition()
+        self.closed     = False
+        self.timeout    = None
+        # Reading
+        self.incoming   = bytearray()                           # Received, but not yet split into frames.  Loop only.
+        self.segments   = collections.deque([bytearray()])      # Frames ready for the thread, in memory or spooled
+        self.buffered   = 0                                     # Bytes of frames in memory
+        self.paused     = False
+        self.framing    = None          # 'bin' for 4 byte binary lengths, 'text' for 6 digit ones
+        self.decompress = None
+        self.decode     = None
+        self.dataMessages = ()
+        self.spoolDir   = None
+        self.state      = 'message'     # What the next frame is: a message, part of its data, or the data's trailer
+        self.messages   = 0             # Whole messages waiting
+        self.waiter     = None
+        # Writing
+        self.queued     = 0             # Bytes handed to the loop, but not yet to the transport
+        self.blocked    = False         # The transport's buffer is full
+        self.inflight   = []            # Buffers which may still be in the transport's buffer
+
+    # Protocol callbacks.  Run on the loop.
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+        transport.set_write_buffer_limits(self.highWater, self.lowWater)
+        if self.connected:
+            self.connected(self)
+
+    def data_received(self, data):
+        with self.cond:
+            if self.framing:
+                self.incoming.extend(data)
+                self._split()
+            else:
+                self._append(data)
+                self.cond.notify_all()
+            self._checkReading()
+        self._checkMessage()
+
+    def eof_received(self):
+        self._close()
+
+    def connection_lost(self, exc):
+        self._close()
+
+    def pause_writing(self):
+        with self.cond:
+            self.blocked = True
+
+    def resume_writing(self):
+        with self.cond:
+            self.blocked = False
+            self.inflight.clear()
+            self.cond.notify_all()
+
+    def _close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self._checkMessage()
+
+    # Loop side
+    async def startTls(self, context):
+        """ Switch the connection to SSL.  Anything received up to now is read in the clear """
+        self.transport = await self.loop.start_tls(self.transport, self, context, server_side=True)
+
+    def startMessages(self, framing, decompress, decode, dataMessages, spoolDir=None):
+        """
+        Start splitting what arrives into messages.  framing is 'bin' or 'text', as for the messenger.  decompress
+        uncompresses compressed frames.  From now on, it's only called here, so frames reach the thread uncompressed.
+        decode turns a frame into a message.  Messages whose type is in dataMessages are followed by a data stream,
+        ended by an empty frame, then a trailer.  Anything already received, but not read by the thread, is split too.
+        """
+        with self.cond:
+            self.framing      = framing
+            self.decompress   = decompress
+            self.decode       = decode
+            self.dataMessages = dataMessages
+            self.spoolDir     = spoolDir
+            self.incoming     = self.segments.pop() + self.incoming
+            self.segments.append(bytearray())
+            self.buffered     = 0
+            self._split()
+            self._checkReading()
+
+    def _frame(self):
+        """ The first frame in incoming, uncompressed, and the size it took, or None if it hasn't all arrived """
+        if self.framing == 'bin':
+            if len(self.incoming) < 4:
+                return None
+            n = struct.unpack_from("!I", self.incoming)[0]
+            size = 4 + (n & 0x7fffffff)
+            if len(self.incoming) < size:
+                return None
+            data = memoryview(self.incoming)[4:size]
+            if n & 0x80000000:
+                data = self.decompress(data)
+            return (data, size)
+        else:
+            if len(self.incoming) < 6:
+                return None
+            size = 6 + int(self.incoming[:6])
+            if len(self.incoming) < size:
+                return None
+            return (memoryview(self.incoming)[6:size], size)
+
+    def _split(self):
+        """ Move the whole frames in incoming to the segments, keeping track of where messages end.  Stops if too much
+            is waiting for the thread, and nothing's waiting for a message, leaving the rest until there's room. """
+        while self.framing and not (self.buffered >= self.highWater and self.waiter is None):
+            frame = self._frame()
+            if frame is None:
+                break
+            (data, size) = frame
+            if self.state == 'message':
+                try:
+                    message = self.decode(data)
+                except Exception:
+                    # Leave it to the thread to find, and report, when it reads it.
+                    message = None
+                if isinstance(message, dict) and message.get('message') in self.dataMessages:
+                    self.state = 'data'
+                else:
+                    self.messages += 1
+            elif self.state == 'data':
+                if not len(data):
+                    self.state = 'trailer'
+            else:
+                self.state = 'message'
+                self.messages += 1
+            if self.framing == 'bin':
+                self._append(struct.pack("!I", len(data)), data)
+            else:
+                self._append(b"%06d" % len(data), data)
+            if isinstance(data, memoryview):
+                data.release()
+            del self.incoming[:size]
+            if self.messages and self.state == 'message' and isinstance(self.segments[-1], _Spool):
+                # The spooled message is complete.  Keep anything after it in memory again.
+                self.segments.append(bytearray())
+        self.cond.notify_all()
+
+    def _append(self, *pieces):
+        """ Add data for the thread.  Spool it if there's too much in memory, and the thread's waiting for this message to complete """
+        tail = self.segments[-1]
+        if isinstance(tail, bytearray) and self.buffered >= self.highWater and self.waiter is not None and self.state != 'message':
+            tail = _Spool(self.spoolDir)
+            self.segments.append(tail)
+        for p in pieces:
+            tail.extend(p) if isinstance(tail, bytearray) else tail.write(p)
+            if isinstance(tail, bytearray):
+                self.buffered += len(p)
+
+    def _checkReading(self):
+        """ Stop reading if too much is waiting for the thread, unless a message is being waited for.  Call with cond held. """
+        stop = self.buffered >= self.highWater and self.waiter is None
+        if stop != self.paused and self.transport and not self.transport.is_closing():
+            self.paused = stop
+            if stop:
+                self.transport.pause_reading()
+            else:
+                self.transport.resume_reading()
+
+    def _checkMessage(self):
+        if self.waiter is None or self.waiter.done():
+            return
+        with self.cond:
+            if self.messages or self.closed:
+                self.waiter.set_result(None)
+
+    async def waitForMessage(self):
+        """ Wait until a whole message, and any data following it, has arrived, or the connection is closed.  Raises
+            socket.timeout if neither happens within the timeout """
+        self.waiter = self.loop.create_future()
+        with self.cond:
+            self._split()
+            self._checkReading()
+        self._checkMessage()
+        try:
+            await asyncio.wait_for(self.waiter, self.timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout("Timed out waiting for message")
+        finally:
+            self.waiter = None
+            with self.cond:
+                if self.messages:
+                    self.messages -= 1
+                self._checkReading()
+
+    # Socket methods, for threads
+    def settimeout(self, timeout):
+        self.timeout = timeout if timeout else None
+
+    def _take(self, n):
+        """ Wait for data, and remove up to n bytes of it.  Returns an empty buffer if the connection's closed """
+        with self.cond:
+            while len(self.segments) > 1 and not len(self.segments[0]):
+                self.segments.popleft()
+            if not self.cond.wait_for(lambda: len(self.segments[0]) or len(self.segments) > 1 or self.closed, self.timeout):
+                raise socket.timeout("timed out")
+            while len(self.segments) > 1 and not len(self.segments[0]):
+                self.segments.popleft()
+            segment = self.segments[0]
+            if isinstance(segment, _Spool):
+                return segment.read(n)
+            data = segment[:n]
+            del segment[:n]
+            self.buffered -= len(data)
+            if self.paused and self.buffered < self.lowWater:
+                self.loop.call_soon_threadsafe(self._resume)
+        return data
+
+    def _resume(self):
+        with self.cond:
+            self._split()
+            self._checkReading()
+        self._checkMessage()
+
+    def recv(self, n):
+        return bytes(self._take(n))
+
+    def recv_into(self, buffer, nbytes=0):
+        view = memoryview(buffer).cast('B')
+        data = self._take(nbytes or len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def sendall(self, data):
+        self._write([data])
+
+    def sendmsg(self, buffers):
+        buffers = list(buffers)
+        return self._write(buffers)
+
+    def _write(self, buffers):
+        """ Queue buffers for the loop to write, without copying them.  If too much is queued, or the transport's
+            buffer is full, wait for the loop to catch up. """
+        size = sum(memoryview(b).nbytes for b in buffers)
+        with self.cond:
+            if not self.cond.wait_for(lambda: (self.queued < self.highWater and not self.blocked) or self.closed, self.timeout):
+                raise socket.timeout("timed out")
+            if self.closed or self.transport.is_closing():
+                raise BrokenPipeError("Connection closed")
+            self.queued += size
+        self.loop.call_soon_threadsafe(self._send, buffers, size)
+        return size
+
+    def _send(self, buffers, size):
+        """ Hand queued buffers to the transport.  Run on the loop.  The buffers are kept until the transport's written
+            everything it holds, as it may only hold views of them """
+        if _vectoredWrites:
+            self.transport.writelines(buffers)
+        elif size <= _joinSize:
+            self.transport.write(b''.join(buffers))
+        else:
+            for b in buffers:
+                self.transport.write(b)
+        with self.cond:
+            self.queued -= size
+            if self.transport.get_write_buffer_size():
+                self.inflight.append(buffers)
+            else:
+                self.inflight.clear()
+            self.cond.notify_all()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.transport.close)
@@ -29,6 +29,8 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import socket
+import select
+import ssl
 import os
 import sys
 import json
@@ -37,6 +39,7 @@ import base64
 import struct
 import zlib
 import snappy
+import zstandard as zstd
 
 try:
     import bson
@@ -45,6 +48,11 @@ except:
     _supportBson = False
     pass
 
+# Compressors available for the message channel
+compressors = ['none', 'zlib', 'zlib-stream', 'snappy', 'zstd', 'zstd-stream']
+
+# Frames larger than this are received into a buffer of their own, rather than growing the reusable one
+_maxBufferSize = 16 * 1024 * 1024
 
 class Messages(object):
     __socket = None
@@ -52,6 +60,9 @@ class Messages(object):
     def __init__(self, socket, stats=None):
         self.__socket = socket
         self.__stats = stats
+        self.__buffer = bytearray(64 * 1024)
+        # SSL sockets don't support sendmsg
+        self.__vectored = hasattr(socket, 'sendmsg') and not isinstance(socket, ssl.SSLSocket)
 
     def receiveBytes(self, n):
         msg = bytearray()
@@ -64,11 +75,55 @@ class Messages(object):
             self.__stats['bytesRecvd'] += len(msg)
         return msg
 
+    def receiveInto(self, n):
+        """ Receive n bytes into a reusable buffer, and return a memoryview of them.  The view is only valid until
+            the next receive, so anything which needs to keep the data must copy it """
+        buf = self.__buffer
+        if len(buf) < n:
+            buf = bytearray(n)
+            if n <= _maxBufferSize:
+                self.__buffer = buf
+        view = memoryview(buf)[:n]
+        got = 0
+        while got < n:
+            r = self.__socket.recv_into(view[got:], n - got)
+            if r == 0:
+                raise RuntimeError("socket connection broken")
+            got += r
+        if self.__stats != None:
+            self.__stats['bytesRecvd'] += n
+        return view
+
+    def hasData(self):
+        """ Check if a message can be received without waiting for the other end to send anything.  Data which has
+            already been read off the socket and decrypted by the SSL layer doesn't show up in a select. """
+        if isinstance(self.__socket, ssl.SSLSocket) and self.__socket.pending():
+            return True
+        (readable, _, _) = select.select([self.__socket], [], [], 0)
+        return bool(readable)
+
     def sendBytes(self, bytes):
         if self.__stats != None:
             self.__stats['bytesSent'] += len(bytes)
         self.__socket.sendall(bytes)
 
+    def sendBuffers(self, buffers):
+        """ Send several buffers, in a single sendmsg call where possible, rather than one send each """
+        buffers = [memoryview(b).cast('B') for b in buffers]
+        if self.__stats != None:
+            self.__stats['bytesSent'] += sum(len(b) for b in buffers)
+        if not self.__vectored:
+            for b in buffers:
+                self.__socket.sendall(b)
+            return
+        while buffers:
+            sent = self.__socket.sendmsg(buffers)
+            # Drop whatever was sent, and go round again for the rest
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            if sent:
+                buffers[0] = buffers[0][sent:]
+
 class zlibCompressor:
     def __init__(self):
         self.compressor = zlib.compressobj()
@@ -83,10 +138,39 @@ class zlibCompressor:
         message = self.decompressor.decompress(message)
         return message
 
+class zstdCompressor:
+    """ Compress all the messages as one zstd frame, flushing a block at the end of each, so later messages can
+        refer back to the earlier ones """
+    def __init__(self, dictionary=None):
+        self.compressor = zstd.ZstdCompressor(level=3, dict_data=dictionary).compressobj()
+        self.decompressor = zstd.ZstdDecompressor(dict_data=dictionary).decompressobj()
+
+    def compress(self, message):
+        message = self.compressor.compress(message)
+        message += self.compressor.flush(zstd.COMPRESSOBJ_FLUSH_BLOCK)
+        return message
+
+    def decompress(self, message):
+        message = self.decompressor.decompress(message)
+        return message
+
+def loadDictionary(path):
+    """ Load a zstd dictionary for compressing messages, as trained by tools/trainMsgDictionary.py.
+        Returns None if no path is specified """
+    if not path:
+        return None
+    with open(path, 'rb') as f:
+        return zstd.ZstdCompressionDict(f.read())
+
+def dictionaryId(dictionary):
+    """ Identify a dictionary, so both ends of a connection can check they have the same one.  0 for none """
+    return dictionary.dict_id() if dictionary is not None else 0
+
 class BinMessages(Messages):
     compress = None
     decompress = None
-    def __init__(self, socket, stats=None, compress='none'):
+    def __init__(self, socket, stats=None, compress='none', dictionary=None):
+        """ Dictionary is only used by the zstd compressors """
         Messages.__init__(self, socket, stats)
         if compress == 'zlib-stream':
             self.compressor = zlibCompressor()
@@ -97,7 +181,14 @@ class BinMessages(Messages):
             self.decompress = zlib.decompress
         elif compress == 'snappy':
             self.compress = snappy.compress
-            self.decompress = snappy.decompress
+            self.decompress = lambda data: snappy.decompress(bytes(data))
+        elif compress == 'zstd-stream':
+            self.compressor = zstdCompressor(dictionary)
+            self.compress = self.compressor.compress
+            self.decompress = self.compressor.decompress
+        elif compress == 'zstd':
+            self.compress = zstd.ZstdCompressor(level=3, dict_data=dictionary).compress
+            self.decompress = zstd.ZstdDecompressor(dict_data=dictionary).decompress
         elif compress != 'none':
             raise Exception("Unrecognized compression method: %s" % str(compress))
 
@@ -108,19 +199,20 @@ class BinMessages(Messages):
         if compress and self.compress:
             length |= 0x80000000
         lBytes = struct.pack("!I", length)
-        self.sendBytes(lBytes)
-        self.sendBytes(message)
+        self.sendBuffers((lBytes, message))
 
     def recvMessage(self):
+        """ Receive a frame.  Uncompressed frames are returned as a memoryview of the receive buffer, which is only
+            valid until the next receive """
         comp = False
-        x = self.receiveBytes(4)
+        x = self.receiveInto(4)
         n = struct.unpack("!I", x)[0]
         if (n & 0x80000000) != 0:
             n &= 0x7fffffff
             comp = True
-        data = self.receiveBytes(n)
+        data = self.receiveInto(n)
         if comp:
-            data = self.decompress(bytes(data))
+            data = self.decompress(data)
         return data
 
 class TextMessages(Messages):
@@ -151,9 +243,12 @@ class JsonMessages(TextMessages):
         if raw:
             message = super(JsonMessages, self).recvMessage()
         else:
-            message = json.loads(super(JsonMessages, self).recvMessage())
+            message = self.decodeMessage(super(JsonMessages, self).recvMessage())
         return message
 
+    def decodeMessage(self, data):
+        return json.loads(bytes(data))
+
     def encode(self, data):
         return base64.b64encode(data)
 
@@ -164,8 +259,8 @@ class JsonMessages(TextMessages):
         return "base64"
 
 class MsgPackMessages(BinMessages):
-    def __init__(self, socket, stats=None, compress=True):
-        BinMessages.__init__(self, socket, stats, compress=compress)
+    def __init__(self, socket, stats=None, compress=True, dictionary=None):
+        BinMessages.__init__(self, socket, stats, compress=compress, dictionary=dictionary)
     
     def sendMessage(self, message, compress=True, raw=False):
         if raw:
@@ -177,10 +272,12 @@ class MsgPackMessages(BinMessages):
         if raw:
             message = super(MsgPackMessages, self).recvMessage()
         else:
-            mess = super(MsgPackMessages, self).recvMessage()
-            message = msgpack.unpackb(mess, encoding='utf-8')
+            message = self.decodeMessage(super(MsgPackMessages, self).recvMessage())
         return message
 
+    def decodeMessage(self, data):
+        return msgpack.unpackb(data, encoding='utf-8')
+
     def encode(self, data):
         return data
 
@@ -191,8 +288,8 @@ class MsgPackMessages(BinMessages):
         return "bin"
 
 class BsonMessages(BinMessages):
-    def __init__(self, socket, stats=None, compress=True):
-        BinMessages.__init__(self, socket, stats, compress=compress)
+    def __init__(self, socket, stats=None, compress=True, dictionary=None):
+        BinMessages.__init__(self, socket, stats, compress=compress, dictionary=dictionary)
     
     def sendMessage(self, message, compress=True, raw=False):
         if raw:
@@ -204,9 +301,12 @@ class BsonMessages(BinMessages):
         if raw:
             message = super(BsonMessages, self).recvMessage()
         else:
-            message = bson.loads(super(BsonMessages, self).recvMessage())
+            message = self.decodeMessage(super(BsonMessages, self).recvMessage())
         return message
 
+    def decodeMessage(self, data):
+        return bson.loads(bytes(data))
+
     def encode(self, data):
         return data
 
@@ -97,6 +97,12 @@ def checkOverwrite(name, info):
     else:
         return True
 
+def getHasher(checksum):
+    """ Get a hash object for the hash the checksum was generated with.  A database can contain checksums generated
+        with several hashes, if the client has changed which it uses. """
+    info = tardis.getChecksumInfo(checksum)
+    return crypt.getHash(name=info['hashalg'] if info else None)
+
 def doAuthenticate(outname, checksum, digest):
     """
     Check that the recorded checksum of the file, and the digest of the generated file match.
@@ -216,7 +222,7 @@ def recoverObject(regenerator, info, bset, outputdir, path, linkDB, name=None, a
 
                 if i:
                     if authenticate:
-                        hasher = crypt.getHash()
+                        hasher = getHasher(checksum)
 
                     if info['link']:
                         # read and make a link
@@ -493,7 +499,7 @@ def main():
             for i in args.files:
                 try:
                     if args.auth:
-                        hasher = crypt.getHash()
+                        hasher = getHasher(i)
                     ckname = i
                     if args.recovername:
                         ckname = recoverName(i)
@@ -29,6 +29,7 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import os
+import io
 import binascii
 import logging
 import tempfile
@@ -43,6 +44,41 @@ import Tardis.librsync as librsync
 class RegenerateException(Exception):
     pass
 
+class ChunkedReader(io.RawIOBase):
+    """ Reassemble a file stored as a list of chunks.  Each chunk is recovered as the reader reaches it, so only one
+        chunk is held at a time, no matter how large the file is.  Not seekable. """
+    def __init__(self, regenerator, chunks, authenticate=True):
+        super().__init__()
+        self.regenerator = regenerator
+        self.chunks = iter(chunks)
+        self.authenticate = authenticate
+        self.current = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while True:
+            if self.current is None:
+                cksum = next(self.chunks, None)
+                if cksum is None:
+                    return 0
+                self.current = self.regenerator.recoverChecksum(cksum, self.authenticate)
+                if self.current is None:
+                    raise RegenerateException("Chunk {} not found".format(cksum))
+            data = self.current.read(len(b))
+            if data:
+                b[:len(data)] = data
+                return len(data)
+            self.current.close()
+            self.current = None
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+        super().close()
+
 class Regenerator:
     errors = 0
 
@@ -118,7 +154,13 @@ class Regenerator:
         #self.logger.debug(" %s: %s", cksum, str(cksInfo))
 
         try:
-            if not cksInfo['isfile']:
+            if cksInfo['chunked']:
+                chunks = self.db.getChunks(cksum)
+                self.logger.debug("Reassembling %s from %d chunks", cksum, len(chunks))
+                output = io.BufferedReader(ChunkedReader(self, chunks, authenticate), buffer_size=1024 * 1024)
+                if not cksInfo['basis']:
+                    return output
+            elif not cksInfo['isfile']:
                 raise RegenerateException("{} is not a file".format(cksum))
 
             if cksInfo['basis']:
@@ -127,19 +169,26 @@ class Regenerator:
                     basis.seek(0)
                 else:
                     basis = self.recoverChecksum(cksInfo['basis'], authenticate, chain)
-
-                if cksInfo['encrypted']:
+                    if isinstance(basis, io.BufferedReader) and not basis.seekable():
+                        # librsync needs random access to the basis
+                        temp = tempfile.TemporaryFile()
+                        shutil.copyfileobj(basis, temp)
+                        basis.close()
+                        temp.seek(0)
+                        basis = temp
+
+                if cksInfo['chunked']:
+                    # A delta sent in ranges.  The chunks are already decrypted and uncompressed
+                    patchfile = output
+                elif cksInfo['encrypted']:
                     patchfile = self.decryptFile(cksum, cksInfo['disksize'], authenticate)
                 else:
                     patchfile = self.cacheDir.open(cksum, 'rb')
 
-                if cksInfo['compressed']:
+                if cksInfo['compressed'] and not cksInfo['chunked']:
+                    # librsync reads the delta straight through, so it can be uncompressed as it goes
                     self.logger.debug("Uncompressing %s", cksum)
-                    temp = tempfile.TemporaryFile()
-                    buf = CompressedBuffer.UncompressedBufferedReader(patchfile, compressor=cksInfo['compressed'])
-                    shutil.copyfileobj(buf, temp)
-                    temp.seek(0)
-                    patchfile = temp
+                    patchfile = CompressedBuffer.UncompressedBufferedReader(patchfile, compressor=cksInfo['compressed'])
                 try:
                     output = librsync.patch(basis, patchfile)
                     #output.seek(0)
@@ -331,6 +331,12 @@ class RemoteDB(object):
         r.raise_for_status()
         return r.json()
 
+    @reconnect
+    def getChunks(self, checksum):
+        r = self.session.get(self.baseURL + "getChunks/" + checksum, headers=self.headers)
+        r.raise_for_status()
+        return r.json()
+
     @reconnect
     def getChecksumInfoChain(self, checksum):
         r = self.session.get(self.baseURL + "getChecksumInfoChain/" + checksum, headers=self.headers)
@@ -0,0 +1,210 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2020, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import os.path
+import logging
+import sqlite3
+
+logger = logging.getLogger("ScanState")
+
+_schema = [
+    "CREATE TABLE IF NOT EXISTS Config (Key TEXT PRIMARY KEY, Value TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS Dirs (Inode INTEGER NOT NULL, Device INTEGER NOT NULL, MTime INTEGER, CTime INTEGER, Hash TEXT, NumFiles INTEGER, "
+    "PRIMARY KEY (Inode, Device))",
+    "CREATE TABLE IF NOT EXISTS Files (Inode INTEGER NOT NULL, Device INTEGER NOT NULL, Size INTEGER, MTime INTEGER, CTime INTEGER, Checksum TEXT, "
+    "PRIMARY KEY (Inode, Device))",
+    "CREATE TABLE IF NOT EXISTS Compression (Class TEXT PRIMARY KEY, Samples INTEGER, BytesIn INTEGER, BytesOut INTEGER)"
+]
+
+class ScanState:
+    """
+    Local record of the state of the filesystem at the end of the last completed backup.
+    Directories are recorded by inode, device, mtime and ctime, along with the hashDir result, so an
+    unchanged directory doesn't need to be rehashed.  Files are recorded by inode, device, size, mtime and ctime,
+    along with their checksum, so checksum requests for unchanged files don't need to read the file.
+    It also keeps the compression ratios achieved for each class of file (extension or MIME type, and size), so
+    classes which have proven incompressible can be sent without trying.
+    Updates are held in a single transaction, which is only committed when the backup completes.
+    """
+    def __init__(self, path, fingerprint):
+        """ Open (or create) the state database at path.  Fingerprint identifies the hash function/keys in use.
+            If it doesn't match the one recorded, all recorded state is discarded. """
+        self.path = path
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname, 0o700)
+
+        self.conn = sqlite3.connect(path)
+        self.cursor = self.conn.cursor()
+        for stmt in _schema:
+            self.cursor.execute(stmt)
+
+        row = self.cursor.execute("SELECT Value FROM Config WHERE Key = 'Fingerprint'").fetchone()
+        if row is None or row[0] != fingerprint:
+            if row is not None:
+                logger.info("Hash parameters changed.  Discarding scan state in %s", path)
+            self.cursor.execute("DELETE FROM Dirs")
+            self.cursor.execute("DELETE FROM Files")
+            self.cursor.execute("INSERT OR REPLACE INTO Config (Key, Value) VALUES ('Fingerprint', ?)", (fingerprint,))
+        self.conn.commit()
+
+        self.compression = {}
+        for (cls, samples, bytesIn, bytesOut) in self.cursor.execute("SELECT Class, Samples, BytesIn, BytesOut FROM Compression"):
+            self.compression[cls] = [samples, bytesIn, bytesOut]
+        self.skipped = {}
+
+        self.dirHits = 0
+        self.checksumHits = 0
+
+    def getDirHash(self, inode, device, mtime, ctime, numfiles):
+        """ Return the (hash, numfiles) recorded for a directory, if it's provably unchanged, None otherwise """
+        row = self.cursor.execute("SELECT Hash, NumFiles FROM Dirs WHERE Inode = ? AND Device = ? AND MTime = ? AND CTime = ?",
+                                  (inode, device, mtime, ctime)).fetchone()
+        if row and row[1] == numfiles:
+            self.dirHits += 1
+            return (row[0], row[1])
+        return None
+
+    def setDirHash(self, inode, device, mtime, ctime, info):
+        (h, s) = info
+        self.cursor.execute("INSERT OR REPLACE INTO Dirs (Inode, Device, MTime, CTime, Hash, NumFiles) VALUES (?, ?, ?, ?, ?, ?)",
+                            (inode, device, mtime, ctime, h, s))
+
+    def getChecksum(self, inode, device, size, mtime, ctime):
+        """ Return the checksum recorded for a file, if it hasn't changed since it was recorded """
+        row = self.cursor.execute("SELECT Checksum FROM Files WHERE Inode = ? AND Device = ? AND Size = ? AND MTime = ? AND CTime = ?",
+                                  (inode, device, size, mtime, ctime)).fetchone()
+        if row:
+            self.checksumHits += 1
+            return row[0]
+        return None
+
+    def setChecksum(self, inode, device, size, mtime, ctime, checksum):
+        self.cursor.execute("INSERT OR REPLACE INTO Files (Inode, Device, Size, MTime, CTime, Checksum) VALUES (?, ?, ?, ?, ?, ?)",
+                            (inode, device, size, mtime, ctime, checksum))
+
+    def isCompressible(self, cls, minSamples=8, threshold=0.9, retry=100):
+        """ Check if a class of files has proven to be compressible.  Returns True or False if enough files of the class
+            have been seen to know, None if not.  Every retry'th file of an incompressible class gets a None, so the class
+            gets sampled again. """
+        info = self.compression.get(cls)
+        if info is None or info[0] < minSamples or info[1] == 0:
+            return None
+        if float(info[2]) / float(info[1]) <= threshold:
+            return True
+        skipped = self.skipped.get(cls, 0) + 1
+        self.skipped[cls] = skipped
+        if skipped % retry == 0:
+            return None
+        return False
+
+    def recordCompression(self, cls, bytesIn, bytesOut, maxSamples=1000):
+        """ Record the results of compressing a file.  Old results are aged out once a class has maxSamples """
+        info = self.compression.setdefault(cls, [0, 0, 0])
+        if info[0] >= maxSamples:
+            info[:] = [x // 2 for x in info]
+        info[0] += 1
+        info[1] += bytesIn
+        info[2] += bytesOut
+        self.cursor.execute("INSERT OR REPLACE INTO Compression (Class, Samples, BytesIn, BytesOut) VALUES (?, ?, ?, ?)",
+                            (cls, info[0], info[1], info[2]))
+
+    def forked(self):
+        """ Get a copy of the state for a forked process to use in place of this one """
+        return ForkedScanState(self)
+
+    def apply(self, changes):
+        """ Apply the changes made to a forked copy, as returned by its changes() """
+        (dirs, files, compression, dirHits, checksumHits) = changes
+        for d in dirs:
+            self.setDirHash(*d)
+        for f in files:
+            self.setChecksum(*f)
+        for c in compression:
+            self.recordCompression(*c)
+        self.dirHits += dirHits
+        self.checksumHits += checksumHits
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self, completed=False):
+        """ Close the state database.  Changes are only kept if the backup completed """
+        if completed:
+            self.conn.commit()
+        else:
+            self.conn.rollback()
+        self.conn.close()
+
+class ForkedScanState(ScanState):
+    """
+    Copy of a ScanState for use in a forked process.  SQLite connections can't be carried across a fork, so it reads
+    through a connection of its own.  The original holds the write transaction, so changes are kept here instead, to be
+    sent back and applied to the original with apply().
+    """
+    def __init__(self, parent):
+        self.path = parent.path
+        self.conn = sqlite3.connect(parent.path)
+        self.cursor = self.conn.cursor()
+        self.compression = {cls: list(info) for (cls, info) in parent.compression.items()}
+        self.skipped = dict(parent.skipped)
+
+        self.dirs = []
+        self.files = []
+        self.compressed = []
+
+        self.dirHits = 0
+        self.checksumHits = 0
+
+    def setDirHash(self, inode, device, mtime, ctime, info):
+        self.dirs.append((inode, device, mtime, ctime, info))
+
+    def setChecksum(self, inode, device, size, mtime, ctime, checksum):
+        self.files.append((inode, device, size, mtime, ctime, checksum))
+
+    def recordCompression(self, cls, bytesIn, bytesOut, maxSamples=1000):
+        info = self.compression.setdefault(cls, [0, 0, 0])
+        if info[0] >= maxSamples:
+            info[:] = [x // 2 for x in info]
+        info[0] += 1
+        info[1] += bytesIn
+        info[2] += bytesOut
+        self.compressed.append((cls, bytesIn, bytesOut))
+
+    def changes(self):
+        """ The changes made, to be passed to the original's apply() """
+        return (self.dirs, self.files, self.compressed, self.dirHits, self.checksumHits)
+
+    def commit(self):
+        pass
+
+    def close(self, completed=False):
+        self.conn.close()
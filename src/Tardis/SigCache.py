@@ -0,0 +1,120 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2020, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import os.path
+import logging
+import tempfile
+import shutil
+import re
+
+logger = logging.getLogger("SigCache")
+
+# Checksums are hex digests, of 128 bits (MD5) or 256 bits (BLAKE2b, BLAKE3).  Anything else isn't used in a path.
+_checksumPattern = re.compile(r'[0-9a-f]{32}|[0-9a-f]{64}')
+
+class SigCache:
+    """
+    Local cache of the signatures of files the client has sent, keyed by their checksum.  When the server asks for a
+    delta of a file, the signature of the version it has is usually here, so it doesn't need to be fetched.
+    Files are kept in a two level directory tree, like the server's cache.  Each file's modification time is updated
+    when it's used, and the least recently used are removed when the cache grows beyond its maximum size.
+    Entries are written to a temporary file and renamed into place, so several processes can share the cache.
+    """
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        if not os.path.isdir(path):
+            os.makedirs(path, 0o700)
+
+    def _path(self, checksum):
+        """ Path to the signature of a checksum.  Returns None if the checksum isn't one """
+        if not isinstance(checksum, str) or not _checksumPattern.fullmatch(checksum):
+            logger.warning("Invalid checksum for signature cache: %r", checksum)
+            return None
+        return os.path.join(self.path, checksum[0:2], checksum + ".sig")
+
+    def get(self, checksum):
+        """ Open the signature for a checksum, if it's here.  Returns None if not """
+        name = self._path(checksum)
+        if name is None:
+            return None
+        try:
+            f = open(name, "rb")
+            os.utime(name)
+            return f
+        except OSError:
+            return None
+
+    def insert(self, checksum, sig):
+        """ Save a copy of a signature file.  The file is read from the start, and left at the end """
+        name = self._path(checksum)
+        if name is None:
+            return
+        if os.path.exists(name):
+            os.utime(name)
+            return
+        dirname = os.path.dirname(name)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname, 0o700, exist_ok=True)
+            sig.seek(0)
+            with tempfile.NamedTemporaryFile(dir=dirname, delete=False) as temp:
+                shutil.copyfileobj(sig, temp)
+            os.rename(temp.name, name)
+        except OSError as e:
+            logger.warning("Unable to save signature for %s: %s", checksum, str(e))
+
+    def prune(self):
+        """ Remove the least recently used signatures, until the cache is under its maximum size.  Returns the number removed """
+        entries = []
+        total = 0
+        for sub in os.scandir(self.path):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                s = entry.stat()
+                entries.append((s.st_mtime, s.st_size, entry.path))
+                total += s.st_size
+
+        removed = 0
+        if total > self.maxsize:
+            entries.sort()
+            for (_, size, name) in entries:
+                if total <= self.maxsize:
+                    break
+                try:
+                    os.unlink(name)
+                    removed += 1
+                except OSError:
+                    pass
+                total -= size
+        logger.debug("Signature cache %s: %d entries, %d bytes, %d removed", self.path, len(entries) - removed, total, removed)
+        return removed
@@ -42,6 +42,11 @@ from Cryptodome.Util.Padding import pad, unpad
 import Cryptodome.Random
 import srp
 
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
 import Tardis.Defaults as Defaults
 from functools import reduce
 
@@ -49,6 +54,41 @@ defaultCryptoScheme = 4
 maxCryptoScheme = 4
 noCryptoScheme = 0
 
+# Content hashes.  Databases created before the hash was selectable use MD5.
+defaultContentHash = 'md5'
+
+def _md5Hash(key):
+    return hmac.new(key, digestmod=hashlib.md5) if key else hashlib.md5()
+
+def _blake2bHash(key):
+    return hashlib.blake2b(digest_size=32, key=key or b'')
+
+def _blake3Hash(key):
+    if blake3 is None:
+        raise Exception("BLAKE3 content hashes require the blake3 module")
+    if key and len(key) != 32:
+        key = hashlib.sha256(key).digest()
+    return blake3.blake3(key=key) if key else blake3.blake3()
+
+_contentHashes = {
+    'md5':      _md5Hash,
+    'blake2b':  _blake2bHash,
+    'blake3':   _blake3Hash,
+}
+
+def getContentHasher(name, key=None):
+    """ Get a hash object for identifying content with the named algorithm.  If a key is given, the hash is keyed, so
+        checksums don't reveal the content they identify. """
+    try:
+        func = _contentHashes[name]
+    except KeyError:
+        raise Exception(f"Unknown content hash: {name}")
+    return func(key)
+
+def getContentHashNames():
+    """ The content hashes available here """
+    return [name for name in _contentHashes if name != 'blake3' or blake3 is not None]
+
 def getCrypto(scheme, password, client=None, fsencoding=sys.getfilesystemencoding()):
     scheme = int(scheme)
 
@@ -254,6 +294,7 @@ class Crypto_Null:
     _blocksize   = AES.block_size
     _keysize     = AES.key_size[-1]                                              # last (largest) acceptable _keysize
     _altchars    = b'#@'
+    _contentHash = defaultContentHash
 
     class NullCipher():
         def encrypt(data):
@@ -280,8 +321,19 @@ class Crypto_Null:
     def decryptFilename(self, name):
         return name
 
-    def getHash(self, func=hashlib.md5):
-        return func()
+    def getHash(self, func=None, name=None):
+        """ Get a hash object.  If func is specified, it's a hashlib constructor, otherwise the content hash is used,
+            either the named one, or the one currently selected. """
+        if func:
+            return func()
+        return getContentHasher(name or self._contentHash)
+
+    def setContentHash(self, name):
+        getContentHasher(name)
+        self._contentHash = name
+
+    def getContentHash(self):
+        return self._contentHash
 
     def getIV(self):
         return None
@@ -369,8 +421,10 @@ class Crypto_AES_CBC_HMAC__AES_ECB(Crypto_Null):
     def getContentEncryptor(self, iv=None):
         return HashingBlockEncryptor(self.getContentCipher(iv), self.getHash(hashlib.sha512))
 
-    def getHash(self, func=hashlib.md5):
-        return hmac.new(self._contentKey, digestmod=func)
+    def getHash(self, func=None, name=None):
+        if func:
+            return hmac.new(self._contentKey, digestmod=func)
+        return getContentHasher(name or self._contentHash, self._contentKey)
 
     def getIV(self):
         return self._random.read(self.ivLength)
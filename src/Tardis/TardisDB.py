@@ -85,9 +85,10 @@ _backupSetInfoFields = "BackupSet AS backupset, StartTime AS starttime, EndTime
 _backupSetInfoJoin = "FROM Backups LEFT OUTER JOIN Checksums ON Checksums.ChecksumID = Backups.CmdLineId "
 
 _checksumInfoFields = "Checksum AS checksum, ChecksumID AS checksumid, Basis AS basis, Encrypted AS encrypted, " \
-                      "Size AS size, DeltaSize AS deltasize, DiskSize AS disksize, IsFile AS isfile, Compressed AS compressed, ChainLength AS chainlength "
+                      "Size AS size, DeltaSize AS deltasize, DiskSize AS disksize, IsFile AS isfile, Compressed AS compressed, ChainLength AS chainlength, " \
+                      "Chunked AS chunked, COALESCE(HashAlg, 'md5') AS hashalg "
 
-_schemaVersion = 17
+_schemaVersion = 21
 
 def _addFields(x, y):
     """ Add fields to the end of a dict """
@@ -126,7 +127,7 @@ class TardisDB(object):
     srpSrv          = None
     authenticated   = False
 
-    def __init__(self, dbname, backup=False, prevSet=None, initialize=None, connid=None, user=-1, group=-1, chunksize=1000, numbackups=2, journal=None, allow_upgrade=False, check_threads=True):
+    def __init__(self, dbname, backup=False, prevSet=None, initialize=None, connid=None, user=-1, group=-1, chunksize=1000, numbackups=2, journal=None, allow_upgrade=False, check_threads=True, timeout=5.0):
         """ Initialize the connection to a per-machine Tardis Database"""
         self.logger  = logging.getLogger("DB")
         self.logger.debug("Initializing connection to %s", dbname)
@@ -147,8 +148,9 @@ class TardisDB(object):
 
         self.backup = backup
         self.numbackups = numbackups
+        self.contentHash = None
 
-        conn = sqlite3.connect(self.dbName, check_same_thread=check_threads)
+        conn = sqlite3.connect(self.dbName, check_same_thread=check_threads, timeout=timeout)
         conn.text_factory = lambda x: x.decode('utf-8', 'backslashreplace')
         conn.row_factory= sqlite3.Row
 
@@ -345,6 +347,20 @@ class TardisDB(object):
 
         return self.currBackupSet
 
+    @authenticate
+    def joinBackupSet(self, session):
+        """ Share the backupset being created by another, still running, session.  Set the current backup set to be that set.
+            Returns whether the backupset before it completed. """
+        c = self.cursor.execute("SELECT BackupSet, Name FROM Backups WHERE Session = :session AND Completed = 0", {"session": session})
+        row = c.fetchone()
+        if row is None:
+            raise Exception("No running backupset for session {}".format(session))
+        (self.currBackupSet, self.currBackupName) = (row[0], row[1])
+        c = self.cursor.execute("SELECT Completed FROM Backups WHERE BackupSet < :backupset ORDER BY BackupSet DESC LIMIT 1", {"backupset": self.currBackupSet})
+        prev = c.fetchone()
+        self.logger.info("Joined backup set: %d: %s %s", self.currBackupSet, self.currBackupName, session)
+        return prev[0] if prev else True
+
     @authenticate
     def setBackupSetName(self, name, priority, current=True):
         """ Change the name of a backupset.  Return True if it can be changed, false otherwise. """
@@ -678,6 +694,69 @@ class TardisDB(object):
                                { "new": newBSet, "old": oldBSet, "parent": parIno, "parentDev": parDev })
         return cursor.rowcount
 
+    # The directories of the tree below a directory, itself included, in a backup set.
+    _treeDirs = ("(WITH RECURSIVE Tree(Inode, Device) AS ("
+                 "VALUES (:inode, :device) "
+                 "UNION "
+                 "SELECT Files.Inode, Files.Device FROM Files JOIN Tree ON Files.Parent = Tree.Inode AND Files.ParentDev = Tree.Device "
+                 "WHERE Files.Dir = 1 AND :old BETWEEN Files.FirstSet AND Files.LastSet) "
+                 "SELECT Inode, Device FROM Tree) ")
+
+    @authenticate
+    def cloneTree(self, top, new=True, old=False):
+        """ Clone every directory in the tree below top, and their digests, into the new backup set.  Returns the number of files cloned """
+        newBSet = self._bset(new)
+        oldBSet = self._bset(old)
+        (inode, device) = top
+        self.logger.debug("Cloning tree inode %d, %d from %d to %d", inode, device, oldBSet, newBSet)
+        args = { "new": newBSet, "old": oldBSet, "inode": inode, "device": device }
+        cursor = self._execute("UPDATE Files "
+                               "SET LastSet = :new "
+                               "WHERE (Parent, ParentDev) IN " + self._treeDirs + "AND "
+                               ":old BETWEEN FirstSet AND LastSet",
+                               args)
+        cloned = cursor.rowcount
+        self._execute("UPDATE TreeDigests "
+                      "SET LastSet = :new "
+                      "WHERE (Inode, Device) IN " + self._treeDirs + "AND "
+                      ":old BETWEEN FirstSet AND LastSet",
+                      args)
+        return cloned
+
+    @authenticate
+    def getTreeMissing(self, top, current=False):
+        """ Count the files in the tree below top which don't have their content """
+        (inode, device) = top
+        row = self._executeWithResult("SELECT COUNT(*) FROM Files "
+                                      "WHERE (Parent, ParentDev) IN " + self._treeDirs + "AND "
+                                      ":old BETWEEN FirstSet AND LastSet AND "
+                                      "Dir = 0 AND ChecksumId IS NULL",
+                                      { "inode": inode, "device": device, "old": self._bset(current) })
+        return row[0] if row else 0
+
+    @authenticate
+    def getTreeDigest(self, top, current=False):
+        (inode, device) = top
+        row = self._executeWithResult("SELECT Digest FROM TreeDigests "
+                                      "WHERE Inode = :inode AND Device = :device AND :bset BETWEEN FirstSet AND LastSet",
+                                      { "inode": inode, "device": device, "bset": self._bset(current) })
+        return row[0] if row else None
+
+    @authenticate
+    def setTreeDigest(self, top, digest, new=True, old=False):
+        """ Record the digest of the tree below top.  If it's the same as in the old set, that one's extended """
+        (inode, device) = top
+        args = { "inode": inode, "device": device, "digest": digest, "new": self._bset(new), "old": self._bset(old) }
+        cursor = self._execute("UPDATE TreeDigests "
+                               "SET LastSet = :new "
+                               "WHERE Inode = :inode AND Device = :device AND Digest = :digest AND "
+                               ":old BETWEEN FirstSet AND LastSet",
+                               args)
+        if cursor.rowcount == 0:
+            self._execute("INSERT OR REPLACE INTO TreeDigests (Inode, Device, Digest, FirstSet, LastSet) "
+                          "VALUES (:inode, :device, :digest, :new, :new)",
+                          args)
+
     @authenticate
     def setNameID(self, files):
         for f in files:
@@ -690,7 +769,7 @@ class TardisDB(object):
                 f["nameid"] = self.cursor.lastrowid
 
     @authenticate
-    def insertChecksumFile(self, checksum, encrypted=False, size=0, basis=None, deltasize=None, compressed='None', disksize=None, current=True, isFile=True):
+    def insertChecksumFile(self, checksum, encrypted=False, size=0, basis=None, deltasize=None, compressed='None', disksize=None, current=True, isFile=True, chunked=False, hashalg=None):
         self.logger.debug("Inserting checksum file: %s -- %d bytes, Compressed %s", checksum, size, str(compressed))
         added = self._bset(current)
         def _xstr(x):
@@ -704,12 +783,78 @@ class TardisDB(object):
         else:
             chainlength = self.getChainLength(basis) + 1
 
-        self.cursor.execute("INSERT INTO CheckSums (CheckSum,  Size,  Basis,  Encrypted,  DeltaSize,  Compressed,  DiskSize,  ChainLength,  Added,  IsFile) "
-                            "VALUES                (:checksum, :size, :basis, :encrypted, :deltasize, :compressed, :disksize, :chainlength, :added, :isfile)",
+        if hashalg is None:
+            hashalg = self.getContentHash()
+
+        self.cursor.execute("INSERT INTO CheckSums (CheckSum,  Size,  Basis,  Encrypted,  DeltaSize,  Compressed,  DiskSize,  ChainLength,  Added,  IsFile,  Chunked,  HashAlg) "
+                            "VALUES                (:checksum, :size, :basis, :encrypted, :deltasize, :compressed, :disksize, :chainlength, :added, :isfile, :chunked, :hashalg)",
                             {"checksum": checksum, "size": size, "basis": basis, "encrypted": encrypted, "deltasize": deltasize,
-                             "compressed": str(compressed), "disksize": disksize, "chainlength": chainlength, "added": added, "isfile": int(isFile)})
+                             "compressed": str(compressed), "disksize": disksize, "chainlength": chainlength, "added": added, "isfile": int(isFile),
+                             "chunked": int(chunked), "hashalg": hashalg})
         return self.cursor.lastrowid
 
+    @authenticate
+    def insertChunkedFile(self, checksum, chunks, encrypted=False, size=0, current=True, basis=None, deltasize=None):
+        """ Record a file which is stored as a list of chunks, each of which is an ordinary checksum file.  If there's a
+            basis, the chunks make up a delta against it, rather than the file itself """
+        self.logger.debug("Inserting chunked file: %s -- %d bytes, %d chunks", checksum, size, len(chunks))
+        checksumId = self.insertChecksumFile(checksum, encrypted, size=size, basis=basis, deltasize=deltasize, current=current, isFile=False, chunked=True)
+        self.cursor.executemany("INSERT INTO Chunks (ChecksumId, Seq, ChunkId) "
+                                "SELECT :checksumid, :seq, ChecksumId FROM CheckSums WHERE Checksum = :chunk",
+                                ({"checksumid": checksumId, "seq": seq, "chunk": chunk} for seq, chunk in enumerate(chunks)))
+        return checksumId
+
+    @authenticate
+    def getChunks(self, checksum):
+        """ Get the list of chunk checksums which make up a chunked file, in order """
+        self.logger.debug("Getting chunks for %s", checksum)
+        c = self._execute("SELECT C2.Checksum FROM Chunks "
+                          "JOIN CheckSums AS C1 ON Chunks.ChecksumId = C1.ChecksumId "
+                          "JOIN CheckSums AS C2 ON Chunks.ChunkId = C2.ChecksumId "
+                          "WHERE C1.Checksum = :checksum ORDER BY Seq ASC",
+                          {"checksum": checksum})
+        return [row[0] for row in c.fetchall()]
+
+    @authenticate
+    def getPartialUpload(self, inode, device, size, mtime):
+        """ Get the pieces already received of a file whose upload didn't finish, as (offset, length, checksum).  Pieces
+            of a different version of the file are discarded. """
+        self.logger.debug("Getting partial upload for %d %d", inode, device)
+        self.cursor.execute("DELETE FROM PartialUploads WHERE Inode = :inode AND Device = :device AND (Size != :size OR MTime != :mtime)",
+                            {"inode": inode, "device": device, "size": size, "mtime": mtime})
+        return self.getPartialPieces(inode, device)
+
+    @authenticate
+    def getPartialPieces(self, inode, device):
+        """ Get the pieces received so far of a file being uploaded in pieces, as (offset, length, checksum) """
+        c = self._execute("SELECT Offset, Length, Checksum FROM PartialUploads "
+                          "JOIN CheckSums ON PartialUploads.ChunkId = CheckSums.ChecksumId "
+                          "WHERE Inode = :inode AND Device = :device ORDER BY Offset ASC",
+                          {"inode": inode, "device": device})
+        return [tuple(row) for row in c.fetchall()]
+
+    @authenticate
+    def insertPartialUpload(self, inode, device, size, mtime, offset, length, chunk):
+        """ Record a piece of a file received, so the upload can be resumed if it doesn't finish """
+        self.cursor.execute("INSERT OR REPLACE INTO PartialUploads (Inode, Device, Size, MTime, Offset, Length, ChunkId, Received) "
+                            "SELECT :inode, :device, :size, :mtime, :offset, :length, ChecksumId, :now FROM CheckSums WHERE Checksum = :chunk",
+                            {"inode": inode, "device": device, "size": size, "mtime": mtime, "offset": offset, "length": length,
+                             "chunk": chunk, "now": int(time.time())})
+
+    @authenticate
+    def deletePartialUpload(self, inode, device):
+        self.logger.debug("Deleting partial upload for %d %d", inode, device)
+        self.cursor.execute("DELETE FROM PartialUploads WHERE Inode = :inode AND Device = :device",
+                            {"inode": inode, "device": device})
+
+    @authenticate
+    def deleteStalePartialUploads(self, before):
+        """ Forget uploads which haven't been added to since before.  Their pieces become orphans """
+        self.cursor.execute("DELETE FROM PartialUploads WHERE (Inode, Device) IN "
+                            "(SELECT Inode, Device FROM PartialUploads GROUP BY Inode, Device HAVING MAX(Received) < :before)",
+                            {"before": before})
+        return self.cursor.rowcount
+
     @authenticate
     def updateChecksumFile(self, checksum, encrypted=False, size=0, basis=None, deltasize=None, compressed=False, disksize=None, chainlength=0):
         self.logger.debug("Updating checksum file: %s -- %d bytes, Compressed %s", checksum, size, str(compressed))
@@ -750,6 +895,25 @@ class TardisDB(object):
 
         return chain
 
+    @authenticate
+    def countContentChecksums(self):
+        """ Count the checksums which have content stored, either as a file or as chunks """
+        c = self._execute("SELECT COUNT(*) FROM CheckSums WHERE IsFile = 1 OR Chunked = 1")
+        return c.fetchone()[0]
+
+    @authenticate
+    def listContentChecksums(self, after=0):
+        """ List the checksums which have content stored, either as a file or as chunks, as (checksumid, checksum), in the
+            order they were added.  If after is set, only those added after the checksum with that ID are listed """
+        c = self.conn.execute("SELECT ChecksumId, Checksum FROM CheckSums WHERE (IsFile = 1 OR Chunked = 1) AND ChecksumId > :after "
+                              "ORDER BY ChecksumId ASC", {"after": after})
+        while True:
+            batch = c.fetchmany(self.chunksize)
+            if not batch:
+                break
+            for row in batch:
+                yield (row[0], row[1])
+
     @authenticate
     def getNamesForChecksum(self, checksum):
         """ Recover a list of names that represent a checksum """
@@ -1004,6 +1168,19 @@ class TardisDB(object):
         self.logger.debug("Getting CryptoScheme")
         return self._getConfigValue('CryptoScheme')
 
+    def getContentHash(self):
+        """ The hash new checksums are generated with.  Databases which predate the choice use MD5. """
+        if self.contentHash is None:
+            self.contentHash = self._getConfigValue('ContentHash', 'md5')
+        return self.contentHash
+
+    @authenticate
+    def setContentHash(self, name):
+        """ Change the hash new checksums are generated with.  Existing checksums keep the hash they were generated with. """
+        self.logger.info("Changing content hash from %s to %s", self.getContentHash(), name)
+        self._setConfigValue('ContentHash', name)
+        self.contentHash = name
+
     @authenticate
     def setKeys(self, salt, vkey, filenameKey, contentKey, backup=True):
         import Tardis.Util as Util      # Import it here, as Util imports TardisDB
@@ -1051,6 +1228,8 @@ class TardisDB(object):
         self.cursor.execute("DELETE FROM Files WHERE "
                             "0 = (SELECT COUNT(*) FROM Backups WHERE Backups.BackupSet BETWEEN Files.FirstSet AND Files.LastSet)")
         filesDeleted = self.cursor.rowcount
+        self.cursor.execute("DELETE FROM TreeDigests WHERE "
+                            "0 = (SELECT COUNT(*) FROM Backups WHERE Backups.BackupSet BETWEEN TreeDigests.FirstSet AND TreeDigests.LastSet)")
         return filesDeleted
 
     @authenticate
@@ -1126,6 +1305,8 @@ class TardisDB(object):
                               "AND   ChecksumID NOT IN (SELECT DISTINCT(AclId) FROM Files WHERE AclId IS NOT NULL) "
                               "AND   ChecksumID NOT IN (SELECT DISTINCT(CmdLineID) FROM Backups WHERE CmdLineID IS NOT NULL) "
                               "AND   Checksum   NOT IN (SELECT DISTINCT(Basis) FROM Checksums WHERE Basis IS NOT NULL) "
+                              "AND   ChecksumID NOT IN (SELECT DISTINCT(ChunkId) FROM Chunks) "
+                              "AND   ChecksumID NOT IN (SELECT DISTINCT(ChunkId) FROM PartialUploads) "
                               "AND IsFile = :isfile",
                               { 'isfile': int(isFile)} )
         while True:
@@ -1143,9 +1324,14 @@ class TardisDB(object):
                             "AND   ChecksumID NOT IN (SELECT DISTINCT(AclId) FROM Files WHERE AclId IS NOT NULL) "
                             "AND   ChecksumID NOT IN (SELECT DISTINCT(CmdLineID) FROM Backups WHERE CmdLineID IS NOT NULL) "
                             "AND   Checksum   NOT IN (SELECT DISTINCT(Basis) FROM Checksums WHERE Basis IS NOT NULL) "
+                            "AND   ChecksumID NOT IN (SELECT DISTINCT(ChunkId) FROM Chunks) "
+                            "AND   ChecksumID NOT IN (SELECT DISTINCT(ChunkId) FROM PartialUploads) "
                             "AND IsFile = :isfile",
                             { 'isfile': int(isFile)} )
-        return self.cursor.rowcount
+        count = self.cursor.rowcount
+        # Drop the chunk lists of any chunked files which were just removed
+        self.cursor.execute("DELETE FROM Chunks WHERE ChecksumId NOT IN (SELECT ChecksumId FROM CheckSums)")
+        return count
 
     @authenticate
     def compact(self):
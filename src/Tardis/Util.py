@@ -35,6 +35,7 @@ import configparser
 import sys
 import subprocess
 import hashlib
+import math
 import shlex
 import getpass
 import stat
@@ -49,6 +50,7 @@ import time
 import struct
 import io
 import signal
+import tempfile
 
 import urllib.request, urllib.parse, urllib.error
 
@@ -462,6 +464,7 @@ def setupDataConnection(dataLoc, client, password, keyFile, dbName, dbLoc=None,
     else:
         (f, c) = tardis.getKeys()
     crypt.setKeys(f, c)
+    crypt.setContentHash(tardis.getConfigValue('ContentHash', TardisCrypto.defaultContentHash))
 
     if retpassword:
         return (tardis, cache, crypt, password)
@@ -559,12 +562,14 @@ def removeOrphans(db, cache):
     while True:
         (lCount, lSize) = _removeOrphans(db, cache)
         if lCount == 0:
-            break
+            # Removing chunked files, which have no file of their own, can orphan the chunks they were built from.
+            if not db.deleteOrphanChecksums(False):
+                break
+            continue
         rounds += 1
         count  += lCount
         size   += lSize
 
-    db.deleteOrphanChecksums(False)
     return count, size, rounds
 
 # Data transmission functions
@@ -586,10 +591,12 @@ def sendDataPlain(sender, data, chunksize=(16 * 1024), compress=None, stats=None
     encrypt = TardisCrypto.NullEncryptor()
     sendData(sender, data, encrypt, chunksize=chunksize, compress=compress, stats=stats)
 
-def sendData(sender, data, encrypt, chunksize=(16 * 1024), hasher=None, compress=None, stats=None, signature=False, progress=None, progressPeriod=8*1024*1024):
+def sendData(sender, data, encrypt, chunksize=(16 * 1024), hasher=None, compress=None, stats=None, signature=False, progress=None, progressPeriod=8*1024*1024, threads=0):
     """
     Send a block of data, optionally encrypt and/or compress it before sending
     Compress should be either None, for no compression, or one of the known compression types (zlib, bzip, lzma)
+    If threads is set, the data is compressed using that many threads, while the sending thread encrypts and sends it.
+    Signature is passed to the reader: True, or a dict of librsync.SignatureJob parameters, to generate one as the data is read.
     """
     #logger = logging.getLogger('Data')
     if isinstance(sender, Connection.Connection):
@@ -605,7 +612,9 @@ def sendData(sender, data, encrypt, chunksize=(16 * 1024), hasher=None, compress
         if progressPeriod % chunksize != 0:
             progressPeriod -= progressPeriod % chunksize
 
-    if compress:
+    if compress and threads:
+        stream = CompressedBuffer.ParallelCompressedBufferedReader(data, threads, hasher=hasher, signature=signature, compressor=compress)
+    elif compress:
         stream = CompressedBuffer.CompressedBufferedReader(data, hasher=hasher, signature=signature, compressor=compress)
     else:
         stream = CompressedBuffer.BufferedReader(data, hasher=hasher, signature=signature)
@@ -663,15 +672,40 @@ def sendData(sender, data, encrypt, chunksize=(16 * 1024), hasher=None, compress
         _transmissionTime += end - start
     return size, ck, sig
 
-def receiveData(receiver, output):
+class _PackCollector:
+    """ Stands in for a message sender, collecting the data stream sendData generates rather than sending it """
+    def __init__(self):
+        self.chunks = []
+        self.trailer = None
+
+    def sendMessage(self, message, compress=True, raw=False):
+        if raw:
+            self.chunks.append(message)
+        else:
+            self.trailer = message
+
+def packData(data, encrypt, chunksize=(16 * 1024), hasher=None, compress=None, stats=None, signature=False):
+    """
+    Generate the same data stream sendData would send, but return it as a single block, to be packed in a
+    message with other files.  Returns the data, the original size, the checksum, the compression used, and the signature
+    """
+    collector = _PackCollector()
+    (size, ck, sig) = sendData(collector, data, encrypt, chunksize=chunksize, hasher=hasher, compress=compress, stats=stats, signature=signature)
+    return (b''.join(collector.chunks), size, ck, collector.trailer['compressed'], sig)
+
+def receiveData(receiver, output, hasher=None, compressed=None):
     """ Receive a block of data from the sender, and store it in the specified file.
     Collect some info sent, and return it.
+    Data frames arrive as views of the receiver's buffer, so they're written out directly, rather than kept.
+    If a hasher is given, the (unencrypted) data is uncompressed, with the compressor named by compressed, and hashed as it
+    arrives, so it can be checked without reading it back.
     """
     # logger = logging.getLogger('Data')
     if isinstance(receiver, Connection.Connection):
         receiver = receiver.sender
     bytesReceived = 0
     checksum = None
+    decompressor = CompressedBuffer.getDecompressor(compressed) if hasher else None
     compressed = False
     while True:
         chunk = receiver.recvMessage(raw=True)
@@ -682,8 +716,16 @@ def receiveData(receiver, output):
         data = receiver.decode(chunk)
         if output:
             output.write(data)
-            output.flush()
+        if hasher:
+            hasher.update(decompressor.decompress(data))
         bytesReceived += len(data)
+    if output:
+        output.flush()
+    if hasher:
+        try:
+            hasher.update(decompressor.flush() or b'')
+        except AttributeError:
+            pass
 
     chunk = receiver.recvMessage()
     status = chunk['status']
@@ -934,6 +976,71 @@ class bidict(dict):
             del self.inverse[self[key]]
         super(bidict, self).__delitem__(key)
 
+# Bloom filter, to let the client check for checksums the server definitely doesn't have.
+
+class BloomFilter:
+    _header = struct.Struct("!4sQIQQQd")
+    _magic = b'TBF1'
+
+    def __init__(self, bits, hashes, data=None, capacity=0, errorRate=0.0):
+        self.bits = max(bits, 8)
+        self.hashes = hashes
+        self.data = bytearray(data) if data else bytearray((self.bits + 7) // 8)
+        self.capacity = capacity
+        self.errorRate = errorRate
+        self.count = 0
+        # How far through whatever it was built from the filter has got, so a saved filter can be brought up to date
+        self.position = 0
+
+    @classmethod
+    def forCapacity(cls, capacity, errorRate=0.01):
+        """ Size a filter to hold capacity entries with (approximately) the given false positive rate """
+        capacity = max(capacity, 1)
+        bits = int(-capacity * math.log(errorRate) / (math.log(2) ** 2))
+        hashes = max(1, round(bits / capacity * math.log(2)))
+        return cls(bits, hashes, capacity=capacity, errorRate=errorRate)
+
+    @classmethod
+    def load(cls, path):
+        """ Read a filter written by save() """
+        with open(path, 'rb') as f:
+            (magic, bits, hashes, capacity, count, position, errorRate) = cls._header.unpack(f.read(cls._header.size))
+            if magic != cls._magic:
+                raise ValueError("{} is not a saved filter".format(path))
+            bloom = cls(bits, hashes, f.read(), capacity, errorRate)
+        if len(bloom.data) != (bloom.bits + 7) // 8:
+            raise ValueError("{} is truncated".format(path))
+        bloom.count = count
+        bloom.position = position
+        return bloom
+
+    def save(self, path):
+        """ Write the filter to a file.  Written to a temporary file, then moved into place, so readers never see half of it """
+        (fd, temp) = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._header.pack(self._magic, self.bits, self.hashes, self.capacity, self.count, self.position, self.errorRate))
+                f.write(self.data)
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    def _indexes(self, key):
+        # Double hashing, from a single digest.
+        d = hashlib.md5(bytes(key, 'utf8')).digest()
+        h1 = int.from_bytes(d[:8], 'little')
+        h2 = int.from_bytes(d[8:], 'little') | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, key):
+        for i in self._indexes(key):
+            self.data[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.data[i >> 3] & (1 << (i & 7)) for i in self._indexes(key))
+
 # Get a hash function.  Configurable.
 
 _hashMagic = struct.pack("!I", 0xffeeddcc)
@@ -964,6 +1071,28 @@ def hashDir(crypt, files, decrypt=False):
     m.update(_hashMagic)
     return (m.hexdigest(), len(filenames))
 
+def hashTree(crypt, files, subtrees):
+    """ Generate the digest of a directory tree, from the stat info of each file in the directory, and the digests of
+        the trees below each subdirectory, in subtrees, keyed by (inode, device) """
+    m = crypt.getHash()
+    m.update(_hashMagic)
+    m.update(struct.pack("!I", len(files)))
+    for f in sorted(files, key=lambda x: x['name']):
+        m.update(bytes(f['name'], 'utf8', 'xmlcharrefreplace'))
+        m.update(b'\0')
+        # Everything the server compares to decide if a file has changed, except the access time, which changes whenever it's read
+        m.update(struct.pack("!QQQqqQQQQ??", f['inode'], f['dev'], f['size'], f['mtime'], f['ctime'],
+                             f['mode'], f['uid'], f['gid'], f['nlinks'], bool(f['dir']), bool(f['link'])))
+        m.update(bytes(f.get('xattr') or '', 'utf8'))
+        m.update(b'\0')
+        m.update(bytes(f.get('acl') or '', 'utf8'))
+        m.update(b'\0')
+        if f['dir']:
+            m.update(bytes(subtrees.get((f['inode'], f['dev']), ''), 'utf8'))
+            m.update(b'\0')
+    m.update(_hashMagic)
+    return m.hexdigest()
+
 
 def asString(a, policy='ignore'):
     if isinstance(a, str):
@@ -26,6 +26,7 @@ SOFTWARE.
 import os
 import ctypes
 import ctypes.util
+import math
 import syslog
 import tempfile
 
@@ -62,11 +63,19 @@ RS_BLOCKED = 1
 RS_JOB_BLOCKSIZE = 65536
 RS_DEFAULT_STRONG_LEN = 8
 RS_DEFAULT_BLOCK_LEN = 2048
+RS_MIN_BLOCK_LEN = 256
+RS_MAX_BLOCK_LEN = 128 * 1024
 
 RS_DELTA_MAGIC          = 0x72730236      # r s \2 6
 RS_MD4_SIG_MAGIC        = 0x72730136      # r s \1 6
 RS_BLAKE2_SIG_MAGIC     = 0x72730137      # r s \1 7
 
+# Signature hashes, by name.  BLAKE2 requires librsync 2.0 or later
+SIG_MAGICS = {
+    'md4':      RS_MD4_SIG_MAGIC,
+    'blake2':   RS_BLAKE2_SIG_MAGIC
+}
+
 #############################
 #  DEFINES FROM librsync.h  #
 #############################
@@ -147,43 +156,75 @@ def _execute(job, f, o=None):
     """
     Executes a librsync "job" by reading bytes from `f` and writing results to
     `o` if provided. If `o` is omitted, the output is ignored.
+    Neither `f` nor `o` need be seekable.  Input librsync doesn't consume in one
+    iteration is carried over to the next, rather than read again.  The input and
+    output buffers are reused, and filled and emptied through memoryviews, so `o`
+    mustn't keep a reference to the data it's handed.
     """
-    # Re-use the same buffer for output, we will read from it after each
-    # iteration.
+    inbuf = ctypes.create_string_buffer(RS_JOB_BLOCKSIZE)
+    inview = memoryview(inbuf).cast('B')
     out = ctypes.create_string_buffer(RS_JOB_BLOCKSIZE)
+    outview = memoryview(out).cast('B')
+    readinto = getattr(f, 'readinto', None)
+
+    buff = Buffer()
+    inptr = ctypes.cast(inbuf, ctypes.c_char_p)
+    outptr = ctypes.cast(out, ctypes.c_char_p)
+    avail = 0
+    eof = False
     while True:
-        block = f.read(RS_JOB_BLOCKSIZE)
-        buff = Buffer()
-        # provide the data block via input buffer.
-        buff.next_in = ctypes.c_char_p(block)
-        buff.avail_in = ctypes.c_size_t(len(block))
-        buff.eof_in = ctypes.c_int(not block)
-        # Set up our buffer for output.
-        buff.next_out = ctypes.cast(out, ctypes.c_char_p)
-        buff.avail_out = ctypes.c_size_t(RS_JOB_BLOCKSIZE)
+        # Top up the input buffer behind whatever was left over last time
+        if not eof and avail < RS_JOB_BLOCKSIZE:
+            if readinto:
+                n = readinto(inview[avail:]) or 0
+            else:
+                block = f.read(RS_JOB_BLOCKSIZE - avail)
+                n = len(block)
+                inview[avail:avail + n] = block
+            eof = (n == 0)
+            avail += n
+        buff.next_in = inptr
+        buff.avail_in = avail
+        buff.eof_in = int(eof)
+        buff.next_out = outptr
+        buff.avail_out = RS_JOB_BLOCKSIZE
         r = _librsync.rs_job_iter(job, ctypes.byref(buff))
-        if o:
-            o.write(out.raw[:RS_JOB_BLOCKSIZE - buff.avail_out])
+        n = RS_JOB_BLOCKSIZE - buff.avail_out
+        if o and n:
+            o.write(outview[:n])
         if r == RS_DONE:
             break
         elif r != RS_BLOCKED:
             raise LibrsyncError(r)
-        if buff.avail_in > 0:
-            # There is data left in the input buffer, librsync did not consume
-            # all of it. Rewind the file a bit so we include that data in our
-            # next read. It would be better to simply tack data to the end of
-            # this buffer, but that is very difficult in Python.
-            f.seek(f.tell() - buff.avail_in)
+        # Move anything librsync didn't consume to the front of the buffer
+        left = buff.avail_in
+        if left and left != avail:
+            ctypes.memmove(inbuf, ctypes.addressof(inbuf) + (avail - left), left)
+        avail = left
     if o and callable(getattr(o, 'seek', None)):
         # As a matter of convenience, rewind the output file.
         o.seek(0)
     return o
 
+def blockSize(filesize):
+    """
+    Choose the signature block size for a file.  The square root of the size, rounded up to a multiple of 64, between
+    RS_MIN_BLOCK_LEN and RS_MAX_BLOCK_LEN.  This keeps the number of blocks (and so the signature size, and the time to
+    build its hash table) growing with the square root of the file size, while keeping blocks small enough in small files
+    to find matches.
+    """
+    size = int(math.sqrt(max(filesize, 0)))
+    size = (size + 63) & ~63
+    return min(max(size, RS_MIN_BLOCK_LEN), RS_MAX_BLOCK_LEN)
+
+def sigParams(filesize, sigHash='md4'):
+    """ Parameters for signature() or SignatureJob() for a file of the given size """
+    return { 'block_size': blockSize(filesize), 'magic': SIG_MAGICS[sigHash] }
+
 def debug(level=syslog.LOG_DEBUG):
     assert level in TRACE_LEVELS, "Invalid log level %i" % level
     _librsync.rs_trace_set_level(level)
 
-@seekable
 def signature(f, s=None, block_size=RS_DEFAULT_BLOCK_LEN, magic=RS_MD4_SIG_MAGIC):
     """
     Generate a signature for the file `f`. The signature will be written to `s`.
@@ -200,13 +241,12 @@ def signature(f, s=None, block_size=RS_DEFAULT_BLOCK_LEN, magic=RS_MD4_SIG_MAGIC
         _librsync.rs_job_free(job)
     return s
 
-@seekable
 def delta(f, s, d=None):
     """
     Create a delta for the file `f` using the signature read from `s`. The delta
     will be written to `d`. If `d` is omitted, a temporary file will be used.
     This function returns the delta file `d`. All parameters must be file-like
-    objects.
+    objects, but needn't be seekable.
     """
     if d is None:
         d = tempfile.SpooledTemporaryFile(max_size=MAX_SPOOL, mode='wb+')
@@ -273,15 +313,16 @@ class SignatureJob(object):
         self.job = job
         self.buff = Buffer()
         self.out = ctypes.create_string_buffer(RS_JOB_BLOCKSIZE)
+        self.outview = memoryview(self.out).cast('B')
+        self.outptr = ctypes.cast(self.out, ctypes.c_char_p)
 
 
     def step(self, data):
         # Make sure we have something
         if data is None:
-            data = ''
+            data = b''
 
         buff = self.buff
-        out = self.out
 
         # provide the data block via input buffer.
         buff.eof_in = ctypes.c_int(not data)
@@ -293,11 +334,12 @@ class SignatureJob(object):
         # than the input.  But just for correctness.....
         while True:
             # Set up our buffer for output.
-            buff.next_out = ctypes.cast(out, ctypes.c_char_p)
-            buff.avail_out = ctypes.c_size_t(RS_JOB_BLOCKSIZE)
+            buff.next_out = self.outptr
+            buff.avail_out = RS_JOB_BLOCKSIZE
             r = _librsync.rs_job_iter(self.job, ctypes.byref(buff))
-            if self.output:
-                self.output.write(out.raw[:RS_JOB_BLOCKSIZE - buff.avail_out])
+            n = RS_JOB_BLOCKSIZE - buff.avail_out
+            if self.output and n:
+                self.output.write(self.outview[:n])
             if r == RS_DONE:
                 return True
             elif r != RS_BLOCKED:
@@ -52,9 +52,42 @@ CREATE TABLE IF NOT EXISTS CheckSums (
     ChainLength INTEGER,
     Added       INTEGER,            -- References BackupSet, but not foreign key, as sets can be deleted.
     IsFile      INTEGER,            -- Boolean, is there a file backing this checksum
+    Chunked     INTEGER DEFAULT 0,  -- Boolean, is the data stored as a list of chunks in the Chunks table
+    HashAlg     TEXT,               -- Hash the checksum was generated with.  NULL for MD5
     FOREIGN KEY(Basis) REFERENCES CheckSums(Checksum)
 );
 
+CREATE TABLE IF NOT EXISTS Chunks (
+    ChecksumId  INTEGER NOT NULL,   -- The chunked file
+    Seq         INTEGER NOT NULL,   -- Position of this chunk within the file
+    ChunkId     INTEGER NOT NULL,   -- The chunk's data
+    PRIMARY KEY(ChecksumId, Seq),
+    FOREIGN KEY(ChecksumId) REFERENCES CheckSums(ChecksumId),
+    FOREIGN KEY(ChunkId) REFERENCES CheckSums(ChecksumId)
+);
+
+CREATE TABLE IF NOT EXISTS PartialUploads (
+    Inode       INTEGER NOT NULL,   -- The client's file, whose upload hasn't finished
+    Device      INTEGER NOT NULL,
+    Size        INTEGER NOT NULL,   -- Size and modification time of the file when it was sent.  Only resumed if they still match
+    MTime       INTEGER NOT NULL,
+    Offset      INTEGER NOT NULL,   -- Position of this piece within the file
+    Length      INTEGER NOT NULL,
+    ChunkId     INTEGER NOT NULL,   -- The piece's data
+    Received    INTEGER NOT NULL,   -- When it arrived
+    PRIMARY KEY(Inode, Device, Offset),
+    FOREIGN KEY(ChunkId) REFERENCES CheckSums(ChecksumId)
+);
+
+CREATE TABLE IF NOT EXISTS TreeDigests (
+    Inode       INTEGER NOT NULL,   -- A directory on the client
+    Device      INTEGER NOT NULL,
+    Digest      TEXT NOT NULL,      -- Digest of the stat info of its files, and the digests of its subdirectories
+    FirstSet    INTEGER NOT NULL,
+    LastSet     INTEGER NOT NULL,
+    PRIMARY KEY(Inode, Device, FirstSet)
+);
+
 CREATE TABLE IF NOT EXISTS Names (
     Name        TEXT UNIQUE NOT NULL,
     NameId      INTEGER PRIMARY KEY AUTOINCREMENT
@@ -96,6 +129,7 @@ CREATE INDEX IF NOT EXISTS ParentFirstIndex ON Files(Parent ASC, ParentDev ASC,
 CREATE INDEX IF NOT EXISTS InodeLastIndex ON Files(Inode ASC, Device ASC, LastSet ASC);
 CREATE INDEX IF NOT EXISTS ParentLastndex ON Files(Parent ASC, ParentDev ASC, LastSet ASC);
 CREATE INDEX IF NOT EXISTS NameIndex ON Names(Name ASC);
+CREATE INDEX IF NOT EXISTS ChunkIndex ON Chunks(ChunkId ASC);
 CREATE INDEX IF NOT EXISTS InodeIndex ON Files(Inode ASC, Device ASC, Parent ASC, ParentDev ASC, FirstSet ASC, LastSet ASC);
 
 INSERT OR IGNORE INTO Backups (Name, StartTime, EndTime, ClientTime, Completed, Priority, FilesFull, FilesDelta, BytesReceived) VALUES (".Initial", 0, 0, 0, 1, 0, 0, 0, 0);
@@ -107,5 +141,5 @@ CREATE VIEW IF NOT EXISTS VFiles AS
     JOIN Backups ON Backups.BackupSet BETWEEN Files.FirstSet AND Files.LastSet
     LEFT OUTER JOIN CheckSums ON Files.ChecksumId = CheckSums.ChecksumId;
 
-INSERT OR REPLACE INTO Config (Key, Value) VALUES ("SchemaVersion", "17");
+INSERT OR REPLACE INTO Config (Key, Value) VALUES ("SchemaVersion", "21");
 INSERT OR REPLACE INTO Config (Key, Value) VALUES ("VacuumInterval", "5");
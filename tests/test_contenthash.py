@@ -0,0 +1,75 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2020, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+""" Checks of the content hash a BACKUP message asks for, against the one the backup set uses """
+
+import os
+
+import pytest
+
+# The server needs librsync, and the rest of its dependencies
+Daemon = pytest.importorskip("Tardis.Daemon", exc_type=ImportError)
+from Tardis import TardisCrypto, TardisDB
+
+@pytest.fixture
+def handler(tmp_path):
+    # Just enough of a session handler to check the hash against a real, new, database
+    handler = Daemon.TardisServerHandler.__new__(Daemon.TardisServerHandler)
+    handler.db = TardisDB.TardisDB(os.path.join(tmp_path, "tardis.db"), initialize=Daemon.schemaFile)
+    yield handler
+    handler.db.close()
+
+def test_new_set_uses_md5(handler):
+    handler.checkContentHash(None, TardisCrypto.getContentHashNames())
+    assert handler.db.getContentHash() == 'md5'
+
+def test_switched_set_then_backup_without_content_hash(handler):
+    names = TardisCrypto.getContentHashNames()
+    handler.checkContentHash('blake2b', names)
+    assert handler.db.getContentHash() == 'blake2b'
+    # A later backup which doesn't ask to switch keeps the set's hash, and isn't rejected
+    handler.checkContentHash(None, names)
+    assert handler.db.getContentHash() == 'blake2b'
+
+def test_switched_set_rejects_legacy_client(handler):
+    handler.checkContentHash('blake2b', TardisCrypto.getContentHashNames())
+    # Clients which don't list the hashes they can use only know MD5
+    with pytest.raises(Daemon.InitFailedException):
+        handler.checkContentHash(None, None)
+
+def test_switched_set_rejects_client_without_hash(handler):
+    handler.checkContentHash('blake2b', TardisCrypto.getContentHashNames())
+    with pytest.raises(Daemon.InitFailedException):
+        handler.checkContentHash(None, ['md5'])
+
+def test_unknown_hash(handler):
+    with pytest.raises(Daemon.InitFailedException):
+        handler.checkContentHash('nosuchhash', TardisCrypto.getContentHashNames())
+    assert handler.db.getContentHash() == 'md5'
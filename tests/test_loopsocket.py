@@ -0,0 +1,207 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2020, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+""" Checks of LoopSocket's message framing, spooling, and flow control, against a real connection """
+
+import asyncio
+import json
+import socket
+import struct
+import threading
+import zlib
+
+import pytest
+
+from Tardis import LoopSocket
+
+class Server:
+    """ An event loop in a thread, accepting one connection as a LoopSocket, and a plain socket connected to it """
+    def __init__(self, highWater=None, lowWater=None):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.accepted = threading.Event()
+        def connected(sock):
+            self.sock = sock
+            self.accepted.set()
+        def factory():
+            sock = LoopSocket.LoopSocket(self.loop, connected)
+            if highWater:
+                sock.highWater = highWater
+                sock.lowWater = lowWater
+            return sock
+        self.listener = self.run(self.loop.create_server(factory, '127.0.0.1', 0))
+        port = self.listener.sockets[0].getsockname()[1]
+        self.client = socket.create_connection(('127.0.0.1', port))
+        self.accepted.wait(5)
+        self.sock.settimeout(5)
+
+    def run(self, coro, timeout=5):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def call(self, func, *args):
+        async def doit():
+            return func(*args)
+        return self.run(doit())
+
+    def startMessages(self, spoolDir=None):
+        self.call(self.sock.startMessages, 'bin', zlib.decompress, lambda data: json.loads(bytes(data)), ('CON',), spoolDir)
+
+    def close(self):
+        self.client.close()
+        self.sock.close()
+        self.listener.close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+
+@pytest.fixture
+def server():
+    s = Server()
+    yield s
+    s.close()
+
+def frame(data, compress=False):
+    if compress:
+        data = zlib.compress(data)
+        return struct.pack("!I", len(data) | 0x80000000) + data
+    return struct.pack("!I", len(data)) + data
+
+def message(m, compress=False):
+    return frame(json.dumps(m).encode('utf-8'), compress)
+
+def readFrame(sock):
+    """ Read a frame as a thread would, from the LoopSocket """
+    header = b''
+    while len(header) < 4:
+        header += sock.recv(4 - len(header))
+    (n,) = struct.unpack("!I", header)
+    # Frames always reach the thread uncompressed
+    assert not n & 0x80000000
+    data = bytearray(n)
+    got = 0
+    while got < n:
+        got += sock.recv_into(memoryview(data)[got:], n - got)
+    return bytes(data)
+
+def test_passthrough_before_messages(server):
+    server.client.sendall(b'hello')
+    assert server.sock.recv(1024) == b'hello'
+
+def test_message_waits_for_data(server):
+    server.startMessages()
+    server.client.sendall(message({'message': 'DIR'}, compress=True))
+    server.run(server.sock.waitForMessage())
+    assert json.loads(readFrame(server.sock)) == {'message': 'DIR'}
+
+    # A content message isn't ready until its data, the empty frame ending it, and the trailer have all arrived
+    server.client.sendall(message({'message': 'CON'}) + frame(b'a' * 1000) + frame(b'b' * 1000, compress=True))
+    with pytest.raises(Exception):
+        server.run(server.sock.waitForMessage(), timeout=0.5)
+    server.client.sendall(frame(b'') + message({'chunk': 'done'}))
+    server.run(server.sock.waitForMessage())
+    assert json.loads(readFrame(server.sock)) == {'message': 'CON'}
+    assert readFrame(server.sock) == b'a' * 1000
+    assert readFrame(server.sock) == b'b' * 1000
+    assert readFrame(server.sock) == b''
+    assert json.loads(readFrame(server.sock)) == {'chunk': 'done'}
+
+def test_split_frames_already_received(server):
+    # Anything which arrives before messages are split out is split too, once they are
+    server.client.sendall(b'init' + message({'message': 'BYE'}))
+    assert server.sock.recv(4) == b'init'
+    threading.Event().wait(0.2)
+    server.startMessages()
+    server.run(server.sock.waitForMessage())
+    assert json.loads(readFrame(server.sock)) == {'message': 'BYE'}
+
+def test_large_message_spooled(tmp_path):
+    server = Server(highWater=16 * 1024, lowWater=4 * 1024)
+    try:
+        server.startMessages(str(tmp_path))
+        blocks = [bytes([i]) * 8192 for i in range(32)]
+        waiting = asyncio.run_coroutine_threadsafe(server.sock.waitForMessage(), server.loop)
+        server.client.sendall(message({'message': 'CON'}) + b''.join(frame(b) for b in blocks) + frame(b'') + message({'chunk': 'done'}))
+        waiting.result(5)
+        # Only the start of the message is kept in memory
+        assert server.sock.buffered <= 16 * 1024 + 8192 + 64
+        assert any(isinstance(s, LoopSocket._Spool) for s in server.sock.segments)
+        assert json.loads(readFrame(server.sock)) == {'message': 'CON'}
+        for b in blocks:
+            assert readFrame(server.sock) == b
+        assert readFrame(server.sock) == b''
+        assert json.loads(readFrame(server.sock)) == {'chunk': 'done'}
+
+        # And anything after it is back in memory
+        server.client.sendall(message({'message': 'DIR'}))
+        server.run(server.sock.waitForMessage())
+        assert json.loads(readFrame(server.sock)) == {'message': 'DIR'}
+    finally:
+        server.close()
+
+def test_reading_paused_when_thread_behind():
+    server = Server(highWater=16 * 1024, lowWater=4 * 1024)
+    try:
+        server.startMessages()
+        # Nothing's waiting for a message, so reading stops once enough are waiting to be read
+        data = b''.join(message({'message': 'DIR', 'n': i, 'pad': 'x' * 1000}) for i in range(100))
+        sender = threading.Thread(target=server.client.sendall, args=(data,), daemon=True)
+        sender.start()
+        threading.Event().wait(0.5)
+        assert server.sock.paused
+        assert server.sock.buffered < 16 * 1024 + 2048
+        for i in range(100):
+            server.run(server.sock.waitForMessage())
+            assert json.loads(readFrame(server.sock))['n'] == i
+        sender.join(5)
+    finally:
+        server.close()
+
+def test_writes_block_when_peer_not_reading():
+    server = Server(highWater=64 * 1024, lowWater=16 * 1024)
+    try:
+        server.sock.settimeout(0.5)
+        block = memoryview(bytearray(b'x' * 16 * 1024))
+        sent = 0
+        with pytest.raises(socket.timeout):
+            for _ in range(100000):
+                server.sock.sendmsg([struct.pack("!I", len(block)), block])
+                sent += 4 + len(block)
+                # Never more than the limit, plus what one call adds, queued for the loop
+                assert server.sock.queued <= 64 * 1024 + 4 + len(block)
+        # Everything accepted gets through, in order, once the peer reads
+        server.client.settimeout(5)
+        received = 0
+        while received < sent:
+            data = server.client.recv(1024 * 1024)
+            assert data
+            received += len(data)
+        assert received == sent
+    finally:
+        server.close()
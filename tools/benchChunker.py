@@ -0,0 +1,91 @@
+#! /usr/bin/env python3
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2020, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Measure the throughput of the chunker used by --chunk-dedup, with each of the hash scanners available, and check they
+all cut the data in exactly the same places.  Data is random, with a copy of part of it, shifted, to deduplicate.
+"""
+
+from Tardis import Chunker
+import argparse
+import io
+import random
+import time
+
+def mkData(size, seed):
+    rand = random.Random(seed)
+    data = rand.getrandbits(size * 8).to_bytes(size, 'little')
+    # Repeat the first half, one byte in, so there are chunks to share
+    half = size // 2
+    return data[:half] + b'x' + data[:half - 1]
+
+def chunkAll(data, avgsize):
+    return [(offset, len(chunk)) for (offset, chunk) in Chunker.Chunker(io.BytesIO(data), avgsize=avgsize)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the throughput of the content defined chunker", add_help=True)
+    parser.add_argument('--size', '-s', dest='size', type=int, default=64 * 1024 * 1024, help='Bytes of data to chunk.  Default: %(default)s')
+    parser.add_argument('--avgsize', '-a', dest='avgsize', type=int, default=1024 * 1024, help='Average chunk size.  Default: %(default)s')
+    parser.add_argument('--repeat', '-r', dest='repeat', type=int, default=3, help='Number of times to time each.  Default: %(default)s')
+    parser.add_argument('--seed', dest='seed', type=int, default=1, help='Random seed.  Default: %(default)s')
+    args = parser.parse_args()
+
+    data = mkData(args.size, args.seed)
+    scanners = [('python', Chunker.Chunker._scanPython)]
+    if Chunker.numpy is not None:
+        scanners.append(('numpy', Chunker.Chunker._scanNumpy))
+    else:
+        print("numpy not available.  Only timing the pure Python scanner")
+
+    saved = Chunker.Chunker._scan
+    expected = None
+    print(f"{args.size:,} bytes, average chunk size {args.avgsize:,}")
+    print(f"{'':10s} {'chunks':>8s} {'shared':>8s} {'time':>10s} {'MB/s':>10s}")
+    try:
+        for (name, scan) in scanners:
+            Chunker.Chunker._scan = staticmethod(scan)
+            best = None
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                chunks = chunkAll(data, args.avgsize)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            if expected is None:
+                expected = chunks
+            elif chunks != expected:
+                print(f"{name} chunk boundaries differ from {scanners[0][0]}")
+            shared = len(chunks) - len(set(data[o:o + n] for (o, n) in chunks))
+            print(f"{name:10s} {len(chunks):8d} {shared:8d} {best:9.2f}s {args.size / best / (1024 * 1024):10.1f}")
+    finally:
+        Chunker.Chunker._scan = saved
+
+if __name__ == "__main__":
+    main()
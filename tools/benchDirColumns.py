@@ -0,0 +1,131 @@
+#! /usr/bin/env python3
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2020, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Compare the size of DIR messages, and the time the server takes to decode them and read each file's fields, with the
+files sent as a list of dicts, and as columns.  Files are synthetic, but with realistic names and values.
+"""
+
+from Tardis import DirColumns
+import argparse
+import random
+import time
+import zlib
+import msgpack
+
+def mkFiles(count, seed):
+    rand = random.Random(seed)
+    now = int(time.time())
+    files = []
+    for i in range(count):
+        mtime = now - rand.randrange(5 * 365 * 86400)
+        isDir = rand.random() < 0.05
+        f = {
+            'name':   f"file_{rand.randrange(1000000):06d}.{rand.choice(['c', 'py', 'txt', 'jpg', 'html', 'o'])}",
+            'inode':  1000000 + i * 3,
+            'dev':    2049,
+            'dir':    isDir,
+            'link':   rand.random() < 0.01,
+            'nlinks': 1,
+            'size':   4096 if isDir else int(rand.lognormvariate(9, 3)),
+            'mtime':  mtime,
+            'ctime':  mtime + rand.randrange(100),
+            'atime':  now - rand.randrange(86400),
+            'mode':   0o40755 if isDir else 0o100644,
+            'uid':    1000,
+            'gid':    1000,
+        }
+        if rand.random() < 0.02:
+            f['xattr'] = '%032x' % rand.getrandbits(128)
+        files.append(f)
+    return files
+
+def readFields(files):
+    # The fields the server's checkFile reads from every file
+    n = 0
+    for f in files:
+        n += f['inode'] + f['dev'] + f['size'] + f['mtime'] + f['ctime'] + f['mode'] + f['nlinks']
+        n += len(f['name']) + f['dir'] + ('xattr' in f) + ('acl' in f)
+    return n
+
+def timeit(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare DIR messages as lists of files, and as columns", add_help=True)
+    parser.add_argument('--files', '-f', dest='files', type=int, default=100000, help='Number of files.  Default: %(default)s')
+    parser.add_argument('--dirslice', '-d', dest='dirslice', type=int, default=128 * 1024, help='Files per message.  Default: %(default)s')
+    parser.add_argument('--repeat', '-r', dest='repeat', type=int, default=5, help='Number of times to time each.  Default: %(default)s')
+    parser.add_argument('--seed', dest='seed', type=int, default=1, help='Random seed.  Default: %(default)s')
+    args = parser.parse_args()
+
+    files = mkFiles(args.files, args.seed)
+    chunks = [files[x : x + args.dirslice] for x in range(0, len(files), args.dirslice)]
+    plain   = [msgpack.packb({'message': 'DIR', 'files': c}, use_bin_type=True) for c in chunks]
+    columns = [msgpack.packb({'message': 'DIR', 'columns': DirColumns.encode(c)}, use_bin_type=True) for c in chunks]
+
+    def unpackPlain():
+        for m in plain:
+            msgpack.unpackb(m, raw=False)['files']
+
+    def unpackColumns():
+        for m in columns:
+            DirColumns.DirColumns(msgpack.unpackb(m, raw=False)['columns'])
+
+    def decodePlain():
+        for m in plain:
+            readFields(msgpack.unpackb(m, raw=False)['files'])
+
+    def decodeColumns():
+        for m in columns:
+            readFields(DirColumns.DirColumns(msgpack.unpackb(m, raw=False)['columns']))
+
+    decoded = [f for m in columns for f in DirColumns.DirColumns(msgpack.unpackb(m, raw=False)['columns'])]
+    assert readFields(decoded) == readFields(files)
+
+    print(f"{args.files:,} files in {len(chunks)} messages")
+    print(f"{'':10s} {'bytes':>12s} {'zlib':>12s} {'unpack':>10s} {'+read':>10s} {'encode':>10s}")
+    for (name, msgs, unpack, decode, encode) in [
+            ('files', plain, unpackPlain, decodePlain, lambda: [msgpack.packb({'files': c}) for c in chunks]),
+            ('columns', columns, unpackColumns, decodeColumns, lambda: [msgpack.packb({'columns': DirColumns.encode(c)}) for c in chunks])]:
+        size = sum(map(len, msgs))
+        zsize = sum(len(zlib.compress(m)) for m in msgs)
+        times = [timeit(f, args.repeat) * 1000 for f in (unpack, decode, encode)]
+        print(f"{name:10s} {size:12,d} {zsize:12,d} {times[0]:8.1f}ms {times[1]:8.1f}ms {times[2]:8.1f}ms")
+
+if __name__ == "__main__":
+    main()
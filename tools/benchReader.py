@@ -0,0 +1,92 @@
+#! /usr/bin/env python3
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2020, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Microbenchmark for the CompressedBuffer readers.  Compares the throughput of the old BufferedReader.read
+implementation, which concatenated and resliced bytes objects, with the current one, and with readinto.
+"""
+
+from Tardis import CompressedBuffer, Util
+import argparse
+import hashlib
+import time
+
+class LegacyReader(CompressedBuffer.BufferedReader):
+    """ The BufferedReader.read implementation from before the zero-copy rewrite """
+    def read(self, size=0x7fffffff):
+        out = b''
+        left = size
+        while len(out) < size:
+            if (not self.buffer) or (len(self.buffer) == 0):
+                self.buffer = self._get()
+                if not self.buffer:
+                    return out
+            amount = min(left, len(self.buffer))
+            out = out + self.buffer[:amount]
+            self.buffer = self.buffer[amount:]
+            left -= amount
+        return out
+
+def runRead(reader, readsize):
+    while reader.read(readsize):
+        pass
+
+def runReadInto(reader, readsize):
+    buf = bytearray(readsize)
+    while reader.readinto(buf):
+        pass
+
+def bench(name, cls, run, args):
+    with open(args.file, 'rb') as f:
+        hasher = hashlib.md5() if args.hash else None
+        reader = cls(f, chunksize=args.chunksize, hasher=hasher)
+        start = time.time()
+        run(reader, args.readsize)
+        duration = time.time() - start
+    size = reader.size()
+    print(f"{name:12s} {Util.fmtSize(size):>10s} {duration:8.3f}s  {(size / (1024 * 1024) / duration):8.2f} MB/s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CompressedBuffer readers", add_help=True)
+    parser.add_argument('--readsize', '-r', dest='readsize', type=int, default=4 * 1024 * 1024, help='Size of each read.  Default: %(default)s')
+    parser.add_argument('--chunksize', '-c', dest='chunksize', type=int, default=CompressedBuffer._defaultChunksize, help='Reader chunk size.  Default: %(default)s')
+    parser.add_argument('--hash', dest='hash', default=False, action=Util.StoreBoolean, help='Hash the data while reading.  Default: %(default)s')
+    parser.add_argument('file', help='File to read.  Use a multi-GB file, and run twice, so the file is in cache')
+
+    Util.addGenCompletions(parser)
+    args = parser.parse_args()
+
+    bench('legacy read', LegacyReader, runRead, args)
+    bench('read', CompressedBuffer.BufferedReader, runRead, args)
+    bench('readinto', CompressedBuffer.BufferedReader, runReadInto, args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#! /usr/bin/env python3
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Tardis: A Backup System
+# Copyright 2013-2020, Eric Koldinger, All Rights Reserved.
+# kolding@washington.edu
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Train a zstd dictionary for compressing messages between the client and server, from samples of DIR and CLN messages,
+and their responses, recorded by a server with RecordMessages set.  Install the result on both the server and the
+clients, and set MsgDictionary to it.  Compares the sizes of the samples compressed with zlib, zstd, and zstd with the
+new dictionary.
+"""
+
+from Tardis import Util
+import argparse
+import os
+import zlib
+import zstandard as zstd
+
+def loadSamples(dirs):
+    samples = []
+    for d in dirs:
+        for entry in os.scandir(d):
+            if entry.is_file():
+                with open(entry.path, 'rb') as f:
+                    samples.append(f.read())
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser(description="Train a dictionary for compressing messages", add_help=True)
+    parser.add_argument('--size', '-s', dest='size', type=int, default=112 * 1024, help='Size of the dictionary.  Default: %(default)s')
+    parser.add_argument('--level', '-l', dest='level', type=int, default=3, help='Compression level to compare at.  Default: %(default)s')
+    parser.add_argument('--output', '-o', dest='output', required=True, help='File to write the dictionary to')
+    parser.add_argument('samples', nargs='+', help='Directories of recorded messages')
+
+    Util.addGenCompletions(parser)
+    args = parser.parse_args()
+
+    samples = loadSamples(args.samples)
+    if not samples:
+        parser.error("No samples found")
+    dictionary = zstd.train_dictionary(args.size, samples)
+    with open(args.output, 'wb') as f:
+        f.write(dictionary.as_bytes())
+    print(f"Dictionary {dictionary.dict_id()}: {Util.fmtSize(len(dictionary.as_bytes()))} from {len(samples):,} samples")
+
+    total = sum(map(len, samples))
+    plain = zstd.ZstdCompressor(level=args.level)
+    withDict = zstd.ZstdCompressor(level=args.level, dict_data=dictionary)
+    for (name, compress) in [('zlib', zlib.compress), ('zstd', plain.compress), ('zstd+dict', withDict.compress)]:
+        size = sum(len(compress(s)) for s in samples)
+        print(f"{name:10s} {Util.fmtSize(total):>10s} => {Util.fmtSize(size):>10s}  {(100.0 * size / total):6.2f}%")
+
+if __name__ == "__main__":
+    main()